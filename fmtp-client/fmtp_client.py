@@ -27,10 +27,21 @@ Nachrichten abrufen und bestätigen (löschen):
 >>>    print message.content
 >>>    message.acknowledge()
 
+Nachrichten mehrerer Queues mit einer Liste abrufen:
+
+>>> for message in myserver.subscribe(prefix='printer-'):
+>>>    print message.queue.queue_url, message.content
+>>>    message.acknowledge()
+
 """
 
+from cStringIO import StringIO
+import base64
+import gzip
 import logging
-from urlparse import urljoin
+import re
+from urllib import unquote, urlencode
+from urlparse import urljoin, urlparse
 from huTools import hujson, http
 
 
@@ -61,6 +72,17 @@ class FmtpHttpError(FmtpError):
     """Diese Exception wird geworfen, wenn ein unerwarteter HTTP-Statuscode auftritt"""
 
 
+class FmtpRetryLater(FmtpHttpError):
+    """Diese Exception wird geworfen, wenn der Server überlastet ist (429 bzw. 503).
+
+    retry_after gibt an, wie viele Sekunden der Client laut Server warten soll, oder None.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(FmtpRetryLater, self).__init__(message)
+        self.retry_after = retry_after
+
+
 class Server(object):
     """Schnittstelle zu einem FMTP-Server.
 
@@ -80,6 +102,10 @@ class Server(object):
         """
         self.url = url
         self.credentials = credentials
+        # ETags der zuletzt leeren Listen von Abonnements, siehe subscribe
+        self.subscription_etags = {}
+        # Millisekunden, die der Client laut Server bis zum nächsten Abruf eines Abonnements warten soll.
+        self.retry_interval = None
 
     def __getitem__(self, key):
         """Gibt eine Queue auf dem Server mit dem gegebenen Namen zurück."""
@@ -87,48 +113,200 @@ class Server(object):
         url = urljoin(self.url, key).rstrip('/') + '/'
         return Queue(url, self.credentials)
 
+    def subscribe(self, queue_names=None, prefix=None):
+        """Iteriert über die Nachrichten mehrerer Queues, die der Server in einer Liste liefert.
+
+        queue_names: Namen der Queues
+        prefix: alle Queues, deren Name damit beginnt
+
+        Statt jede Queue einzeln abzufragen, wird die Liste des SubscriptionHandlers abgerufen (siehe
+        fmtp_server). Die Nachrichten werden einzeln abgerufen, message.queue ist ihre Queue. Liefert der
+        Server nicht alle Nachrichten auf einmal, wird die Liste erneut abgerufen, solange sie neue
+        Nachrichten enthält. Eine leere Liste merkt sich der Client per ETag, bis zu ihrer Änderung
+        antwortet der Server dann mit 304 Not Modified. Wie lange bis zum nächsten Aufruf gewartet werden
+        soll, steht danach in retry_interval.
+
+        Mögliche Exceptions sind FmtpFormatError, FmtpHttpError und FmtpRetryLater
+        """
+        params = [('queue', name) for name in queue_names or []]
+        if prefix:
+            params.append(('prefix', prefix))
+        list_url = urljoin(self.url, '_fmtp/subscription') + '?' + urlencode(params)
+        queues = {}
+        seen = set()
+        while True:
+            entries, more = self._fetch_subscription(list_url)
+            new = [(name, url) for name, url in entries if url not in seen]
+            for name, url in new:
+                seen.add(url)
+                if name not in queues:
+                    queues[name] = self[name]
+                yield queues[name]._fetch_message(url)
+            # Ohne neue Nachrichten wurden die gelieferten nicht bestätigt, erneutes Abrufen hilft dann nicht
+            if not (more and new):
+                return
+
+    def _fetch_subscription(self, list_url):
+        """Ruft die Liste eines Abonnements als JSON ab.
+
+        Gibt eine Liste von (Name der Queue, url) zurück, und ob der Server weitere Nachrichten hat. Ist die
+        Liste unverändert leer, ist sie leer.
+
+        Mögliche Exceptions: FmtpHttpError, FmtpFormatError, FmtpRetryLater
+        """
+        headers = {'Accept': 'application/json'}
+        if list_url in self.subscription_etags:
+            headers['If-None-Match'] = self.subscription_etags[list_url]
+        status, headers, body = http.fetch(list_url, method='GET', credentials=self.credentials,
+                                           headers=headers)
+        self.retry_interval = _get_retry_interval(headers) or self.retry_interval
+        if status == 304:
+            return [], False
+        _check_listing_status(list_url, status, headers)
+        try:
+            data = hujson.loads(body)
+            entries = [(msg['queue'], msg['url']) for msg in data['messages']]
+        except (ValueError, KeyError, TypeError):
+            raise FmtpFormatError('Expected a json subscription list at %s' % list_url)
+        # Nur eine leere Liste per ETag bestätigen, sonst gingen nicht bestätigte Nachrichten verloren
+        etag = headers.get('etag', headers.get('ETag'))
+        if etag and not entries:
+            self.subscription_etags[list_url] = etag
+        else:
+            self.subscription_etags.pop(list_url, None)
+        return entries, bool(data.get('more'))
+
+
+def _get_retry_interval(headers):
+    """Gibt das Retry-Interval aus dem Header X-FMTP-Retry-Interval in Millisekunden zurück, oder None."""
+    retry_interval = headers.get('x-fmtp-retry-interval', headers.get('X-FMTP-Retry-Interval'))
+    if retry_interval:
+        return int(retry_interval)
+    return None
+
+
+def _check_listing_status(list_url, status, headers):
+    """Wirft bei HTTP-Fehlern beim Abruf einer Liste eine Exception."""
+    if status in (429, 503):
+        retry_after = headers.get('retry-after', headers.get('Retry-After'))
+        raise FmtpRetryLater('requested %s as Messagelist, got %s' % (list_url, status),
+                             int(retry_after) if retry_after and retry_after.isdigit() else None)
+    if status != 200:
+        raise FmtpHttpError('requested %s as Messagelist, got %s' % (list_url, status))
+
+
+def _gzip_compress(data):
+    """Komprimiert data im gzip-Format."""
+    buf = StringIO()
+    fileobj = gzip.GzipFile(fileobj=buf, mode='wb')
+    fileobj.write(data)
+    fileobj.close()
+    return buf.getvalue()
+
+
+def _gzip_decompress(data):
+    """Entpackt gzip-komprimierte data."""
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
 
 class Queue(object):
     """Schnittstelle zu FMTP-Queues.
 
     Eine Queue startet HTTP-Verbindungen nur 'on demand', es ist daher sicher, Queues in einer Konfigurations-
     oder Environmentdatei als Singletons zu erstellen und später zu nutzen.
+
+    Nachrichten ab compress_min_size Bytes werden gzip-komprimiert gesendet, sobald der Server per
+    Accept-Encoding angezeigt hat, dass er das versteht.
     """
 
-    def __init__(self, queue_url, credentials=None):
+    # Nachrichten ab dieser Größe (in Bytes) werden komprimiert gesendet.
+    compress_min_size = 1024
+
+    def __init__(self, queue_url, credentials=None, wait=None, lease=None):
         """Instantiiert die Queue-Schnittstelle.
 
         queue_url: ist die URL des QueueHandlers (siehe fmtp_server)
         credetials: HTTP-Credetials in der form username:password
+        wait: Sekunden, die der Server beim Abruf der Nachrichtenübersicht auf neue Nachrichten warten soll,
+              wenn keine bereitstehen (Long-Polling). None wartet nicht.
+        lease: Sekunden, für die abgerufene Nachrichten vor anderen Clients verborgen werden sollen. Damit
+               können mehrere Clients dieselbe Queue abarbeiten. None least nicht.
         """
         self.queue_url = queue_url
         self.credentials = credentials
+        self.wait = wait
+        self.lease = lease
+        # Wird True, sobald der Server anzeigt, dass er gzip-komprimierte Requests versteht.
+        self.server_accepts_gzip = False
+        # Wird True, sobald der Server anzeigt, dass er Listen mit eingebetteten Bodies liefern kann.
+        self.server_inlines_bodies = False
+        # Millisekunden, die der Client laut Server bis zum nächsten Abruf der Liste warten soll.
+        self.retry_interval = None
+
+    def _note_server_encodings(self, headers):
+        """Merkt sich, ob der Server gzip-komprimierte Requests versteht (Accept-Encoding, RFC 7694)."""
+        accept_encoding = headers.get('accept-encoding', headers.get('Accept-Encoding', ''))
+        if 'gzip' in accept_encoding:
+            self.server_accepts_gzip = True
+        listing_formats = headers.get('x-fmtp-listing-formats', headers.get('X-FMTP-Listing-Formats', ''))
+        if 'application/x-ndjson' in listing_formats:
+            self.server_inlines_bodies = True
+
+    def _check_listing_status(self, list_url, status, headers):
+        """Merkt sich das Retry-Interval der Liste und wirft bei HTTP-Fehlern eine Exception."""
+        self.retry_interval = _get_retry_interval(headers) or self.retry_interval
+        _check_listing_status(list_url, status, headers)
 
     def __iter__(self):
         """Iteriert über die Nachrichten auf der Queue.
 
         Ruft zuerst die Nachrichtenübersicht ab, und dann schrittweise die einzelnen Nachrichten, und gibt
-        diese als Message wieder.
+        diese als Message wieder. Ist die Nachrichtenübersicht auf mehrere Seiten verteilt, werden diese
+        nacheinander abgerufen. Ist wait gesetzt, wartet der Server auf neue Nachrichten, falls die Queue leer
+        ist. Bietet der Server Listen mit eingebetteten Bodies an, werden diese genutzt und nur Nachrichten,
+        die nicht eingebettet sind, einzeln abgerufen. Ist lease gesetzt, sind die gelieferten Nachrichten
+        für diese Zeit vor anderen Clients verborgen und sollten innerhalb dieser Zeit verarbeitet und
+        gelöscht werden.
 
         Mögliche Exceptions sind FmtpFormatError und FmtpHttpError
         """
-        for url in self._fetch_message_urls():
-            yield self._fetch_message(url)
+        params = []
+        if self.wait:
+            params.append('wait=%s' % self.wait)
+        if self.lease:
+            params.append('lease=%d' % self.lease)
+        list_url = self.queue_url
+        if params:
+            list_url = '%s?%s' % (self.queue_url, '&'.join(params))
+        while list_url:
+            if self.server_inlines_bodies:
+                entries, list_url = self._fetch_inline_listing(list_url)
+            else:
+                message_urls, list_url = self._fetch_message_urls(list_url)
+                entries = [(url, None) for url in message_urls]
+            for url, message in entries:
+                yield message or self._fetch_message(url)
 
     def post_message(self, guid, content_type, content, ignore_duplication_errors=False):
         """Veröffentlicht eine Nachricht auf der FMTP-Queue.
 
         guid: Eindeutiger Bezeichner für die Nachricht
         content_type: Content-Type der Nachricht, beispielsweise text/plain
-        content: Inhalt der Nachricht
+        content: Inhalt der Nachricht, als String oder Dateiobjekt
         ignore_duplication_errors: Wenn True, werden die exceptions FmtpMessageExists und FmtpMessageDeleted
             nicht geworfen.
         """
         url = self.queue_url + guid + '/'
         headers = {'Content-Type': content_type}
+        if hasattr(content, 'read'):
+            content = content.read()
+        if self.server_accepts_gzip and len(content) >= self.compress_min_size:
+            content = _gzip_compress(content)
+            headers['Content-Encoding'] = 'gzip'
 
         status, headers, body = http.fetch(url, method='POST', credentials=self.credentials, headers=headers,
                                                                                               content=content)
+        self._note_server_encodings(headers)
         if status == 409:
             if not ignore_duplication_errors:
                 raise FmtpMessageExists('Message %s already exists' % url)
@@ -142,38 +320,157 @@ class Queue(object):
         elif status != 201:
             raise FmtpHttpError('expected 201 when posting to %s, got %s' % (url, status))
 
-    def _fetch_message_urls(self):
-        """Erfragt die URLs der Nachrichten auf der Queue vom Server, und gibt sie als Liste zurück.
+    def post_messages(self, messages, ignore_duplication_errors=False):
+        """Veröffentlicht mehrere Nachrichten mit einem einzigen Request auf der FMTP-Queue.
+
+        messages: Iterable aus (guid, content_type, content)-Tupeln, siehe post_message
+        ignore_duplication_errors: Wenn True, werden die exceptions FmtpMessageExists und FmtpMessageDeleted
+            nicht geworfen.
+
+        Gibt ein dict zurück, das jeder guid den HTTP-Status der Nachricht zuordnet. Auch wenn eine Exception
+        geworfen wird, wurden alle übrigen Nachrichten gespeichert.
+        """
+        lines = []
+        for guid, content_type, content in messages:
+            item = {'guid': guid, 'content_type': content_type}
+            try:
+                item['body'] = content.decode('utf-8')
+            except UnicodeDecodeError:
+                item['body_base64'] = base64.b64encode(content)
+            lines.append(hujson.dumps(item))
+
+        headers = {'Content-Type': 'application/x-ndjson'}
+        content = '\n'.join(lines)
+        if self.server_accepts_gzip and len(content) >= self.compress_min_size:
+            content = _gzip_compress(content)
+            headers['Content-Encoding'] = 'gzip'
+        status, headers, body = http.fetch(self.queue_url, method='POST', credentials=self.credentials,
+                                           headers=headers, content=content)
+        self._note_server_encodings(headers)
+        if status != 200:
+            raise FmtpHttpError('expected 200 when posting messages to %s, got %s' % (self.queue_url, status))
+        try:
+            results = dict((msg['guid'], msg['status']) for msg in hujson.loads(body)['messages'])
+        except (ValueError, KeyError, TypeError):
+            raise FmtpFormatError('Expected a json status list when posting messages to %s' % self.queue_url)
+
+        failed = [guid for guid, msgstatus in results.items() if msgstatus not in (201, 409, 410)]
+        if failed:
+            raise FmtpHttpError('posting %s to %s failed' % (', '.join(sorted(failed)), self.queue_url))
+        for msgstatus, exception in [(409, FmtpMessageExists), (410, FmtpMessageDeleted)]:
+            duplicates = sorted(guid for guid, s in results.items() if s == msgstatus)
+            if duplicates:
+                if not ignore_duplication_errors:
+                    raise exception('Messages %s in %s already exist or were deleted'
+                                    % (', '.join(duplicates), self.queue_url))
+                logger.info('Messages %s already in queue %s, ignored', ', '.join(duplicates), self.queue_url)
+        return results
+
+    def acknowledge_messages(self, messages):
+        """Bestätigt den Empfang mehrerer Nachrichten mit einem einzigen Request, und löscht sie von der Queue.
+
+        messages: Iterable aus Message-Objekten dieser Queue
+
+        Mögliche Exceptions: FmtpMessageDeleted, FmtpHttpError, FmtpFormatError
+        """
+        guids = [message.guid for message in messages]
+        status, headers, body = http.fetch(self.queue_url, method='DELETE', credentials=self.credentials,
+                                           headers={'Content-Type': 'application/json'},
+                                           content=hujson.dumps({'guids': guids}))
+        if status != 200:
+            raise FmtpHttpError('expected 200 when deleting messages from %s, got %s' % (self.queue_url, status))
+        try:
+            results = dict((msg['guid'], msg['status']) for msg in hujson.loads(body)['messages'])
+        except (ValueError, KeyError, TypeError):
+            raise FmtpFormatError('Expected a json status list when deleting messages from %s' % self.queue_url)
+
+        gone = sorted(guid for guid, msgstatus in results.items() if msgstatus == 410)
+        failed = sorted(guid for guid, msgstatus in results.items() if msgstatus not in (204, 410))
+        if failed:
+            raise FmtpHttpError('deleting %s from %s failed' % (', '.join(failed), self.queue_url))
+        if gone:
+            raise FmtpMessageDeleted('Messages %s already deleted' % ', '.join(gone))
+
+    def _fetch_message_urls(self, list_url):
+        """Erfragt die URLs der Nachrichten auf einer Seite der Nachrichtenübersicht vom Server.
+
+        Gibt die URLs als Liste und die URL der nächsten Seite (oder None, wenn es keine weitere gibt)
+        zurück.
 
         Mögliche Exceptions: FmtpHttpError, FmtpFormatError
         """
-        status, headers, body = http.fetch(self.queue_url, method='GET', credentials=self.credentials,
+        status, headers, body = http.fetch(list_url, method='GET', credentials=self.credentials,
                                                                        headers={'Accept': 'application/json'})
+        self._note_server_encodings(headers)
         # Nach HTTP-Fehlern schauen.
-        if status != 200:
-            raise FmtpHttpError('requested %s as Messagelist, got %s' % (self.queue_url, status))
+        self._check_listing_status(list_url, status, headers)
 
         # Antwort parsen, wenn nicht parsebar, exception
         try:
             data = hujson.loads(body)
         except:
-            raise FmtpFormatError('Expeceted to get a json messagelist at %s.' % self.queue_url)
+            raise FmtpFormatError('Expeceted to get a json messagelist at %s.' % list_url)
 
         # Urls auflisten, wenn Format nicht stimmt: exception
         try:
-            return [msg['url'] for msg in data['messages']]
+            return [msg['url'] for msg in data['messages']], data.get('next_url')
         except KeyError:
-            raise FmtpFormatError('Expected the message at %s list to have /messages[*]/url', self.queue_url)
+            raise FmtpFormatError('Expected the message at %s list to have /messages[*]/url', list_url)
+
+    def _fetch_inline_listing(self, list_url):
+        """Erfragt eine Seite der Nachrichtenübersicht im NDJSON-Format mit eingebetteten Bodies.
+
+        Gibt eine Liste von (url, message) zurück, message ist None, wenn der Server den Body nicht
+        eingebettet hat. Außerdem wird die URL der nächsten Seite (oder None) zurückgegeben.
+
+        Mögliche Exceptions: FmtpHttpError, FmtpFormatError
+        """
+        status, headers, body = http.fetch(list_url, method='GET', credentials=self.credentials,
+                                           headers={'Accept': 'application/x-ndjson'})
+        self._note_server_encodings(headers)
+        self._check_listing_status(list_url, status, headers)
+
+        entries = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = hujson.loads(line)
+                message = None
+                if 'body_base64' in item:
+                    content = base64.b64decode(item['body_base64'])
+                elif 'body' in item:
+                    content = item['body'].encode('utf-8')
+                else:
+                    content = None
+                if content is not None:
+                    if item.get('content_encoding') == 'gzip':
+                        content = _gzip_decompress(content)
+                    message = Message(self, item['url'], item['content_type'], content)
+                entries.append((item['url'], message))
+            except (ValueError, TypeError, KeyError, AttributeError, IOError):
+                raise FmtpFormatError('Expected a ndjson messagelist at %s.' % list_url)
+
+        next_url = None
+        match = re.search(r'<([^>]+)>\s*;\s*rel="?next"?', headers.get('link', headers.get('Link', '')))
+        if match:
+            next_url = match.group(1)
+        return entries, next_url
 
     def _fetch_message(self, url):
         """Erfragt eine Nachricht von der Queue, und gibt sie als Message zurück.
 
         Mögliche Exceptions: FmtpHttpError, FmtpFormatError
         """
-        status, headers, body = http.fetch(url, method='GET', credentials=self.credentials)
+        status, headers, body = http.fetch(url, method='GET', credentials=self.credentials,
+                                           headers={'Accept-Encoding': 'gzip'})
         if status != 200:
             raise FmtpHttpError('expected 200 when fetching %s, got %s' % (url, status))
+        self._note_server_encodings(headers)
 
+        # Sofern die HTTP-Bibliothek nicht schon entpackt hat, ist der Body noch gzip-komprimiert
+        if headers.get('content-encoding') == 'gzip' and body.startswith('\x1f\x8b'):
+            body = _gzip_decompress(body)
         return Message(self, url, headers['content-type'], body)
 
     def _acknowledge_message(self, url):
@@ -215,6 +512,11 @@ class Message(object):
         self.content_type = content_type
         self.content = content
 
+    @property
+    def guid(self):
+        """Die guid der Nachricht, das letzte Segment ihrer Url."""
+        return unquote(urlparse(self.url).path.rstrip('/').split('/')[-1])
+
     def acknowledge(self):
         """Bestätigt die verarbeitung der Nachricht, und löscht sie vom Server.
 
@@ -6,6 +6,7 @@ Created by Philipp Benjamin Köppchen on 2011-03-07.
 Copyright (c) 2010, 2011 HUDORA. All rights reserved.
 """
 
+import base64
 import unittest
 import fmtp_client
 import mock
@@ -78,6 +79,77 @@ class TestMessagePosting(unittest.TestCase):
                                                                                ignore_duplication_errors=True)
 
 
+class TestCompression(unittest.TestCase):
+    """Testet die gzip-Kompression von Nachrichten.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.queue = fmtp_client.Queue('http://example.com/chat/')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+        self.content = 'Hi Alice, ' * 200
+
+    def test_compresses_once_server_accepts_gzip(self):
+        """Große Nachrichten werden komprimiert, sobald der Server Accept-Encoding: gzip angezeigt hat."""
+        self.fetch.return_value = (201, {'accept-encoding': 'gzip'}, '')
+        self.queue.post_message('1', 'text/plain', self.content)
+        self.assertEquals(self.fetch.call_args[1]['content'], self.content)
+
+        self.queue.post_message('2', 'text/plain', self.content)
+        kwargs = self.fetch.call_args[1]
+        self.assertEquals(kwargs['headers'], {'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'})
+        self.assertEquals(fmtp_client._gzip_decompress(kwargs['content']), self.content)
+
+    def test_does_not_compress_small_messages(self):
+        """Kleine Nachrichten werden unkomprimiert gesendet."""
+        self.queue.server_accepts_gzip = True
+        self.fetch.return_value = (201, {}, '')
+        self.queue.post_message('1', 'text/plain', 'Hi Alice')
+        self.assertEquals(self.fetch.call_args[1]['headers'], {'Content-Type': 'text/plain'})
+
+    def test_decompresses_fetched_message(self):
+        """Komprimiert gelieferte Nachrichten werden entpackt."""
+        self.fetch.return_value = (200, {'content-type': 'text/plain', 'content-encoding': 'gzip'},
+                                   fmtp_client._gzip_compress(self.content))
+        message = self.queue._fetch_message('http://example.com/chat/1/')
+        self.assertEquals(message.content, self.content)
+        self.assertEquals(self.fetch.call_args[1]['headers'], {'Accept-Encoding': 'gzip'})
+
+
+class TestBatchPosting(unittest.TestCase):
+    """Testet das Posten mehrerer Nachrichten mit einem Request.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.queue = fmtp_client.Queue('http://example.com/chat/')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+
+    def test_successful_post_messages(self):
+        """post_messages sendet die Nachrichten als NDJSON an die Queue und liefert die Status zurück."""
+        self.fetch.return_value = (200, {}, '{"messages": [{"guid": "1", "status": 201},'
+                                            ' {"guid": "2", "status": 201}]}')
+
+        results = self.queue.post_messages([('1', 'text/plain', 'Hi Alice'), ('2', 'image/png', '\x89PNG')])
+
+        self.assertEquals(results, {'1': 201, '2': 201})
+        args, kwargs = self.fetch.call_args
+        self.assertEquals(args, ('http://example.com/chat/',))
+        self.assertEquals(kwargs['headers'], {'Content-Type': 'application/x-ndjson'})
+        self.assertEquals([fmtp_client.hujson.loads(line) for line in kwargs['content'].splitlines()], [
+            {'guid': '1', 'content_type': 'text/plain', 'body': 'Hi Alice'},
+            {'guid': '2', 'content_type': 'image/png', 'body_base64': 'iVBORw=='},
+        ])
+
+    def test_posting_duplicates(self):
+        """Dubletten führen zu FmtpMessageExists, sofern sie nicht ignoriert werden."""
+        self.fetch.return_value = (200, {}, '{"messages": [{"guid": "1", "status": 409}]}')
+        self.assertRaises(fmtp_client.FmtpMessageExists, self.queue.post_messages,
+                          [('1', 'text/plain', 'Do it again, sam')])
+        self.assertEquals(self.queue.post_messages([('1', 'text/plain', 'Do it again, sam')],
+                                                   ignore_duplication_errors=True), {'1': 409})
+
+
 class TestReceivingMessages(unittest.TestCase):
     """Testet das Abrufen einer Nachricht von einem FMTP-Queue.
 
@@ -113,3 +185,161 @@ class TestReceivingMessages(unittest.TestCase):
     def mock_fetch(self, *args, **kwargs):
         """Simulation von huTools.http.fetch"""
         return self.http_responses.pop(0)
+
+    def test_iteration_follows_next_url(self):
+        """Ist die Nachrichtenübersicht auf mehrere Seiten verteilt, werden alle Seiten abgerufen."""
+        self.http_responses = [
+            (200, {}, '{"messages": [{"url": "http://example.com/chat/1/"}],'
+                      ' "next_url": "http://example.com/chat/?cursor=abc"}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Alice'),
+            (200, {}, '{"messages": [{"url": "http://example.com/chat/2/"}]}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Bob'),
+        ]
+
+        messages = list(self.queue)
+
+        self.assertEquals([message.content for message in messages], ['Hi Alice', 'Hi Bob'])
+        self.assertEquals(self.http_responses, [])
+
+
+class TestRetryInterval(unittest.TestCase):
+    """Testet die Auswertung von Retry-Interval und Retry-After.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.queue = fmtp_client.Queue('http://example.com/chat/')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+
+    def test_remembers_retry_interval(self):
+        """Das Retry-Interval der letzten Liste steht in retry_interval."""
+        self.fetch.return_value = (200, {'x-fmtp-retry-interval': '1500'}, '{"messages": []}')
+        self.assertEquals(list(self.queue), [])
+        self.assertEquals(self.queue.retry_interval, 1500)
+
+    def test_raises_retry_later(self):
+        """Bei 429 wird FmtpRetryLater mit dem Retry-After des Servers geworfen."""
+        self.fetch.return_value = (429, {'retry-after': '12'}, '')
+        self.assertRaises(fmtp_client.FmtpRetryLater, list, self.queue)
+        try:
+            list(self.queue)
+        except fmtp_client.FmtpRetryLater, exception:
+            self.assertEquals(exception.retry_after, 12)
+
+
+class TestSubscription(unittest.TestCase):
+    """Testet das Abrufen der Nachrichten mehrerer Queues mit einer Liste.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.server = fmtp_client.Server('http://example.com/', credentials='victoria:secret')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+
+    def test_fetches_messages_of_all_queues(self):
+        """Die Nachrichten werden einzeln abgerufen und gehören zu ihrer Queue."""
+        self.fetch.side_effect = [
+            (200, {'x-fmtp-retry-interval': '500'},
+             '{"messages": [{"url": "http://example.com/a/1/", "queue": "a"},'
+             ' {"url": "http://example.com/b/2/", "queue": "b"}], "more": false}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Alice'),
+            (200, {'content-type': 'text/plain'}, 'Hi Bob'),
+        ]
+
+        messages = list(self.server.subscribe(['a', 'b']))
+
+        self.assertEquals([message.content for message in messages], ['Hi Alice', 'Hi Bob'])
+        self.assertEquals([message.queue.queue_url for message in messages],
+                          ['http://example.com/a/', 'http://example.com/b/'])
+        self.assertEquals(self.fetch.call_args_list[0][0][0],
+                          'http://example.com/_fmtp/subscription?queue=a&queue=b')
+        self.assertEquals(self.server.retry_interval, 500)
+
+    def test_refetches_while_more(self):
+        """Meldet der Server weitere Nachrichten, wird die Liste erneut abgerufen."""
+        self.fetch.side_effect = [
+            (200, {}, '{"messages": [{"url": "http://example.com/a/1/", "queue": "a"}], "more": true}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Alice'),
+            (200, {}, '{"messages": [{"url": "http://example.com/a/2/", "queue": "a"}], "more": false}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Bob'),
+        ]
+
+        messages = list(self.server.subscribe(prefix='a'))
+
+        self.assertEquals([message.guid for message in messages], ['1', '2'])
+
+    def test_sends_etag_of_empty_listing(self):
+        """Die ETag einer leeren Liste wird beim nächsten Abruf mitgeschickt, 304 liefert keine Nachrichten."""
+        self.fetch.side_effect = [
+            (200, {'etag': '"abc"'}, '{"messages": [], "more": false}'),
+            (304, {'x-fmtp-retry-interval': '2000'}, ''),
+        ]
+
+        self.assertEquals(list(self.server.subscribe(prefix='a')), [])
+        self.assertEquals(list(self.server.subscribe(prefix='a')), [])
+
+        self.assertEquals(self.fetch.call_args_list[1][1]['headers']['If-None-Match'], '"abc"')
+        self.assertEquals(self.server.retry_interval, 2000)
+
+
+class TestInlineListing(unittest.TestCase):
+    """Testet das Abrufen von Listen mit eingebetteten Bodies.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.queue = fmtp_client.Queue('http://example.com/chat/')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+
+    def test_uses_inline_listing_once_advertised(self):
+        """Zeigt der Server NDJSON-Listen an, werden eingebettete Nachrichten nicht einzeln abgerufen."""
+        self.fetch.side_effect = [
+            (200, {'x-fmtp-listing-formats': 'application/json, application/x-ndjson'},
+             '{"messages": [{"url": "http://example.com/chat/1/"}],'
+             ' "next_url": "http://example.com/chat/?cursor=abc"}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Alice'),
+            (200, {'link': '<http://example.com/chat/?cursor=def>; rel="next"'},
+             '{"url": "http://example.com/chat/2/", "content_type": "text/plain", "body": "Hi Bob"}\n'
+             '{"url": "http://example.com/chat/3/", "content_type": "application/octet-stream",'
+             ' "content_encoding": "gzip", "body_base64": "%s"}' % base64.b64encode(
+                 fmtp_client._gzip_compress('Hi Carol'))),
+            (200, {}, '{"url": "http://example.com/chat/4/", "content_type": "text/plain"}'),
+            (200, {'content-type': 'text/plain'}, 'Hi Dave'),
+        ]
+
+        messages = list(self.queue)
+
+        self.assertEquals([message.content for message in messages], ['Hi Alice', 'Hi Bob', 'Hi Carol', 'Hi Dave'])
+        self.assertEquals(messages[2].guid, '3')
+        self.assertEquals(self.fetch.call_args_list[2][1]['headers'], {'Accept': 'application/x-ndjson'})
+        self.assertEquals(self.fetch.call_args_list[3][0][0], 'http://example.com/chat/?cursor=def')
+        self.assertEquals(self.fetch.call_count, 5)
+
+
+class TestBatchAcknowledging(unittest.TestCase):
+    """Testet das Bestätigen mehrerer Nachrichten mit einem Request.
+
+    Http-Communikation wird dabei gemocked."""
+
+    def setUp(self):
+        self.queue = fmtp_client.Queue('http://example.com/chat/')
+        self.fetch = fmtp_client.http.fetch = mock.Mock()
+        self.messages = [fmtp_client.Message(self.queue, 'http://example.com/chat/%s/' % guid, 'text/plain', '')
+                         for guid in ['1', '2']]
+
+    def test_successful_acknowledge_messages(self):
+        """acknowledge_messages löscht die Nachrichten per DELETE auf die Queue."""
+        self.fetch.return_value = (200, {}, '{"messages": [{"guid": "1", "status": 204},'
+                                            ' {"guid": "2", "status": 204}]}')
+        self.queue.acknowledge_messages(self.messages)
+
+        args, kwargs = self.fetch.call_args
+        self.assertEquals(args, ('http://example.com/chat/',))
+        self.assertEquals(kwargs['method'], 'DELETE')
+        self.assertEquals(fmtp_client.hujson.loads(kwargs['content']), {'guids': ['1', '2']})
+
+    def test_acknowledging_deleted_messages(self):
+        """Bereits gelöschte Nachrichten führen zu FmtpMessageDeleted."""
+        self.fetch.return_value = (200, {}, '{"messages": [{"guid": "1", "status": 204},'
+                                            ' {"guid": "2", "status": 410}]}')
+        self.assertRaises(fmtp_client.FmtpMessageDeleted, self.queue.acknowledge_messages, self.messages)
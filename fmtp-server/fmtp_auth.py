@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/fmtp_auth.py
+
+Hilfen für Zugriffsprüfungen in den on_access-Events der Handler: Auslesen von HTTP-Basic-Credentials und
+ein Cache für die Ergebnisse der Prüfung, damit nicht bei jedem Abruf der Liste und jeder Nachricht der
+Benutzerspeicher befragt werden muss.
+
+    access_cache = AccessCache(max_size=10000, ttl=300, negative_ttl=30)
+
+    class MyQueueHandler(QueueHandler):
+        def on_access(self, message_queue_name):
+            if not access_cache.allowed(basic_credentials(self.request), message_queue_name, 'LIST',
+                                        check_user_store):
+                raise HTTP401_Unauthorized()
+
+check_user_store(credentials, message_queue_name, method) fragt den eigentlichen Benutzerspeicher und gibt
+True oder False zurück. Der Cache liegt im Speicher des Prozesses, revoke wirkt daher nur auf der eigenen
+Instanz; auf anderen Instanzen begrenzt ttl, wie lange ein entzogenes Recht noch gilt.
+
+Das Modul kommt ohne App Engine SDK aus.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+
+import base64
+import binascii
+import collections
+import hashlib
+import threading
+import time
+
+
+def basic_credentials(request):
+    """Gibt die HTTP-Basic-Credentials des Requests als (user, password) zurück, oder None."""
+    scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+    try:
+        user, separator, password = base64.b64decode(value.strip()).partition(':')
+    except (TypeError, binascii.Error):
+        return None
+    if not separator:
+        return None
+    return user, password
+
+
+class AccessCache(object):
+    """Begrenzter Cache für Ergebnisse von Zugriffsprüfungen, mit Ablaufzeit und Negativ-Caching.
+
+    Die Einträge sind nach (user, Hash des Passworts, queue, method) geschlüsselt, Passwörter werden also
+    nicht im Klartext gehalten und ein geändertes Passwort führt zu einer neuen Prüfung. Erlaubte Zugriffe
+    gelten ttl Sekunden, verweigerte negative_ttl Sekunden. Ist der Cache voll, wird der am längsten nicht
+    benutzte Eintrag verdrängt. Die Methoden sind threadsafe.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=30, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (allowed, expires_at)
+
+    @staticmethod
+    def make_key(credentials, message_queue_name, method):
+        """Gibt den Schlüssel für credentials ((user, password) oder None), Queue und Methode zurück.
+
+        method ist frei wählbar, z.B. die HTTP-Methode oder 'LIST' für die Nachrichtenliste.
+        """
+        if credentials is None:
+            return (None, None, message_queue_name, method)
+        user, password = credentials
+        return (user, hashlib.sha256(password).hexdigest(), message_queue_name, method)
+
+    def get(self, credentials, message_queue_name, method):
+        """Gibt das gecachte Ergebnis (True oder False) zurück, oder None, wenn keines vorliegt."""
+        key = self.make_key(credentials, message_queue_name, method)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= self.clock():
+                return None
+            self.entries[key] = entry  # als zuletzt benutzt einordnen
+            return entry[0]
+
+    def set(self, credentials, message_queue_name, method, allowed):
+        """Legt das Ergebnis einer Prüfung ab."""
+        key = self.make_key(credentials, message_queue_name, method)
+        expires_at = self.clock() + (self.ttl if allowed else self.negative_ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (bool(allowed), expires_at)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def allowed(self, credentials, message_queue_name, method, check):
+        """Gibt zurück, ob der Zugriff erlaubt ist, und fragt dazu nur ohne gecachtes Ergebnis
+        check(credentials, message_queue_name, method). Exceptions von check werden nicht gecached."""
+        allowed = self.get(credentials, message_queue_name, method)
+        if allowed is None:
+            allowed = bool(check(credentials, message_queue_name, method))
+            self.set(credentials, message_queue_name, method, allowed)
+        return allowed
+
+    def revoke(self, user=None, message_queue_name=None):
+        """Verwirft die Einträge des Benutzers und/oder der Queue, ohne Angaben alle Einträge.
+
+        Gibt die Zahl der verworfenen Einträge zurück.
+        """
+        with self.lock:
+            keys = [key for key in self.entries
+                    if (user is None or key[0] == user)
+                    and (message_queue_name is None or key[2] == message_queue_name)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/fmtp_metrics.py
+
+Messwerte des FMTP-Servers: Zähler und Histogramme, die die Handler in fmtp_server füllen und der
+MetricsHandler im Prometheus-Textformat oder als JSON ausliefert.
+
+Die Messwerte liegen im Speicher des Prozesses. Auf App Engine meldet daher jede Instanz ihre eigenen
+Werte, mit dem Neustart einer Instanz beginnen sie von vorn. Das Modul kommt ohne App Engine SDK aus.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+
+import collections
+import threading
+import time
+
+
+# Grenzen der Histogramme für Zeiten in Sekunden
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Grenzen der Histogramme für Anzahlen, z.B. Nachrichten je Liste
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+# Datastore-Aufrufe, die als Lese- bzw. Schreibzugriff gezählt werden. Alle anderen zählen als 'other'.
+DATASTORE_READS = ('Get', 'RunQuery', 'Next')
+DATASTORE_WRITES = ('Put', 'Delete', 'Commit')
+
+
+def _format_value(value):
+    """Formatiert eine Zahl für das Prometheus-Textformat."""
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    """Formatiert Labels, gegeben als sortierte Liste von Paaren, für das Prometheus-Textformat."""
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(escaped)
+
+
+class Metrics(object):
+    """Sammlung von Zählern, Histogrammen und Profilen einzelner Requests.
+
+    Zähler und Histogramme werden über ihren Namen und ihre Labels (Keyword-Argumente) angesprochen und bei
+    der ersten Benutzung angelegt. Die Methoden sind threadsafe.
+
+    Je Name werden höchstens max_series Kombinationen von Labels geführt, weitere Kombinationen werden mit
+    dem Wert OTHER für alle Labels zusammengefasst. So wächst der Speicher auch dann nicht unbegrenzt, wenn
+    Labels aus Requests stammen.
+    """
+
+    # Anzahl der Profile, die höchstens aufbewahrt werden. Ältere werden verworfen.
+    max_profiles = 20
+
+    # Anzahl der Kombinationen von Labels, die je Zähler bzw. Histogramm höchstens geführt werden
+    max_series = 1000
+
+    # Wert der Labels, unter dem Kombinationen über max_series zusammengefasst werden
+    OTHER = '_other'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Verwirft alle Messwerte."""
+        with self.lock:
+            self.started_at = time.time()
+            self.counters = {}
+            self.histograms = {}
+            self.series = {}  # Name -> Anzahl der Kombinationen von Labels
+            self.profiles = collections.deque(maxlen=self.max_profiles)
+
+    def _key(self, values, name, labels):
+        """Gibt den Schlüssel für name und labels in values zurück, siehe max_series. Muss unter lock laufen."""
+        key = (name, tuple(sorted(labels.items())))
+        if key not in values:
+            if self.series.get(name, 0) >= self.max_series:
+                key = (name, tuple((label, self.OTHER) for label, _value in key[1]))
+            if key not in values:
+                self.series[name] = self.series.get(name, 0) + 1
+        return key
+
+    def incr(self, name, value=1, **labels):
+        """Erhöht den Zähler name mit den gegebenen Labels um value."""
+        with self.lock:
+            key = self._key(self.counters, name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Trägt value in das Histogramm name mit den gegebenen Labels ein.
+
+        buckets sind die oberen Grenzen der Klassen, sie gelten ab dem ersten Eintrag in das Histogramm.
+        """
+        with self.lock:
+            key = self._key(self.histograms, name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': tuple(buckets), 'counts': [0] * len(buckets),
+                                                    'sum': 0, 'count': 0}
+            for index, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def start_request(self):
+        """Beginnt die Zählung der Datastore-Aufrufe des laufenden Requests (siehe count_rpc)."""
+        self.local.rpcs = {}
+
+    def finish_request(self):
+        """Beendet die Zählung und gibt die Datastore-Aufrufe des Requests als dict call -> Anzahl zurück."""
+        rpcs = getattr(self.local, 'rpcs', None) or {}
+        self.local.rpcs = None
+        return rpcs
+
+    def count_rpc(self, call):
+        """Zählt einen Datastore-Aufruf, sowohl insgesamt als auch für den laufenden Request."""
+        if call in DATASTORE_READS:
+            kind = 'read'
+        elif call in DATASTORE_WRITES:
+            kind = 'write'
+        else:
+            kind = 'other'
+        self.incr('fmtp_datastore_rpcs_total', call=call, kind=kind)
+        rpcs = getattr(self.local, 'rpcs', None)
+        if rpcs is not None:
+            rpcs[call] = rpcs.get(call, 0) + 1
+
+    def add_profile(self, profile):
+        """Bewahrt das Profil eines Requests auf (ein dict, siehe MetricsMixin in fmtp_server)."""
+        with self.lock:
+            self.profiles.append(profile)
+
+    def as_dict(self):
+        """Gibt alle Messwerte als dict für die JSON-Ausgabe zurück. Histogramme sind kumulativ."""
+        counters = {}
+        histograms = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                buckets, total = [], 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    total += count
+                    buckets.append([bound, total])
+                histograms.setdefault(name, []).append({'labels': dict(labels), 'buckets': buckets,
+                                                        'sum': histogram['sum'], 'count': histogram['count']})
+            profiles = list(self.profiles)
+        return {'uptime': time.time() - self.started_at, 'counters': counters, 'histograms': histograms,
+                'profiles': profiles}
+
+    def as_prometheus(self):
+        """Gibt Zähler und Histogramme im Prometheus-Textformat (Version 0.0.4) zurück."""
+        lines = []
+        with self.lock:
+            name = None
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name != name:
+                    name = counter_name
+                    lines.append('# TYPE %s counter' % name)
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+            name = None
+            for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    name = histogram_name
+                    lines.append('# TYPE %s histogram' % name)
+                total = 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', bound),)), total))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', '+Inf'),)),
+                                                 histogram['count']))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(histogram['sum'])))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+# Die Messwerte des Prozesses, in die die Handler aus fmtp_server schreiben
+metrics = Metrics()
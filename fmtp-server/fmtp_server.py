@@ -7,26 +7,120 @@ Created by Maximillian Dornseif on 2010-11-16.
 Copyright (c) 2010 HUDORA. All rights reserved.
 """
 
+from cStringIO import StringIO
 from datetime import datetime, timedelta
+import base64
+import cProfile
+import gzip
+import hashlib
+import logging
+import pickle
+import pstats
+import random
 import re
+import time
+import urllib
+import uuid
+import zlib
 
 from huTools import hujson as json
 from huTools.structured import dict2xml
 from huTools.http.tools import quote
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from gaetk.handler import BasicHandler, JsonResponseHandler
-from gaetk.handler import HTTP404_NotFound, HTTP401_Unauthorized, HTTP403_Forbidden, HTTP410_Gone, HTTP409_Conflict
+from gaetk.handler import HTTP400_BadRequest, HTTP404_NotFound, HTTP401_Unauthorized, HTTP403_Forbidden
+from gaetk.handler import HTTP410_Gone, HTTP409_Conflict
+
+from fmtp_auth import basic_credentials
+from fmtp_metrics import COUNT_BUCKETS, metrics
+from fmtp_storage import InvalidCursor, Storage
+
+# Nachrichtenbodies bis zu dieser Größe (in Bytes) werden im memcache gehalten.
+# Größere Bodies werden bei Bedarf aus dem Datastore gelesen.
+MAX_CACHED_BODY_SIZE = 32 * 1024
+
+# Zeit in Sekunden, nach der Nachrichten spätestens aus dem memcache verdrängt werden.
+MESSAGE_CACHE_TIME = 60 * 60
+
+# Zeit in Sekunden, die eine gerenderte Nachrichtenliste höchstens im memcache gehalten wird. Eine Änderung
+# der Queue macht sie ohnehin ungültig, siehe QueueHandler._get_listing.
+LISTING_CACHE_TIME = 10 * 60
+
+# Zeit in Sekunden, die die Namen der Queues für Abonnements per Präfix gecached werden. Neue Queues
+# erscheinen also mit dieser Verzögerung, siehe SubscriptionHandler.
+QUEUE_NAMES_CACHE_TIME = 60
+
+# Zeit in Sekunden, nach der eine Änderung spätestens in den Ergebnissen von Queries sichtbar ist.
+QUERY_CONSISTENCY_DELAY = 5
+
+# Bodies werden in Stücken dieser Größe (in Bytes) als MessageChunk gespeichert.
+CHUNK_SIZE = 256 * 1024
+
+# Anzahl MessageChunks, die mit einem Datastore-Aufruf geschrieben werden.
+CHUNKS_PER_PUT = 16
+
+# Anzahl Seiten der Nachrichtenliste, die beim Leasen höchstens nach freien Nachrichten durchsucht werden.
+LEASE_SCAN_PAGES = 5
+
+# Minimale Zeit in Tagen, die gelöschte Nachrichten aufbewahrt werden, bevor die GarbageCollection sie
+# entfernen darf.
+RETENTION_PERIOD_DAYS = 7
+
+# Anzahl Nachrichten, die die GarbageCollection auf einmal löscht und danach ihren Fortschritt speichert.
+GC_BATCH_SIZE = 100
+
+# Zeit in Sekunden, nach der ein GarbageCollection-Task aufhört und in einem neuen Task weitermacht.
+GC_TIME_LIMIT = 60
+
+# Zeit in Sekunden, nach der eine GarbageCollection ohne Fortschritt als abgebrochen gilt und beim nächsten
+# Start ab dem letzten Stand fortgesetzt wird.
+GC_STALE_TIME = 10 * 60
+
+# Name der Pull-Queue (siehe queue.yaml), in der NdbStorage zurückgestellte Events hält
+EVENT_QUEUE_NAME = 'fmtp-events'
+
+# Anzahl Shards der Zähler je Queue (siehe QueueCounterShard). Mehr Shards erlauben mehr gleichzeitige
+# Transaktionen auf einer Queue, machen das Lesen der Zähler aber teurer.
+COUNTER_SHARDS = 20
 
 
 class Message(ndb.Model):
-    """Repräsentiert eine FMTP-Nachricht."""
+    """Repräsentiert die Metadaten einer FMTP-Nachricht.
+
+    Nachrichten werden unter dem Key `<message_queue_name>/<guid>` gespeichert (siehe `make_key`),
+    so dass sie ohne Query gefunden werden können. Der Body liegt in MessageChunks, so dass Queries und
+    Lookups der Metadaten nie den Inhalt der Nachricht laden.
+
+    Beim Löschen wird der Body entfernt. Bis zur GarbageCollection bleibt die Nachricht als Tombstone
+    ohne Body erhalten, damit erneutes Einstellen mit 410 beantwortet werden kann.
+    """
     guid = ndb.StringProperty(required=True)
     message_queue_name = ndb.StringProperty(required=True)
     content_type = ndb.StringProperty(required=True)
-    body = ndb.BlobProperty(required=True)
+    body = ndb.BlobProperty()  # nur bei Nachrichten, die vor Einführung von MessageChunk gespeichert wurden
+    chunks = ndb.KeyProperty(kind='MessageChunk', repeated=True, indexed=False)
+    content_encoding = ndb.StringProperty(indexed=False)  # 'gzip', wenn der Body komprimiert gespeichert ist
+    content_hash = ndb.StringProperty(indexed=False)  # SHA-1 des gespeicherten Bodys, bleibt nach dem Löschen
+    size = ndb.IntegerProperty(indexed=False)  # Größe des gespeicherten Bodys in Bytes
     deleted_at = ndb.DateTimeProperty()  # None, wenn die Nachricht nicht gelöscht wurde, sonst das datum der Löschung.
+    leased_until = ndb.DateTimeProperty(indexed=False)  # bis dahin für andere Clients unsichtbar, siehe lease
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    # Das Caching übernehmen get_message() und cache_messages(), ndb soll Nachrichten nicht zusätzlich
+    # im memcache ablegen.
+    _use_memcache = False
+
+    @classmethod
+    def make_key(cls, message_queue_name, guid):
+        """Gibt den Datastore-Key der Nachricht mit der guid in der gegebenen Queue zurück."""
+        return ndb.Key(cls, '%s/%s' % (message_queue_name, guid))
+
     def __unicode__(self):
         """Repräsentation als Unicode-Objekt"""
         return u'%s/%s' % (self.message_queue_name, self.guid)
@@ -36,19 +130,1010 @@ class Message(ndb.Model):
         return self.to_dict(exclude=['body'])
 
 
-class QueueHandler(BasicHandler):
-    """Handler für FMTP-Nachrichtenlisten, gemäss README/Listenformate.
+class QueueCounterShard(ndb.Model):
+    """Ein Shard der Zähler einer Queue, siehe NdbStorage.queue_stats.
 
-    Der Handler kümmert sich um die Auflistung der Nachrichten in einer Queue in verschiedenen Formaten (GET),
-    und um Garbage Collection (DELETE).
+    Die Zähler werden in den Transaktionen fortgeschrieben, die Nachrichten erstellen oder löschen. Jede
+    Transaktion ändert einen von COUNTER_SHARDS Shards, damit gleichzeitige Transaktionen auf derselben Queue
+    nicht an einer Entity kollidieren, die Stapel einer Anfrage verteilt batch_keys reihum. Der Stand ergibt
+    sich aus der Summe aller Shards.
+    """
+    message_queue_name = ndb.StringProperty(required=True)
+    live = ndb.IntegerProperty(default=0, indexed=False)  # nicht gelöschte Nachrichten
+    deleted = ndb.IntegerProperty(default=0, indexed=False)  # Tombstones
+    bytes = ndb.IntegerProperty(default=0, indexed=False)  # Größe der Bodies nicht gelöschter Nachrichten
 
-    Dieser Handler ist als Basisklasse vorgesehen, in dessen Erben zur Anpassung
+    @classmethod
+    def make_keys(cls, message_queue_name):
+        """Gibt die Keys aller Shards der Queue zurück."""
+        return [ndb.Key(cls, '%s:%d' % (message_queue_name, index)) for index in range(COUNTER_SHARDS)]
 
-     * (min/max)_retry_interval,
-     * max_messages, und
-     * on_access
+    @classmethod
+    def random_key(cls, message_queue_name):
+        """Gibt den Key eines zufälligen Shards der Queue zurück."""
+        return ndb.Key(cls, '%s:%d' % (message_queue_name, random.randrange(COUNTER_SHARDS)))
 
-    überschrieben werden können (siehe dort zur wozu).
+    @classmethod
+    def batch_keys(cls, message_queue_name, count):
+        """Gibt die Keys von count verschiedenen Shards der Queue zurück, reihum ab einem zufälligen Shard.
+
+        count darf höchstens COUNTER_SHARDS sein.
+        """
+        offset = random.randrange(COUNTER_SHARDS)
+        return [ndb.Key(cls, '%s:%d' % (message_queue_name, (offset + index) % COUNTER_SHARDS))
+                for index in range(count)]
+
+    def add(self, live=0, deleted=0, bytes=0):
+        """Ändert die Zähler um die gegebenen Werte."""
+        self.live = (self.live or 0) + live
+        self.deleted = (self.deleted or 0) + deleted
+        self.bytes = (self.bytes or 0) + bytes
+
+
+def _stored_size(message):
+    """Gibt die Größe des gespeicherten Bodys zurück. Alten Nachrichten ohne size fehlt sie bei Chunks."""
+    if message.size is not None:
+        return message.size
+    return len(message.body or '')
+
+
+@ndb.transactional_tasklet
+def _add_to_counters(message_queue_name, **changes):
+    """Ändert in einer eigenen Transaktion einen Shard der Zähler der Queue, siehe QueueCounterShard.add."""
+    key = QueueCounterShard.random_key(message_queue_name)
+    shard = yield key.get_async()
+    shard = shard or QueueCounterShard(key=key, message_queue_name=message_queue_name)
+    shard.add(**changes)
+    yield shard.put_async()
+
+
+class MessageChunk(ndb.Model):
+    """Ein Stück des Bodys einer Nachricht, siehe CHUNK_SIZE.
+
+    Chunks sind Kinder ihrer Nachricht. Die Nachricht listet ihre Chunks in der richtigen Reihenfolge.
+    """
+    data = ndb.BlobProperty(required=True)
+
+    # Chunks werden nur gestreamt, nicht gecached
+    _use_memcache = False
+
+
+class GarbageCollection(ndb.Model):
+    """Fortschritt der GarbageCollection einer Queue, siehe start_garbage_collection.
+
+    Die ID ist der Name der Queue, so dass es je Queue nur eine GarbageCollection gibt.
+    """
+    delete_before = ndb.DateTimeProperty(required=True)  # nur vorher gelöschte Nachrichten werden entfernt
+    expire_before = ndb.DateTimeProperty(indexed=False)  # vorher erstellte Nachrichten werden gelöscht
+    expire_done = ndb.BooleanProperty(default=False, indexed=False)  # alle abgelaufenen sind markiert
+    run_id = ndb.StringProperty(indexed=False)  # nur der Task mit dieser ID darf weiterarbeiten
+    cursor = ndb.StringProperty(indexed=False)  # Position nach dem letzten gelöschten Stapel
+    deleted = ndb.IntegerProperty(default=0, indexed=False)
+    expired = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    started_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def as_dict(self):
+        """Repräsentation als dict"""
+        return {
+            'status': 'done' if self.done else 'running',
+            'deleted': self.deleted,
+            'delete_before': self.delete_before,
+            'expired': self.expired,
+            'expire_before': self.expire_before,
+            'started_at': self.started_at,
+            'updated_at': self.updated_at,
+        }
+
+
+def split_body(message_key, body):
+    """Gibt die noch nicht gespeicherten MessageChunks zurück, in denen body gespeichert wird.
+
+    Die Keys der Chunks sind je Aufruf eindeutig, so dass konkurrierende Uploads derselben guid sich
+    nicht gegenseitig überschreiben.
+    """
+    upload_id = uuid.uuid4().hex
+    return [MessageChunk(key=ndb.Key(MessageChunk, '%s-%d' % (upload_id, index), parent=message_key),
+                         data=body[start:start + CHUNK_SIZE])
+            for index, start in enumerate(range(0, len(body), CHUNK_SIZE))]
+
+
+def iter_body(message):
+    """Liefert den gespeicherten Body der Nachricht Stück für Stück.
+
+    Kleine Bodies kommen aus dem memcache, bei großen wird immer nur ein Chunk im voraus gelesen. Das Lesen
+    beginnt schon beim Aufruf, nicht erst beim Iterieren, und überlappt so z.B. mit on_access.
+    """
+    if message.body is not None:
+        return iter([message.body])
+    if not message.chunks:
+        return iter([])
+    if len(message.chunks) == 1:
+        return _iter_cached_chunk(message, ndb.get_context().memcache_get(_body_cache_key(message.key)))
+    return _iter_chunks(message.chunks, message.chunks[0].get_async())
+
+
+def _iter_cached_chunk(message, cached):
+    """Liefert den Body aus dem einzigen Chunk der Nachricht. cached ist der Future des memcache-Abrufs."""
+    body = cached.get_result()
+    if body is None:
+        body = message.chunks[0].get().data
+        if len(body) <= MAX_CACHED_BODY_SIZE:
+            memcache.add(_body_cache_key(message.key), body, time=MESSAGE_CACHE_TIME)
+    yield body
+
+
+def _iter_chunks(keys, future):
+    """Liefert die Daten der Chunks unter keys. future ist der bereits gestartete Abruf des ersten Chunks."""
+    for next_key in keys[1:] + [None]:
+        chunk = future.get_result()
+        if next_key:
+            future = next_key.get_async()
+        yield chunk.data
+
+
+def gzip_decompress_iter(parts):
+    """Entpackt einen gzip-komprimierten Datenstrom, der als Iterable von Stücken vorliegt."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for part in parts:
+        yield decompressor.decompress(part)
+    yield decompressor.flush()
+
+
+def gzip_compress(data):
+    """Komprimiert data im gzip-Format."""
+    buf = StringIO()
+    fileobj = gzip.GzipFile(fileobj=buf, mode='wb')
+    fileobj.write(data)
+    fileobj.close()
+    return buf.getvalue()
+
+
+def gzip_decompress(data):
+    """Entpackt gzip-komprimierte data."""
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+def _cache_key(message_queue_name, guid):
+    """Gibt den memcache-Key zurück, unter dem die Metadaten einer Nachricht gecached werden."""
+    return 'fmtp_message:%s/%s' % (message_queue_name, guid)
+
+
+def _body_cache_key(message_key):
+    """Gibt den memcache-Key zurück, unter dem der Body einer Nachricht gecached wird."""
+    return 'fmtp_body:%s' % message_key.id()
+
+
+def _cache_entry(message):
+    """Gibt die Metadaten der Nachricht als dict für den memcache zurück.
+
+    Alte Nachrichten mit Body in der Nachricht selbst werden nur gecached, wenn der Body klein genug ist.
+    """
+    if message.body is not None and len(message.body) > MAX_CACHED_BODY_SIZE:
+        return None
+    return message.to_dict()
+
+
+def cache_messages(messages):
+    """Schreibt die Metadaten der Nachrichten in den memcache.
+
+    Muss nach jeder Änderung einer Nachricht aufgerufen werden, damit der memcache nicht veraltet.
+    """
+    entries = dict((_cache_key(msg.message_queue_name, msg.guid), _cache_entry(msg)) for msg in messages)
+    memcache.set_multi(dict((key, entry) for key, entry in entries.items() if entry is not None),
+                       time=MESSAGE_CACHE_TIME)
+    memcache.delete_multi([key for key, entry in entries.items() if entry is None])
+
+
+def cache_bodies(messages_and_chunks):
+    """Schreibt die Bodies frisch gespeicherter Nachrichten in den memcache, sofern sie klein genug sind.
+
+    messages_and_chunks ist eine Liste von (message, chunks), siehe insert_messages.
+    """
+    memcache.set_multi(dict((_body_cache_key(message.key), chunks[0].data)
+                            for message, chunks in messages_and_chunks
+                            if len(chunks) == 1 and len(chunks[0].data) <= MAX_CACHED_BODY_SIZE),
+                       time=MESSAGE_CACHE_TIME)
+
+
+def get_message(message_queue_name, guid):
+    """Gibt die message_queue_name und guid entsprechene Nachricht zurück, oder None, wenn keine solche
+    existiert.
+
+    Die Nachricht wird bevorzugt aus dem memcache gelesen, sonst per Key aus dem Datastore. Den Body
+    liefert iter_body().
+    """
+    entry = memcache.get(_cache_key(message_queue_name, guid))
+    if entry is not None:
+        return Message(key=Message.make_key(message_queue_name, guid), **entry)
+
+    message = Message.make_key(message_queue_name, guid).get()
+    if message and _cache_entry(message) is not None:
+        # add statt set: wurde die Nachricht inzwischen geändert, gewinnt der Eintrag von cache_messages()
+        memcache.add(_cache_key(message_queue_name, guid), _cache_entry(message), time=MESSAGE_CACHE_TIME)
+    return message
+
+
+def get_messages(message_queue_name, guids):
+    """Wie get_message für mehrere guids, mit einem memcache- und einem Datastore-Batch.
+
+    Gibt die Nachrichten (bzw. None) in der Reihenfolge der guids zurück.
+    """
+    cache_keys = [_cache_key(message_queue_name, guid) for guid in guids]
+    entries = memcache.get_multi(cache_keys)
+    missing = [guid for guid, cache_key in zip(guids, cache_keys) if cache_key not in entries]
+    futures = ndb.get_multi_async([Message.make_key(message_queue_name, guid) for guid in missing])
+    found = dict((guid, future.get_result()) for guid, future in zip(missing, futures))
+    # add statt set, siehe get_message
+    memcache.add_multi(dict((_cache_key(message_queue_name, guid), _cache_entry(message))
+                            for guid, message in found.items()
+                            if message and _cache_entry(message) is not None), time=MESSAGE_CACHE_TIME)
+    return [Message(key=Message.make_key(message_queue_name, guid), **entries[cache_key])
+            if cache_key in entries else found[guid]
+            for guid, cache_key in zip(guids, cache_keys)]
+
+
+def _queue_version_key(message_queue_name):
+    """Gibt den memcache-Key zurück, unter dem die Version einer Queue gespeichert wird."""
+    return 'fmtp_queue_version:%s' % message_queue_name
+
+
+def _queue_changed_key(message_queue_name):
+    """Gibt den memcache-Key zurück, unter dem der Zeitpunkt der letzten Änderung einer Queue steht."""
+    return 'fmtp_queue_changed:%s' % message_queue_name
+
+
+def _queue_leased_key(message_queue_name):
+    """Gibt den memcache-Key zurück, unter dem das Ende der spätesten Lease in einer Queue steht."""
+    return 'fmtp_queue_leased:%s' % message_queue_name
+
+
+def _initial_queue_version():
+    """Startwert der Version einer Queue.
+
+    Zeitbasiert, damit eine nach Verdrängung aus dem memcache neu begonnene Version keine früher
+    vergebene wiederholt.
+    """
+    return int(time.time() * 1000)
+
+
+def get_queue_version(message_queue_name):
+    """Gibt die aktuelle Version der Queue als Tupel (Zähler, stabil) zurück.
+
+    Die Version ändert sich bei jeder Erstellung und Löschung einer Nachricht in der Queue (siehe
+    touch_queue) und erlaubt so, Änderungen ohne Datastore-Query zu erkennen.
+
+    Queries sind nur eventually consistent und sehen eine Änderung möglicherweise erst nach einigen
+    Sekunden. Solange die letzte Änderung jünger als QUERY_CONSISTENCY_DELAY ist, ist `stabil` daher
+    False, und aus Queries erstellte Ergebnisse dürfen nicht gecached werden. Der Übergang zu stabil
+    ändert die Version ebenfalls.
+
+    Solange Nachrichten der Queue geleast sind (siehe lease_messages), kann der Ablauf einer Lease die
+    Liste ändern, ohne dass die Queue angefasst wird. Die Version ändert sich dann jede Sekunde und ist
+    nicht stabil.
+    """
+    version_key = _queue_version_key(message_queue_name)
+    changed_key = _queue_changed_key(message_queue_name)
+    leased_key = _queue_leased_key(message_queue_name)
+    values = memcache.get_multi([version_key, changed_key, leased_key])
+    if version_key not in values:
+        memcache.add(version_key, _initial_queue_version())
+        values = memcache.get_multi([version_key, changed_key, leased_key])
+    if version_key not in values:
+        # memcache nicht verfügbar: jede Abfrage sieht eine neue Version
+        return (_initial_queue_version(), False)
+    now = time.time()
+    if values.get(leased_key, 0) > now:
+        return ((values[version_key], int(now)), False)
+    return (values[version_key], now - values.get(changed_key, 0) >= QUERY_CONSISTENCY_DELAY)
+
+
+def touch_queue(message_queue_name):
+    """Ändert die Version der Queue.
+
+    Muss nach jeder Erstellung und Löschung von Nachrichten aufgerufen werden, weckt u.a. wartende
+    Anfragen (siehe QueueHandler.get).
+    """
+    memcache.set(_queue_changed_key(message_queue_name), time.time())
+    memcache.incr(_queue_version_key(message_queue_name), initial_value=_initial_queue_version())
+
+
+# Anzahl Nachrichten, die bei Stapelverarbeitung in einer Transaktion geschrieben werden. Jede Nachricht
+# ist eine eigene Entity-Group, Cross-Group-Transaktionen sind auf 25 Entity-Groups beschränkt. Eine davon
+# braucht der Shard der Zähler (siehe QueueCounterShard).
+BATCH_SIZE = 24
+
+# Anzahl Transaktionen einer Anfrage, die gleichzeitig laufen. Jede schreibt einen anderen Shard der Zähler
+# (siehe run_batches), höchstens COUNTER_SHARDS.
+PARALLEL_BATCHES = 10
+
+
+def run_batches(message_queue_name, items, func):
+    """Teilt items in Stapel von je BATCH_SIZE und ruft für jeden Stapel func(batch, shard_key) auf, das
+    einen Future liefern muss. Gibt die Ergebnisse in der Reihenfolge der Stapel zurück.
+
+    Es laufen höchstens PARALLEL_BATCHES Transaktionen gleichzeitig, jede mit einem eigenen Shard der Zähler
+    (siehe QueueCounterShard.batch_keys), so dass die Stapel einer Anfrage nicht miteinander kollidieren.
+    """
+    batches = [items[start:start + BATCH_SIZE] for start in range(0, len(items), BATCH_SIZE)]
+    shard_keys = QueueCounterShard.batch_keys(message_queue_name, PARALLEL_BATCHES)
+    results = []
+    for start in range(0, len(batches), PARALLEL_BATCHES):
+        futures = [func(batch, shard_key)
+                   for batch, shard_key in zip(batches[start:start + PARALLEL_BATCHES], shard_keys)]
+        results.extend(future.get_result() for future in futures)
+    return results
+
+
+def _put_chunks_async(chunks):
+    """Schreibt chunks in parallelen RPCs von je CHUNKS_PER_PUT Chunks. Gibt die Futures zurück."""
+    futures = []
+    for start in range(0, len(chunks), CHUNKS_PER_PUT):
+        futures.extend(ndb.put_multi_async(chunks[start:start + CHUNKS_PER_PUT]))
+    return futures
+
+
+def _delete_keys_async(keys):
+    """Löscht die Entities unter keys in parallelen RPCs von je CHUNKS_PER_PUT Keys. Gibt die Futures zurück."""
+    futures = []
+    for start in range(0, len(keys), CHUNKS_PER_PUT):
+        futures.extend(ndb.delete_multi_async(keys[start:start + CHUNKS_PER_PUT]))
+    return futures
+
+
+@ndb.transactional_tasklet(xg=True)
+def _insert_messages_async(messages, chunks, shard_key=None):
+    """Speichert die Nachrichten und die zugehörigen chunks, sofern unter ihren Keys noch keine Nachricht
+    existiert, und zählt sie im Shard shard_key (oder einem zufälligen Shard) der Zähler ihrer Queue.
+
+    Alle Nachrichten müssen in derselben Queue liegen. Liefert zu jeder Nachricht die bereits existierende
+    Nachricht oder None.
+    """
+    message_queue_name = messages[0].message_queue_name
+    shard_key = shard_key or QueueCounterShard.random_key(message_queue_name)
+    entities = yield ndb.get_multi_async([message.key for message in messages] + [shard_key])
+    existing, shard = entities[:-1], entities[-1]
+    created = [message for message, found in zip(messages, existing) if found is None]
+    if created:
+        created_keys = set(message.key for message in created)
+        shard = shard or QueueCounterShard(key=shard_key, message_queue_name=message_queue_name)
+        shard.add(live=len(created), bytes=sum(_stored_size(message) for message in created))
+        yield ndb.put_multi_async(created + [shard] +
+                                  [chunk for chunk in chunks if chunk.key.parent() in created_keys])
+    raise ndb.Return(existing)
+
+
+@ndb.tasklet
+def insert_messages_async(messages_and_chunks, shard_key=None):
+    """Speichert Nachrichten samt ihrer Chunks, sofern unter ihren Keys noch keine Nachricht existiert.
+
+    messages_and_chunks ist eine Liste von (message, chunks), höchstens BATCH_SIZE lang. Gezählt wird im
+    Shard shard_key, siehe _insert_messages_async.
+    Bodies aus einem Chunk werden in derselben Transaktion wie die Nachricht geschrieben. Größere Bodies
+    werden vor der Transaktion geschrieben und wieder gelöscht, wenn die Nachricht schon existiert.
+    Liefert zu jeder Nachricht die bereits existierende Nachricht oder None.
+    """
+    large = [chunks for _message, chunks in messages_and_chunks if len(chunks) > 1]
+    futures = _put_chunks_async([chunk for chunks in large for chunk in chunks])
+    if futures:
+        yield futures
+
+    existing = yield _insert_messages_async(
+        [message for message, _chunks in messages_and_chunks],
+        [chunks[0] for _message, chunks in messages_and_chunks if len(chunks) == 1], shard_key)
+    orphans = [chunk.key for (_message, chunks), found in zip(messages_and_chunks, existing)
+               if found is not None and len(chunks) > 1 for chunk in chunks]
+    if orphans:
+        yield _delete_keys_async(orphans)
+    raise ndb.Return(existing)
+
+
+def insert_messages(messages_and_chunks):
+    """Wie insert_messages_async, wartet aber auf das Ergebnis."""
+    return insert_messages_async(messages_and_chunks).get_result()
+
+
+@ndb.transactional_tasklet(xg=True)
+def _mark_messages_deleted_async(message_queue_name, keys, deleted_at, shard_key=None):
+    """Markiert die Nachrichten mit den gegebenen Keys als gelöscht und macht sie zu Tombstones ohne Body.
+
+    Die Zähler der Queue werden in derselben Transaktion im Shard shard_key (oder einem zufälligen Shard)
+    fortgeschrieben. Liefert zu jedem Key den HTTP-Status
+    (204, 404 oder 410, siehe MessageHandler.delete) und die Nachricht bzw. None, sowie die Keys der nicht
+    mehr benötigten Chunks.
+    """
+    results = []
+    changed = []
+    chunk_keys = []
+    shard_key = shard_key or QueueCounterShard.random_key(message_queue_name)
+    entities = yield ndb.get_multi_async(list(keys) + [shard_key])
+    messages, shard = entities[:-1], entities[-1]
+    size = 0
+    for message in messages:
+        if message is None:
+            results.append((404, None))
+        elif message.deleted_at:
+            results.append((410, message))
+        else:
+            size += _stored_size(message)
+            message.deleted_at = deleted_at
+            message.body = None
+            chunk_keys.extend(message.chunks)
+            message.chunks = []
+            changed.append(message)
+            results.append((204, message))
+    if changed:
+        shard = shard or QueueCounterShard(key=shard_key, message_queue_name=message_queue_name)
+        shard.add(live=-len(changed), deleted=len(changed), bytes=-size)
+        yield ndb.put_multi_async(changed + [shard])
+    raise ndb.Return((results, chunk_keys))
+
+
+def mark_messages_deleted(message_queue_name, keys, deleted_at):
+    """Markiert die Nachrichten mit den gegebenen Keys in Transaktionen von je BATCH_SIZE Nachrichten als
+    gelöscht, siehe _mark_messages_deleted.
+
+    Die Transaktionen laufen parallel, siehe run_batches. Die Chunks werden erst nach den Transaktionen
+    gelöscht, damit große Bodies die Transaktion nicht sprengen. Bleiben dabei Chunks übrig, entfernt sie die
+    GarbageCollection mit der Nachricht.
+    """
+    results = []
+    chunk_keys = []
+    batches = run_batches(message_queue_name, keys, lambda batch, shard_key: _mark_messages_deleted_async(
+        message_queue_name, batch, deleted_at, shard_key))
+    for batch_results, batch_chunk_keys in batches:
+        results.extend(batch_results)
+        chunk_keys.extend(batch_chunk_keys)
+
+    deleted = [message for status, message in results if status == 204]
+    futures = _delete_keys_async(chunk_keys)
+    cache_messages(deleted)
+    memcache.delete_multi([_body_cache_key(message.key) for message in deleted])
+    ndb.Future.wait_all(futures)
+    if deleted:
+        touch_queue(message_queue_name)
+    return results
+
+
+@ndb.transactional
+def _claim_garbage_collection(message_queue_name, delete_before, expire_before):
+    """Legt die GarbageCollection der Queue an oder übernimmt eine abgebrochene.
+
+    Gibt die run_id für den neuen Task zurück, oder None, wenn bereits eine GarbageCollection läuft.
+    """
+    job = GarbageCollection.get_by_id(message_queue_name)
+    if job and not job.done and job.updated_at > datetime.now() - timedelta(seconds=GC_STALE_TIME):
+        return None
+    if job is None or job.done:
+        job = GarbageCollection(id=message_queue_name, delete_before=delete_before, expire_before=expire_before)
+    job.run_id = uuid.uuid4().hex
+    job.put()
+    return job.run_id
+
+
+@ndb.transactional
+def _save_garbage_collection(message_queue_name, run_id, cursor, more, deleted=0, expired=0):
+    """Speichert den Fortschritt der GarbageCollection, sofern sie nicht von einem anderen Task übernommen
+    wurde. Ist die aktuelle Phase (erst Ablauf, dann Entfernen) fertig, beginnt die nächste von vorne.
+    Gibt den aktuellen Stand zurück."""
+    job = GarbageCollection.get_by_id(message_queue_name)
+    if job.run_id == run_id:
+        job.deleted += deleted
+        job.expired += expired
+        if more:
+            job.cursor = cursor.urlsafe() if cursor else job.cursor
+        else:
+            job.cursor = None
+            if job.expire_before and not job.expire_done:
+                job.expire_done = True
+            else:
+                job.done = True
+        job.put()
+    return job
+
+
+def _delete_messages(keys):
+    """Entfernt die Nachrichten mit den gegebenen Keys samt ihrer Chunks endgültig."""
+    futures = [MessageChunk.query(ancestor=key).fetch_async(keys_only=True) for key in keys]
+    chunk_keys = [chunk_key for future in futures for chunk_key in future.get_result()]
+    ndb.delete_multi(keys + chunk_keys)
+    # Die Queue-Namen enthalten keinen '/', die Key-ID ist also eindeutig teilbar, siehe Message.make_key
+    memcache.delete_multi([_cache_key(*key.id().split('/', 1)) for key in keys]
+                          + [_body_cache_key(key) for key in keys])
+
+
+def collect_garbage(message_queue_name, run_id):
+    """Entfernt die vor GarbageCollection.delete_before gelöschten Nachrichten der Queue.
+
+    Ist GarbageCollection.expire_before gesetzt, werden vorher die bis dahin erstellten, nicht gelöschten
+    Nachrichten als gelöscht markiert.
+
+    Läuft als deferred Task. Die Nachrichten werden per keys-only Query in Stapeln von GC_BATCH_SIZE
+    bearbeitet, nach jedem Stapel wird der Fortschritt gespeichert. Nach GC_TIME_LIMIT Sekunden macht ein
+    neuer Task weiter.
+    """
+    deadline = time.time() + GC_TIME_LIMIT
+    job = GarbageCollection.get_by_id(message_queue_name)
+    while job and job.run_id == run_id and not job.done:
+        if time.time() > deadline:
+            deferred.defer(collect_garbage, message_queue_name, run_id)
+            return
+        cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+        if job.expire_before and not job.expire_done:
+            query = Message.query(Message.message_queue_name == message_queue_name, Message.deleted_at == None,
+                                  Message.created_at < job.expire_before)
+            keys, cursor, more = query.fetch_page(GC_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            results = mark_messages_deleted(message_queue_name, keys, datetime.now())
+            expired = len([status for status, _message in results if status == 204])
+            job = _save_garbage_collection(message_queue_name, run_id, cursor, more, expired=expired)
+        else:
+            query = Message.query(Message.message_queue_name == message_queue_name,
+                                  Message.deleted_at < job.delete_before)
+            keys, cursor, more = query.fetch_page(GC_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            _delete_messages(keys)
+            if keys:
+                _add_to_counters(message_queue_name, deleted=-len(keys)).get_result()
+            job = _save_garbage_collection(message_queue_name, run_id, cursor, more, deleted=len(keys))
+
+
+def start_garbage_collection(message_queue_name, delete_before, expire_before=None):
+    """Startet die GarbageCollection der Queue als Hintergrund-Task, sofern nicht bereits eine läuft.
+
+    Entfernt werden alle Nachrichten, die vor delete_before als gelöscht markiert wurden. Ist expire_before
+    angegeben, werden zuvor alle vor expire_before erstellten Nachrichten als gelöscht markiert. Gibt den
+    aktuellen Stand als GarbageCollection zurück.
+    """
+    run_id = _claim_garbage_collection(message_queue_name, delete_before, expire_before)
+    if run_id:
+        deferred.defer(collect_garbage, message_queue_name, run_id)
+    return GarbageCollection.get_by_id(message_queue_name)
+
+
+class NdbStorage(Storage):
+    """Speichert Nachrichten im App Engine Datastore, siehe Message und MessageChunk.
+
+    Metadaten und kleine Bodies werden im memcache gehalten, die Version der Queues ebenfalls.
+    """
+
+    @staticmethod
+    def _build_message(message_queue_name, created_at, guid, content_type, body, content_encoding):
+        """Erzeugt eine noch nicht gespeicherte Nachricht und die Chunks ihres Bodys.
+
+        Gibt (message, chunks) zurück, siehe insert_messages.
+        """
+        message = Message(key=Message.make_key(message_queue_name, guid),
+                          guid=guid,
+                          message_queue_name=message_queue_name,
+                          content_type=content_type,
+                          content_encoding=content_encoding,
+                          content_hash=hashlib.sha1(body).hexdigest(),
+                          size=len(body),
+                          created_at=created_at,
+                          deleted_at=None)
+        chunks = split_body(message.key, body)
+        message.chunks = [chunk.key for chunk in chunks]
+        return message, chunks
+
+    def create_messages(self, message_queue_name, items):
+        """Speichert die Nachrichten in parallelen Transaktionen von je BATCH_SIZE Nachrichten, siehe
+        run_batches.
+
+        Ob eine Nachricht schon existiert, wird nur innerhalb der Transaktion per Key gelesen. created_at
+        steigt mit der Reihenfolge der items, die Liste der Queue folgt so der Reihenfolge des Stapels.
+        """
+        results = []
+        created = []
+        now = datetime.now()
+        messages = [self._build_message(message_queue_name, now + timedelta(microseconds=index), *item)
+                    for index, item in enumerate(items)]
+        existing = [found for batch in run_batches(message_queue_name, messages, insert_messages_async)
+                    for found in batch]
+        for (message, chunks), found in zip(messages, existing):
+            if found is None:
+                results.append((201, message))
+                created.append((message, chunks))
+            else:
+                results.append((410 if found.deleted_at else 409, found))
+
+        cache_messages([message for message, _chunks in created])
+        cache_bodies(created)
+        if created:
+            touch_queue(message_queue_name)
+        return results
+
+    def get_message(self, message_queue_name, guid):
+        """Siehe get_message."""
+        return get_message(message_queue_name, guid)
+
+    def get_messages(self, message_queue_name, guids):
+        """Siehe get_messages."""
+        return get_messages(message_queue_name, guids)
+
+    def iter_body(self, message):
+        """Siehe iter_body."""
+        return iter_body(message)
+
+    def body_sizes(self, messages):
+        """Siehe Storage.body_sizes. Alten Nachrichten mit Chunks fehlt die Größe."""
+        return [_stored_size(message) if message.size is not None or not message.chunks else None
+                for message in messages]
+
+    def mark_deleted(self, message_queue_name, guids, deleted_at):
+        """Siehe mark_messages_deleted."""
+        return mark_messages_deleted(message_queue_name, [Message.make_key(message_queue_name, guid)
+                                                          for guid in guids], deleted_at)
+
+    @staticmethod
+    def _fetch_page(query, cursor, limit, **kwargs):
+        """Wie query.fetch_page, mit Cursorn als String."""
+        try:
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+        except BadValueError:
+            raise InvalidCursor(cursor)
+        results, next_cursor, more = query.fetch_page(limit, start_cursor=cursor, **kwargs)
+        return results, next_cursor.urlsafe() if next_cursor else None, more
+
+    @staticmethod
+    def _live_query(message_queue_name):
+        """Query über die nicht gelöschten Nachrichten der Queue in Reihenfolge der Erstellung."""
+        return Message.query(
+            Message.message_queue_name == message_queue_name, Message.deleted_at == None).order(
+            Message.created_at)
+
+    def list_messages(self, message_queue_name, cursor, limit):
+        """Siehe Storage.list_messages.
+
+        Geleaste Nachrichten werden nach der Query aussortiert, eine Seite kann daher kürzer als limit sein.
+        """
+        messages, next_cursor, more = self._fetch_page(self._live_query(message_queue_name), cursor, limit)
+        now = datetime.now()
+        return [message for message in messages if not _is_leased(message, now)], next_cursor, more
+
+    def lease_messages(self, message_queue_name, cursor, limit, lease_seconds):
+        """Siehe Storage.lease_messages.
+
+        Die Kandidaten einer Seite werden in Transaktionen von je BATCH_SIZE Nachrichten geleast, so dass
+        keine Nachricht an zwei Clients gleichzeitig geht. Sind alle Nachrichten einer Seite schon
+        geleast, wird mit der nächsten weitergemacht, höchstens LEASE_SCAN_PAGES Seiten weit.
+        """
+        now = datetime.now()
+        leased_until = now + timedelta(seconds=lease_seconds)
+        leased = []
+        for _page in range(LEASE_SCAN_PAGES):
+            messages, cursor, more = self._fetch_page(self._live_query(message_queue_name), cursor, limit)
+            keys = [message.key for message in messages if not _is_leased(message, now)]
+            for start in range(0, len(keys), BATCH_SIZE):
+                leased.extend(_lease_messages(keys[start:start + BATCH_SIZE], now, leased_until))
+            if leased or not more:
+                break
+
+        if leased:
+            cache_messages(leased)
+            leased_key = _queue_leased_key(message_queue_name)
+            horizon = time.mktime(leased_until.timetuple())
+            memcache.set(leased_key, max(horizon, memcache.get(leased_key) or 0))
+            touch_queue(message_queue_name)
+        return leased, cursor, more
+
+    def list_all_messages(self, message_queue_name, status, created_after, created_before, cursor, limit):
+        """Siehe Storage.list_all_messages.
+
+        Die Liste wird per keys-only Query ermittelt, geladen werden nur die Metadaten der Nachrichten.
+        Da der Datastore Ungleichungen nur auf einem Property erlaubt, lassen sich gelöschte Nachrichten
+        nicht zusätzlich nach created_at filtern.
+        """
+        query = Message.query(Message.message_queue_name == message_queue_name)
+        if status == 'deleted':
+            if created_after or created_before:
+                raise ValueError('Geloeschte Nachrichten lassen sich nicht nach created_at filtern.')
+            query = query.filter(Message.deleted_at > datetime.min).order(Message.deleted_at)
+        else:
+            if status == 'live':
+                query = query.filter(Message.deleted_at == None)
+            if created_after:
+                query = query.filter(Message.created_at >= created_after)
+            if created_before:
+                query = query.filter(Message.created_at < created_before)
+            query = query.order(Message.created_at)
+        keys, next_cursor, more = self._fetch_page(query, cursor, limit, keys_only=True)
+        return [message for message in ndb.get_multi(keys) if message], next_cursor, more
+
+    def queue_version(self, message_queue_name):
+        """Siehe get_queue_version."""
+        return get_queue_version(message_queue_name)
+
+    def queue_stats(self, message_queue_name):
+        """Summiert die Shards der Zähler (siehe QueueCounterShard), parallel zur Query nach der ältesten
+        Nachricht."""
+        shards = ndb.get_multi_async(QueueCounterShard.make_keys(message_queue_name))
+        oldest = self._live_query(message_queue_name).get_async()
+        stats = {'live': 0, 'deleted': 0, 'bytes': 0}
+        for future in shards:
+            shard = future.get_result()
+            if shard:
+                for name in stats:
+                    stats[name] += getattr(shard, name) or 0
+        oldest = oldest.get_result()
+        stats['oldest_created_at'] = oldest.created_at if oldest else None
+        return stats
+
+    def queue_names(self):
+        """Siehe Storage.queue_names."""
+        query = Message.query(projection=[Message.message_queue_name], distinct=True)
+        return [message.message_queue_name for message in query]
+
+    def start_garbage_collection(self, message_queue_name, delete_before, expire_before=None):
+        """Startet die GarbageCollection als deferred Task, siehe start_garbage_collection."""
+        return start_garbage_collection(message_queue_name, delete_before, expire_before).as_dict()
+
+    def garbage_collection_status(self, message_queue_name):
+        """Siehe Storage.garbage_collection_status."""
+        job = GarbageCollection.get_by_id(message_queue_name)
+        return job.as_dict() if job else None
+
+    def add_events(self, payloads):
+        """Stellt die Events als Tasks in die Pull-Queue EVENT_QUEUE_NAME."""
+        taskqueue.Queue(EVENT_QUEUE_NAME).add([taskqueue.Task(payload=payload, method='PULL')
+                                               for payload in payloads])
+
+    def lease_events(self, limit, lease_seconds):
+        """Least Tasks aus der Pull-Queue EVENT_QUEUE_NAME, event_id ist der Name des Tasks."""
+        tasks = taskqueue.Queue(EVENT_QUEUE_NAME).lease_tasks(lease_seconds, limit)
+        return [(task.name, task.payload) for task in tasks]
+
+    def delete_events(self, event_ids):
+        """Löscht die Tasks aus der Pull-Queue EVENT_QUEUE_NAME."""
+        if event_ids:
+            taskqueue.Queue(EVENT_QUEUE_NAME).delete_tasks_by_name(event_ids)
+
+    def cache_get(self, key):
+        """Liest aus dem memcache."""
+        return memcache.get(key)
+
+    def cache_set(self, key, value, time):
+        """Schreibt in den memcache."""
+        memcache.set(key, value, time=time)
+
+    def cache_incr(self, key, time):
+        """Zählt im memcache."""
+        value = memcache.incr(key)
+        if value is None:
+            memcache.add(key, 0, time=time)
+            value = memcache.incr(key)
+        return value
+
+    def cache_incr_multi(self, keys, time):
+        """Zählt im memcache, mit einem RPC für alle bereits angelegten Zähler."""
+        values = memcache.offset_multi(dict((key, 1) for key in keys))
+        missing = [key for key in keys if values.get(key) is None]
+        if missing:
+            memcache.add_multi(dict((key, 0) for key in missing), time=time)
+            values.update(memcache.offset_multi(dict((key, 1) for key in missing)))
+        return [values.get(key) for key in keys]
+
+
+@ndb.transactional(xg=True)
+def _lease_messages(keys, now, leased_until):
+    """Least die Nachrichten mit den gegebenen Keys bis leased_until, sofern sie weder gelöscht noch
+    bereits von einem anderen Client geleast sind. Gibt die geleasten Nachrichten zurück."""
+    leased = [message for message in ndb.get_multi(keys) if message and not message.deleted_at
+              and not (message.leased_until and message.leased_until > now)]
+    for message in leased:
+        message.leased_until = leased_until
+    ndb.put_multi(leased)
+    return leased
+
+
+def _is_leased(message, now):
+    """Gibt True zurück, wenn die Nachricht gerade von einem Client geleast ist."""
+    return bool(message.leased_until and message.leased_until > now)
+
+
+def _count_datastore_rpc(service, call, request, response):
+    """Hook des apiproxy, zählt jeden Datastore-Aufruf in fmtp_metrics."""
+    metrics.count_rpc(call)
+
+
+class MetricsMixin(object):
+    """Misst Dauer, Status und Größe der Requests eines Handlers in fmtp_metrics.metrics.
+
+    Gezählt werden je Handler und HTTP-Methode die Dauer (fmtp_request_seconds), die Antworten je
+    Statusklasse (fmtp_responses_total), die Bytes der Requests und Antworten und die Datastore-Aufrufe.
+    Mit profile_sample_rate wird ein Anteil der Requests mit cProfile profiliert, die Profile zeigt der
+    MetricsHandler an.
+    """
+
+    # Anteil der Requests (zwischen 0 und 1), die profiliert werden. 0 schaltet das Profilieren ab.
+    profile_sample_rate = 0
+
+    # Anzahl der Funktionen, die je Profil (sortiert nach kumulierter Zeit) aufbewahrt werden
+    profile_functions = 25
+
+    def dispatch(self):
+        """Führt den Request aus und zeichnet dabei die Messwerte auf."""
+        # Das Testbed ersetzt den apiproxy, der Hook wird daher bei jedem Request (idempotent) eingehängt
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('fmtp_metrics', _count_datastore_rpc, 'datastore_v3')
+        handler, method = type(self).__name__, self.request.method
+        profiler = None
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            profiler = cProfile.Profile()
+        metrics.start_request()
+        start = time.time()
+        status = 500
+        try:
+            if profiler:
+                result = profiler.runcall(super(MetricsMixin, self).dispatch)
+            else:
+                result = super(MetricsMixin, self).dispatch()
+            status = self.response.status_int
+            metrics.incr('fmtp_request_bytes_total', len(self.request.body), handler=handler)
+            metrics.incr('fmtp_response_bytes_total', self._response_size(), handler=handler)
+            return result
+        except Exception, exception:
+            status = getattr(exception, 'code', 500)
+            raise
+        finally:
+            seconds = time.time() - start
+            rpcs = metrics.finish_request()
+            metrics.observe('fmtp_request_seconds', seconds, handler=handler, method=method)
+            metrics.incr('fmtp_responses_total', handler=handler, method=method, status='%dxx' % (status // 100))
+            if self._counts_queue(status):
+                metrics.incr('fmtp_queue_requests_total', queue=self.request.route_args[0])
+            if profiler:
+                self._add_profile(profiler, handler, method, status, seconds, rpcs)
+
+    def _response_size(self):
+        """Gibt die Größe der Antwort zurück, ohne die geschriebenen Stücke (siehe MessageHandler.get) zu
+        einem String zusammenzufügen."""
+        app_iter = self.response.app_iter
+        if isinstance(app_iter, list):
+            return sum(len(part) for part in app_iter)
+        return self.response.content_length or 0
+
+    def _counts_queue(self, status):
+        """Gibt True zurück, wenn der Request für seine Queue gezählt wird.
+
+        Gezählt werden nur erfolgreiche Requests auf gültige Queue-Namen, damit Clients mit ausgedachten
+        Namen nicht beliebig viele Labels anlegen (siehe auch Metrics.max_series).
+        """
+        if not self.request.route_args or status >= 400:
+            return False
+        check = getattr(self, 'check_messagequeue_name', None)
+        return check is None or check(self.request.route_args[0])
+
+    def _add_profile(self, profiler, handler, method, status, seconds, rpcs):
+        """Übergibt das Profil eines Requests an fmtp_metrics.metrics."""
+        out = StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(self.profile_functions)
+        metrics.add_profile({
+            'handler': handler,
+            'method': method,
+            'path': self.request.path_qs,
+            'status': status,
+            'seconds': seconds,
+            'started_at': datetime.now() - timedelta(seconds=seconds),
+            'datastore_rpcs': rpcs,
+            'stats': out.getvalue(),
+        })
+
+
+class MessageEventsMixin(object):
+    """Anpassungspunkte für Handler, die Nachrichten anlegen oder löschen.
+
+    Wird von MessageHandler und für Stapelverarbeitung von QueueHandler genutzt. Wer die Events
+    anpasst, muss das daher in den Erben beider Handler tun.
+    """
+
+    # Regulärer Ausdruck, dem die guids der Nachrichten entsprechen müssen
+    guid_pattern = r'^[a-zA-Z0-9_-]+$'
+
+    # Speicher der Nachrichten, siehe fmtp_storage.Storage
+    storage = NdbStorage()
+
+    # Bodies ab dieser Größe (in Bytes) werden gzip-komprimiert gespeichert, sofern das Platz spart.
+    # None schaltet die Kompression durch den Server ab, komprimiert eingelieferte Bodies bleiben komprimiert.
+    compress_min_size = 1024
+
+    def initialize(self, request, response):
+        """Zeigt Clients an, dass Requests gzip-komprimiert sein dürfen (siehe RFC 7694)."""
+        super(MessageEventsMixin, self).initialize(request, response)
+        self.response.headers['Accept-Encoding'] = 'gzip'
+
+    def _get_request_encoding(self):
+        """Gibt 'gzip' zurück, wenn der Request-Body gzip-komprimiert ist, sonst None."""
+        encoding = self.request.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return None
+        if encoding != 'gzip':
+            raise HTTP400_BadRequest('Nicht unterstuetztes Content-Encoding: %r' % encoding)
+        return encoding
+
+    def _accepts_gzip(self):
+        """Gibt True zurück, wenn der Client laut Accept-Encoding gzip-komprimierte Antworten versteht."""
+        for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+            params = [param.strip().lower() for param in coding.split(';')]
+            if params[0] == 'gzip' and not [param for param in params[1:] if re.match(r'q=0(\.0*)?$', param)]:
+                return True
+        return False
+
+    def _storable_body(self, body, content_encoding):
+        """Gibt (body, content_encoding) zurück, wie ein Body gespeichert werden soll.
+
+        Komprimiert eingelieferte Bodies werden unverändert gespeichert, andere ab compress_min_size
+        komprimiert.
+        """
+        if content_encoding == 'gzip':
+            if not body.startswith('\x1f\x8b'):
+                raise HTTP400_BadRequest('Body ist nicht gzip-komprimiert.')
+            return body, content_encoding
+        if self.compress_min_size is not None and len(body) >= self.compress_min_size:
+            compressed = gzip_compress(body)
+            if len(compressed) < len(body):
+                return compressed, 'gzip'
+        return body, None
+
+    def check_messagequeue_name(self, message_queue_name):
+        """Gibt True zurück, wenn message_queue_name ein erlaubter Name für eine MesssageQueue ist.
+        Per default sind alle Namen erlaubt.
+
+        Kann zur Anpassung überschrieben werden, z.B:
+
+        def is_allowed_message_queue_name(self, message_queue_name):
+            return message_queue_name in ['queue_a', 'queue_b']
+        """
+        return True
+
+    # Mit True werden on_created und on_deleted nicht im Request ausgelöst, sondern über die Storage an den
+    # EventHandler übergeben, der sie stapelweise im Hintergrund verarbeitet (siehe README/Events).
+    defer_events = False
+
+    def on_created(self, message):
+        """Event nach der Nachrichtenerstellung, z.B. für Auditlogs
+
+        Darf einen ndb.Future zurückgeben, z.B. von put_async(). Der Handler wartet darauf erst vor der
+        Antwort, bei Stapelverarbeitung laufen die Events aller Nachrichten so parallel.
+        """
+        pass
+
+    def on_deleted(self, message):
+        """Event nach der Nachrichtenlöschung, z.B. für AuditLogs. Darf einen ndb.Future zurückgeben."""
+        pass
+
+    def on_created_batch(self, messages):
+        """Löst on_created für mehrere Nachrichten aus.
+
+        Kann überschrieben werden, um z.B. die Auditlogs eines Stapels mit einem put_multi zu schreiben.
+        Mit defer_events bekommt es die Nachrichten mehrerer Requests zusammen.
+        """
+        self._wait_for_events([self.on_created(message) for message in messages])
+
+    def on_deleted_batch(self, messages):
+        """Löst on_deleted für mehrere Nachrichten aus, siehe on_created_batch."""
+        self._wait_for_events([self.on_deleted(message) for message in messages])
+
+    def _emit_events(self, event, messages):
+        """Löst das Event ('on_created' oder 'on_deleted') für messages aus, bzw. stellt es mit
+        defer_events zurück."""
+        if not messages:
+            return
+        if self.defer_events:
+            self.storage.add_events([pickle.dumps((event, messages), pickle.HIGHEST_PROTOCOL)])
+        else:
+            getattr(self, event + '_batch')(messages)
+
+    def _wait_for_events(self, results):
+        """Wartet auf die Futures, die Events zurückgegeben haben. Exceptions der Events werden geraised."""
+        for result in results:
+            if isinstance(result, ndb.Future):
+                result.get_result()
+
+
+class ListingMixin(object):
+    """Gemeinsame Logik der Handler, die Nachrichtenlisten ausliefern (QueueHandler und SubscriptionHandler):
+    Aushandeln des Formats, Conditional-GET, Zählen der Abrufe und Retry-Intervalle.
+
+    Erben brauchen ein Attribut storage, anpassen lassen sich (min/max)_retry_interval und slow_listing_time.
     """
 
     # Zeitspanne in Millisekunden, die ein Client mindestens warten MUSS, bevor er eine neue Anfrage stellt.
@@ -57,57 +1142,554 @@ class QueueHandler(BasicHandler):
     # Zeitspanne in Millisekunden, die ein Client höchstens warten sollte, bevor er eine neue Anfrage stellt.
     max_retry_interval = 60000
 
-    # Maximale Anzahl von Nachrichten, die angezeigt werden
+    # Zeit in Sekunden, ab der das Erstellen einer Liste als langsam gilt. Clients sollen dann länger warten.
+    slow_listing_time = 1.0
+
+    def get_listing_format(self):
+        """Gibt das per Accept-Header angefragte Listenformat zurück: 'json', 'xml', 'ndjson' oder 'text'."""
+        accept = self.request.headers.get('Accept', '')
+        if accept.startswith('application/json'):
+            return 'json'
+        elif accept.startswith('application/xml'):
+            return 'xml'
+        elif accept.startswith('application/x-ndjson'):
+            return 'ndjson'
+        return 'text'
+
+    def client_has_listing(self, etag):
+        """Gibt True zurück, wenn der Client die Liste mit dem ETag per If-None-Match als aktuell meldet."""
+        tags = [tag.strip() for tag in self.request.headers.get('If-None-Match', '').split(',')]
+        return '"%s"' % etag in tags or 'W/"%s"' % etag in tags
+
+    def client_id(self):
+        """Gibt zurück, wem Abrufe zugerechnet werden: dem Benutzer aus HTTP-Basic-Credentials, sonst der
+        Adresse des Clients. Erben können z.B. Mandanten zurückgeben.
+        """
+        credentials = basic_credentials(self.request)
+        if credentials:
+            return 'user:%s' % credentials[0]
+        return 'addr:%s' % self.request.remote_addr
+
+    def count_polls(self, message_queue_names):
+        """Zählt den Abruf der Listen der Queues durch den Client (siehe client_id) und gibt zurück, wie oft
+        er jede der Queues in der laufenden Minute abgerufen hat. Kann die Storage nicht zählen, sind die
+        Zahlen None.
+        """
+        minute = int(time.time() // 60)
+        client = self.client_id()
+        return self.storage.cache_incr_multi(['fmtp_polls:%s:%s:%d' % (message_queue_name, client, minute)
+                                              for message_queue_name in message_queue_names], 120)
+
+    def get_retry_interval(self, listing, polls):
+        """Berechnet, wie viele Millisekunden ein Client bis zur nächsten Anfrage warten soll.
+
+        Liegen Nachrichten bereit, soll der Client nach min_retry_interval wiederkommen. Ist die Liste leer
+        oder unverändert (listing ist None), wächst die Wartezeit mit der Zahl der Abrufe dieses Clients in
+        der laufenden Minute (siehe count_polls). Ein Client, der zu oft fragt, wird so bis auf
+        max_retry_interval zurückgedrängt, ohne dass andere Clients derselben Queue länger warten müssen.
+        War die Liste langsam zu erstellen, wird die Wartezeit verdoppelt. Tiefe und Alter der Queue spielen
+        keine Rolle, eine leere Liste ist das Signal.
+        """
+        if listing and (listing['count'] or listing['link']):
+            interval = self.min_retry_interval
+        else:
+            interval = self.min_retry_interval * (polls or 1)
+        if listing and listing['render_time'] > self.slow_listing_time:
+            interval *= 2
+        return max(self.min_retry_interval, min(interval, self.max_retry_interval))
+
+
+class QueueHandler(MetricsMixin, ListingMixin, MessageEventsMixin, BasicHandler):
+    """Handler für FMTP-Nachrichtenlisten, gemäss README/Listenformate.
+
+    Der Handler kümmert sich um die Auflistung der Nachrichten in einer Queue in verschiedenen Formaten (GET),
+    und um das Einstellen (POST) und Bestätigen (DELETE) mehrerer Nachrichten auf einmal.
+
+    Dieser Handler ist als Basisklasse vorgesehen, in dessen Erben zur Anpassung
+
+     * (min/max)_retry_interval, slow_listing_time (siehe ListingMixin),
+     * max_polls_per_minute, check_budget,
+     * max_messages,
+     * max_wait, max_lease, max_inline_size,
+     * max_post_messages, max_delete_guids, message_handler,
+     * on_access,
+     * storage,
+     * profile_sample_rate (siehe MetricsMixin), und
+     * die Events aus MessageEventsMixin
+
+    überschrieben werden können (siehe dort zur wozu).
+    """
+
+    # Anzahl Abrufe der Liste je Client (siehe client_id), Queue und Minute, ab der mit 429 Too Many Requests
+    # geantwortet wird. None: unbegrenzt
+    max_polls_per_minute = None
+
+    # Maximale Anzahl von Nachrichten, die pro Seite der Liste angezeigt werden
     max_messages = 10
 
+    # Maximale Zeit in Sekunden, die eine Anfrage mit dem Parameter `wait` auf neue Nachrichten wartet.
+    # Muss deutlich unter der Request-Deadline von 60 Sekunden bleiben.
+    max_wait = 20
+
+    # Zeitspanne in Sekunden, in der eine wartende Anfrage prüft, ob neue Nachrichten eingetroffen sind.
+    wait_poll_interval = 0.25
+
+    # Maximale Dauer in Sekunden, für die eine Nachricht mit dem Parameter `lease` geleast werden kann.
+    max_lease = 3600
+
+    # Maximale Summe der Bodies in Bytes, die eine NDJSON-Liste eingebettet enthält. Größere Bodies werden
+    # gar nicht erst gelesen.
+    max_inline_size = 512 * 1024
+
+    # Listenformate, die der Handler per Accept-Header anbietet
+    listing_formats = ['text/plain', 'application/json', 'application/xml', 'application/x-ndjson']
+
+    # Maximale Anzahl von guids, die mit einem DELETE gelöscht werden können
+    max_delete_guids = 1000
+
+    # Maximale Anzahl von Nachrichten, die mit einem POST erstellt werden können
+    max_post_messages = 1000
+
+    # Erbe von MessageHandler, dessen on_access die Nachrichten eines Stapels (POST bzw. DELETE) und die
+    # Bodies einer NDJSON-Liste (GET) freigibt, siehe on_batch_access und _readable_guids. Ohne
+    # message_handler werden Stapel mit 403 Forbidden abgelehnt und NDJSON-Listen enthalten keine Bodies.
+    message_handler = None
+
     def _message_as_dict(self, message):
         """Erstellt ein dict, das eine Nachricht in der Liste repräsentiert."""
-        return {
-            'url': '%s/%s/' % (self.request.uri.rstrip('/'), quote(message.guid)),
+        ret = {
+            'url': '%s/%s/' % (self.request.path_url.rstrip('/'), quote(message.guid)),
             'created_at': str(message.created_at),
         }
+        if _is_leased(message, datetime.now()):
+            ret['leased_until'] = str(message.leased_until)
+        return ret
+
+    def _get_cursor(self):
+        """Gibt den Cursor aus dem Parameter `cursor` zurück, oder None, wenn die Liste von vorne beginnt."""
+        return self.request.get('cursor') or None
+
+    def _get_wait(self):
+        """Gibt die Wartezeit in Sekunden aus dem Parameter `wait` zurück, höchstens max_wait."""
+        if not self.request.get('wait'):
+            return 0
+        try:
+            wait = float(self.request.get('wait'))
+        except ValueError:
+            raise HTTP400_BadRequest('Ungueltige Wartezeit: %r' % self.request.get('wait'))
+        return max(0, min(wait, self.max_wait))
+
+    def _get_lease(self):
+        """Gibt die Dauer der Lease in Sekunden aus dem Parameter `lease` zurück, höchstens max_lease.
+
+        0 bedeutet, dass die Nachrichten nicht geleast werden.
+        """
+        if not self.request.get('lease'):
+            return 0
+        try:
+            lease = int(self.request.get('lease'))
+        except ValueError:
+            raise HTTP400_BadRequest('Ungueltige Lease-Dauer: %r' % self.request.get('lease'))
+        return max(0, min(lease, self.max_lease))
+
+    def _fetch_messages(self, message_queue_name, cursor, lease=0):
+        """Gibt eine Seite der bereitstehenden Nachrichten als (messages, next_cursor, more) zurück.
+
+        Ist lease angegeben, werden die Nachrichten für lease Sekunden geleast.
+        """
+        try:
+            if lease:
+                return self.storage.lease_messages(message_queue_name, cursor, self.max_messages, lease)
+            return self.storage.list_messages(message_queue_name, cursor, self.max_messages)
+        except InvalidCursor:
+            raise HTTP400_BadRequest('Ungueltiger cursor: %r' % cursor)
+
+    def _parse_batch(self):
+        """Liest die Nachrichten eines Stapels im NDJSON-Format aus dem Request.
+
+        Jede Zeile ist ein JSON-Objekt mit den Schlüsseln guid, content_type und body bzw. body_base64,
+        sowie optional content_encoding. Der Stapel selbst darf gzip-komprimiert sein.
+        Gibt eine Liste von (guid, content_type, body, content_encoding) zurück. Enthält der Stapel mehr als
+        max_post_messages Nachrichten, wird HTTP400_BadRequest geraised.
+        """
+        data = self.request.body
+        if self._get_request_encoding() == 'gzip':
+            try:
+                data = gzip_decompress(data)
+            except (IOError, EOFError):
+                raise HTTP400_BadRequest('Nachrichtenstapel ist nicht gzip-komprimiert.')
+
+        items = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            if len(items) >= self.max_post_messages:
+                raise HTTP400_BadRequest('Es koennen hoechstens %d Nachrichten auf einmal erstellt werden.'
+                                         % self.max_post_messages)
+            try:
+                item = json.loads(line)
+                if 'body_base64' in item:
+                    body = base64.b64decode(item['body_base64'])
+                else:
+                    body = item['body'].encode('utf-8')
+                items.append((unicode(item['guid']), item.get('content_type') or 'application/octet-stream',
+                              body, item.get('content_encoding')))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                raise HTTP400_BadRequest('Ungueltige Zeile im Nachrichtenstapel: %r' % line[:100])
+        return items
 
     def on_access(self, message_queue_name):
-        """Event, das beim Versuch, eine Messagequeue abzufragen ausgelöst wird.
-        message_queue_name ist der Parameter aus der URL.
+        """Event, das beim Versuch, eine Messagequeue abzufragen (GET bzw. HEAD) ausgelöst wird.
+        message_queue_name ist der Parameter aus der URL. Stapel prüft on_batch_access.
 
         Um den Zugriff auf Messagequeues zu kontrollieren, kann ggf. HTTP401_Unauthorized
-        geraised werden.
+        geraised werden. Das Ergebnis von Prüfungen gegen einen Benutzerspeicher lässt sich mit
+        fmtp_auth.AccessCache cachen.
         """
         pass
 
+    def on_batch_access(self, method, message_queue_name, items):
+        """Event, das vor dem Erstellen (POST) bzw. Löschen (DELETE) eines Stapels ausgelöst wird.
+        items ist eine Liste von (guid, message), message ist bei POST immer None, bei DELETE None, wenn
+        keine Nachricht gefunden wurde.
+
+        Ruft on_access von message_handler für jede Nachricht auf, für Stapel gelten so dieselben Rechte wie
+        für einzelne Nachrichten. Ohne message_handler wird HTTP403_Forbidden geraised.
+        """
+        if self.message_handler is None:
+            raise HTTP403_Forbidden('Stapelverarbeitung ist nicht freigegeben.')
+        handler = self.message_handler(self.request, self.response)
+        self._wait_for_events([handler.on_access(method, message_queue_name, guid, message)
+                               for guid, message in items])
+
+    def _listing_etag(self, version, listing_format):
+        """Gibt das ETag der angefragten Liste bei der gegebenen Version der Queue zurück."""
+        return hashlib.md5(repr((version, listing_format, self.request.path_url,
+                                 self.request.get('cursor')))).hexdigest()
+
+    def _readable_guids(self, message_queue_name, messages):
+        """Gibt die guids der Nachrichten zurück, die der Client auch einzeln per GET abrufen dürfte.
+
+        Ruft on_access('GET', ...) von message_handler für jede Nachricht auf, Nachrichten, bei denen
+        HTTP401_Unauthorized oder HTTP403_Forbidden geraised wird, fehlen im Ergebnis. Ohne message_handler
+        ist das Ergebnis leer.
+        """
+        if self.message_handler is None:
+            return set()
+        handler = self.message_handler(self.request, self.response)
+        results = []
+        for message in messages:
+            try:
+                results.append((message.guid, handler.on_access('GET', message_queue_name, message.guid, message)))
+            except (HTTP401_Unauthorized, HTTP403_Forbidden):
+                pass
+        readable = set()
+        for guid, result in results:
+            try:
+                self._wait_for_events([result])
+            except (HTTP401_Unauthorized, HTTP403_Forbidden):
+                continue
+            readable.add(guid)
+        return readable
+
+    def _inline_message_lines(self, message_queue_name, messages):
+        """Erstellt die Zeilen einer NDJSON-Liste, mit eingebetteten Bodies bis max_inline_size Bytes.
+
+        Die Zeilen haben das Format aus _parse_batch, zusätzlich mit url und created_at. Eingebettet werden
+        nur Bodies, die der Client auch einzeln abrufen dürfte (siehe _readable_guids). Passt ein Body laut
+        Storage.body_sizes nicht mehr ins Budget, enthalten er und alle folgenden Zeilen keinen Body, der
+        Client ruft die Nachrichten dann einzeln ab. Gelesen werden nur die eingebetteten Bodies.
+        """
+        budget = self.max_inline_size
+        readable = self._readable_guids(message_queue_name, messages) if budget else set()
+        candidates = [message for message in messages if message.guid in readable]
+        inlined = []
+        for message, size in zip(candidates, self.storage.body_sizes(candidates)):
+            if size is None or size > budget:
+                break
+            budget -= size
+            inlined.append(message)
+        # Die eingebetteten Bodies parallel anfordern (siehe iter_body)
+        bodies = dict((message.guid, self.storage.iter_body(message)) for message in inlined)
+
+        lines = []
+        for message in messages:
+            line = self._message_as_dict(message)
+            line.update(guid=message.guid, content_type=message.content_type or 'application/octet-stream')
+            if message.guid in bodies:
+                body = ''.join(bodies[message.guid])
+                if message.content_encoding:
+                    # wird wie gespeichert geliefert, der Client entpackt selbst
+                    line['content_encoding'] = message.content_encoding
+                    line['body_base64'] = base64.b64encode(body)
+                else:
+                    try:
+                        line['body'] = body.decode('utf-8')
+                    except UnicodeDecodeError:
+                        line['body_base64'] = base64.b64encode(body)
+            lines.append(json.dumps(line))
+        return lines
+
+    def _render_listing(self, message_queue_name, cursor, listing_format, lease=0):
+        """Erstellt die Liste der bereitstehenden Nachrichten im gegebenen Format.
+
+        Gibt ein dict mit dem Format, dem Dokument, dem Link-Header (oder None), der Anzahl der Nachrichten,
+        bei NDJSON den Nachrichten selbst und der zum Erstellen benötigten Zeit zurück. Die Retry-Intervalle
+        werden erst beim Ausliefern eingesetzt, siehe _serialize_listing.
+        """
+        start = time.time()
+        messages, next_cursor, more = self._fetch_messages(message_queue_name, cursor, lease)
+        document = {'messages': [self._message_as_dict(msg) for msg in messages]}
+        link = None
+        if more and next_cursor:
+            document['cursor'] = next_cursor
+            document['next_url'] = '%s?cursor=%s' % (self.request.path_url, document['cursor'])
+            if lease:
+                document['next_url'] += '&lease=%d' % lease
+            link = '<%s>; rel="next"' % document['next_url']
+        # Bodies werden erst beim Ausliefern eingebettet, siehe get
+        return {'format': listing_format, 'document': document, 'link': link, 'count': len(messages),
+                'messages': messages if listing_format == 'ndjson' else None, 'render_time': time.time() - start}
+
+    def _serialize_listing(self, listing, retry_interval):
+        """Gibt Content-Type und Body der Liste mit dem gegebenen Retry-Interval zurück."""
+        document = dict(listing['document'], min_retry_interval=retry_interval,
+                        max_retry_interval=self.max_retry_interval)
+        if listing['format'] == 'json':
+            return 'application/json', json.dumps(document)
+        elif listing['format'] == 'xml':
+            return 'application/xml', dict2xml(document, listnames={'messages': 'message'})
+        elif listing['format'] == 'ndjson':
+            return 'application/x-ndjson', '\n'.join(listing['lines'])
+        return 'text/plain', '\n'.join(x['url'] for x in document['messages'])
+
+    def check_budget(self, message_queue_name, polls):
+        """Gibt die Sekunden zurück, die ein Client warten muss, weil er sein Budget an Abrufen der Queue
+        überschritten hat, oder None. polls ist die Zahl seiner Abrufe in der laufenden Minute (oder None).
+
+        Erben können hier z.B. Budgets je Mandant prüfen, client_id bestimmt, wem die Abrufe zählen.
+        """
+        if self.max_polls_per_minute and polls and polls > self.max_polls_per_minute:
+            return 60 - int(time.time()) % 60
+        return None
+
+    def _get_listing(self, message_queue_name, cursor, listing_format, etag, stable):
+        """Gibt die Liste aus dem memcache zurück oder erstellt sie (siehe _render_listing).
+
+        Das ETag enthält die Version der Queue, eine gecachte Liste gilt also bis zur nächsten Änderung.
+        Ist die Version nicht stabil (siehe Storage.queue_version), wird die Liste nicht gecached.
+        """
+        listing = self.storage.cache_get('fmtp_listing:%s' % etag)
+        if listing is None:
+            listing = self._render_listing(message_queue_name, cursor, listing_format)
+            if stable:
+                self.storage.cache_set('fmtp_listing:%s' % etag, listing, LISTING_CACHE_TIME)
+        return listing
+
+    def _wait_for_change(self, message_queue_name, version, deadline):
+        """Wartet bis zur deadline, dass sich die Version der Queue ändert, und gibt die neue Version zurück."""
+        while time.time() < deadline:
+            time.sleep(self.wait_poll_interval)
+            current_version = self.storage.queue_version(message_queue_name)
+            if current_version != version:
+                return current_version
+        return version
+
     def get(self, message_queue_name):
         """ Liefert eine Übersicht über die Nachrichten in der Queue zurück.
 
-        Kann in JSON, XML, oder plaintext abgefragt werden.
-        Für eine Beschreibung des Formats siehe README.
+        Kann in JSON, XML, NDJSON mit eingebetteten Bodies oder plaintext abgefragt werden, die Formate werden
+        im Header X-FMTP-Listing-Formats angezeigt. Für eine Beschreibung der Formate siehe README.
+
+        Die Liste umfasst höchstens max_messages Nachrichten. Gibt es weitere, enthält die Antwort einen
+        Cursor, mit dem die nächste Seite abgerufen werden kann (siehe README/Blättern).
+
+        Die Antwort trägt ein ETag, das sich mit jeder Änderung der Queue ändert. Meldet der Client per
+        If-None-Match, dass er die aktuelle Liste hat, wird mit 304 Not Modified geantwortet
+        (siehe README/Conditional-GET).
+
+        Ist die Liste leer bzw. unverändert und der Parameter `wait` angegeben, wartet die Anfrage bis zu
+        `wait` Sekunden (höchstens max_wait) auf eine Änderung (siehe README/Long-Polling).
+
+        Mit dem Parameter `lease` werden die gelieferten Nachrichten für `lease` Sekunden (höchstens
+        max_lease) vor anderen Clients verborgen (siehe README/Leases). Solche Listen tragen kein ETag.
+
+        Wie lange der Client bis zur nächsten Anfrage warten soll, steht in min_retry_interval und im Header
+        X-FMTP-Retry-Interval (siehe get_retry_interval). Überschreitet die Queue ihr Budget, wird mit
+        429 Too Many Requests und Retry-After geantwortet (siehe check_budget).
         """
         self.on_access(message_queue_name)
-        query = Message.query(
-            Message.message_queue_name == message_queue_name, Message.deleted_at == None).order(
-            Message.created_at)
-        messages = query.fetch(self.max_messages)
+        polls, = self.count_polls([message_queue_name])
+        retry_after = self.check_budget(message_queue_name, polls)
+        if retry_after is not None:
+            self.response.headers['Retry-After'] = str(retry_after)
+            self.response.set_status(429, 'Too Many Requests')
+            return
+
+        cursor = self._get_cursor()
+        deadline = time.time() + self._get_wait()
+        lease = self._get_lease()
+        listing_format = self.get_listing_format()
+
+        # Die Version vor der Query lesen, damit keine Änderung zwischen Query und Warten verloren geht
+        version = self.storage.queue_version(message_queue_name)
+        while True:
+            etag, listing = None, None
+            if lease:
+                # Leasen verändert die Queue, die Liste darf weder gecached noch per ETag bestätigt werden
+                listing = self._render_listing(message_queue_name, cursor, listing_format, lease)
+            else:
+                etag = self._listing_etag(version, listing_format)
+                if not self.client_has_listing(etag):
+                    listing = self._get_listing(message_queue_name, cursor, listing_format, etag, version[1])
+            # Eine Seite kann leer sein, weil ihre Nachrichten geleast sind; dann gibt es aber eine nächste
+            if (listing and (listing['count'] or listing['link'])) or time.time() >= deadline:
+                break
+            version = self._wait_for_change(message_queue_name, version, deadline)
+
+        retry_interval = self.get_retry_interval(listing, polls)
+        self.response.headers['X-FMTP-Listing-Formats'] = ', '.join(self.listing_formats)
+        self.response.headers['X-FMTP-Retry-Interval'] = str(retry_interval)
+        if etag:
+            self.response.headers['ETag'] = '"%s"' % etag
+        if listing is None:
+            del self.response.headers['Content-Type']
+            self.response.set_status(304)  # not modified
+            return
+
+        metrics.observe('fmtp_listing_messages', listing['count'], buckets=COUNT_BUCKETS, format=listing['format'])
+        if listing['link']:
+            self.response.headers['Link'] = listing['link']
+        if listing['format'] == 'ndjson':
+            # Die Liste ist für alle Clients gecached, welche Bodies eingebettet werden, hängt aber vom
+            # Client ab (siehe _readable_guids)
+            listing = dict(listing, lines=self._inline_message_lines(message_queue_name, listing['messages']))
+        content_type, body = self._serialize_listing(listing, retry_interval)
+        self.response.headers["Content-Type"] = content_type
+        self.response.out.write(body)
+
+    def head(self, message_queue_name):
+        """Liefert die Statistik der Queue (siehe Storage.queue_stats) in Headern, ohne die Nachrichten zu
+        lesen:
+
+        - X-FMTP-Depth: Anzahl der nicht gelöschten Nachrichten, auch der geleasten,
+        - X-FMTP-Tombstones: Anzahl der gelöschten, noch nicht entfernten Nachrichten,
+        - X-FMTP-Bytes: Größe der gespeicherten Bodies der nicht gelöschten Nachrichten,
+        - X-FMTP-Oldest-Age: Alter der ältesten nicht gelöschten Nachricht in Sekunden, fehlt bei leerer Queue.
+        """
+        self.on_access(message_queue_name)
+        stats = self.storage.queue_stats(message_queue_name)
+        self.response.headers['X-FMTP-Depth'] = str(stats['live'])
+        self.response.headers['X-FMTP-Tombstones'] = str(stats['deleted'])
+        self.response.headers['X-FMTP-Bytes'] = str(stats['bytes'])
+        if stats['oldest_created_at']:
+            age = datetime.now() - stats['oldest_created_at']
+            self.response.headers['X-FMTP-Oldest-Age'] = str(max(0, age.days * 86400 + age.seconds))
+
+    def post(self, message_queue_name):
+        """Erstellt mehrere Nachrichten in der gegebenen queue.
+
+        Der Request enthält die Nachrichten im Format application/x-ndjson (siehe README/Stapelverarbeitung).
+        Für jede Nachricht gelten dieselben Regeln wie bei MessageHandler.post, die Antwort enthält zu jeder
+        guid den Status, den MessageHandler.post geliefert hätte:
+        - 201 Created, wenn die Nachricht erstellt wurde,
+        - 400 Bad Request, wenn das content_encoding unbekannt oder der Body nicht gzip-komprimiert ist,
+        - 403 Forbidden, wenn die guid ungültig ist,
+        - 409 Conflict, wenn eine Nachricht mit der guid schon existiert,
+        - 410 Gone, wenn eine Nachricht mit der guid schon existierte, aber gelöscht wurde.
 
-        document = {
-            'min_retry_interval': self.min_retry_interval,
-            'max_retry_interval': self.max_retry_interval,
-            'messages': [self._message_as_dict(msg) for msg in messages],
-        }
+        Ein Stapel kann höchstens max_post_messages Nachrichten enthalten, größere werden mit 400 Bad Request
+        abgelehnt. Die Nachrichten werden in der Reihenfolge des Stapels erstellt. Der Zugriff wird mit
+        on_batch_access('POST', ...) geprüft.
+        """
+        if not self.check_messagequeue_name(message_queue_name):
+            raise HTTP403_Forbidden('Ungueltiger queue-name: %r' % message_queue_name)
 
-        accept = self.request.headers.get('Accept', '')
+        results = []
+        candidates = []
+        seen = set()
+        for guid, content_type, body, content_encoding in self._parse_batch():
+            result = {'guid': guid, 'url': '%s/%s/' % (self.request.path_url.rstrip('/'), quote(guid))}
+            results.append(result)
+            if not re.match(self.guid_pattern, guid):
+                result['status'] = 403
+            elif guid in seen:
+                # Dublette innerhalb des Stapels
+                result['status'] = 409
+            elif content_encoding not in (None, 'gzip'):
+                result['status'] = 400
+            else:
+                seen.add(guid)
+                try:
+                    candidates.append((result, (guid, content_type) + self._storable_body(body, content_encoding)))
+                except HTTP400_BadRequest:
+                    result['status'] = 400
 
-        if accept.startswith('application/json'):
-            self.response.headers["Content-Type"] = 'application/json'
-            self.response.out.write(json.dumps(document))
-        elif accept.startswith('application/xml'):
-            self.response.headers["Content-Type"] = 'application/xml'
-            self.response.out.write(dict2xml(document, listnames={'messages': 'message'}))
-        else:
-            self.response.headers["Content-Type"] = 'text/plain'
-            self.response.out.write('\n'.join(x['url'] for x in document['messages']))
+        self.on_batch_access('POST', message_queue_name, [(item[0], None) for _result, item in candidates])
+        created = []
+        stored = self.storage.create_messages(message_queue_name, [item for _result, item in candidates])
+        for (result, _item), (status, message) in zip(candidates, stored):
+            result['status'] = status
+            if status == 201:
+                created.append(message)
 
+        self._emit_events('on_created', created)
 
-class MessageHandler(BasicHandler):
+        self.response.headers["Content-Type"] = 'application/json'
+        self.response.out.write(json.dumps({'messages': results}))
+
+    def delete(self, message_queue_name):
+        """Löscht mehrere Nachrichten in der gegebenen queue.
+
+        Der Request enthält die guids als JSON, z.B. {"guids": ["guid", "otherguid"]}
+        (siehe README/Stapelverarbeitung). Die Antwort enthält zu jeder guid den Status, den
+        MessageHandler.delete geliefert hätte:
+        - 204 No Content, wenn die Nachricht gelöscht wurde,
+        - 403 Forbidden, wenn die guid ungültig ist,
+        - 404 Not Found, wenn keine Nachricht mit der gegebenen guid in der queue gefunden wurde,
+        - 410 Gone, wenn eine entsprechende Nachricht existierte, aber bereits gelöscht wurde.
+
+        Ein Request kann höchstens max_delete_guids guids löschen. Der Zugriff wird mit
+        on_batch_access('DELETE', ...) geprüft, wie bei MessageHandler.delete mit den gelesenen Nachrichten.
+        """
+        if not self.check_messagequeue_name(message_queue_name):
+            raise HTTP403_Forbidden('Ungueltiger queue-name: %r' % message_queue_name)
+        try:
+            guids = json.loads(self.request.body)['guids']
+        except (ValueError, TypeError, KeyError):
+            guids = None
+        if not isinstance(guids, list) or not all(isinstance(guid, basestring) for guid in guids):
+            raise HTTP400_BadRequest('Erwarte {"guids": [...]} im Request.')
+        if len(guids) > self.max_delete_guids:
+            raise HTTP400_BadRequest('Es koennen hoechstens %d guids auf einmal geloescht werden.'
+                                     % self.max_delete_guids)
+        guids = [unicode(guid) for guid in guids]
+
+        results = []
+        deleted = []
+        # Jede gültige guid nur einmal löschen, Wiederholungen bekommen 410
+        unique_guids = sorted(set(guid for guid in guids if re.match(self.guid_pattern, guid)))
+        self.on_batch_access('DELETE', message_queue_name,
+                             zip(unique_guids, self.storage.get_messages(message_queue_name, unique_guids)))
+        statuses = dict((guid, 403) for guid in guids)
+        marked = self.storage.mark_deleted(message_queue_name, unique_guids, datetime.now())
+        for guid, (status, message) in zip(unique_guids, marked):
+            statuses[guid] = status
+            if status == 204:
+                deleted.append(message)
+
+        for guid in guids:
+            results.append({'guid': guid, 'status': statuses[guid]})
+            if statuses[guid] == 204:
+                statuses[guid] = 410
+
+        self._emit_events('on_deleted', deleted)
+
+        self.response.headers["Content-Type"] = 'application/json'
+        self.response.out.write(json.dumps({'messages': results}))
+
+
+class MessageHandler(MetricsMixin, MessageEventsMixin, BasicHandler):
     """Handler für individuelle Messages.
 
     Dieser Handler ist als Basisklasse vorgesehen, in dessen Erben zur Anpassung
@@ -115,49 +1697,37 @@ class MessageHandler(BasicHandler):
     * on_access,
     * on_created, und
     * on_deleted
+    * defer_events, on_created_batch und on_deleted_batch
     * check_messagequeue_name
+    * storage
+    * profile_sample_rate (siehe MetricsMixin)
 
 
     überschreiben werden können (siehe dort zur wozu).
     """
 
-    # Regulärer Ausdruck, dem die guids der Nachrichten entsprechen müssen
-    guid_pattern = r'^[a-zA-Z0-9_-]+$'
-
-    def _find_message(self, message_queue_name, guid):
-        """Gibt die message_queue_name und guid entsprechene Nachricht aus der DB zurück,
-        oder None, wenn keine solche existiert."""
-        query = Message.query(Message.guid == guid, Message.message_queue_name == message_queue_name)
-        return query.get()
-
-    def check_messagequeue_name(self, message_queue_name):
-        """Gibt True zurück, wenn message_queue_name ein erlaubter Name für eine MesssageQueue ist.
-        Per default sind alle Namen erlaubt.
-
-        Kann zur Anpassung überschrieben werden, z.B:
-
-        def is_allowed_message_queue_name(self, message_queue_name):
-            return message_queue_name in ['queue_a', 'queue_b']
-        """
-        return True
-
     def on_access(self, method, message_queue_name, guid, message):
         """Event, das beim Versuch, auf eine Nachricht zuzugreifen ausgelöst wird.
         method ist die HTTP-methode, message_queue_name und guid sind die Parameter
-        aus der URL, message die Nachricht oder None, wenn keine gefunden wurde.
+        aus der URL, message die Nachricht oder None, wenn keine gefunden wurde. Bei POST wird die Nachricht
+        vorher nicht gelesen, message ist dann immer None.
 
         Um den Zugriff auf Nachrichten zu kontrollieren, kann ggf. HTTP401_Unauthorized
-        geraised werden.
+        geraised werden. Braucht die Prüfung RPCs, darf on_access auch einen ndb.Future zurückgeben, dessen
+        Exception dann geraised wird. Bei GET wird der Body währenddessen schon gelesen. Siehe auch
+        fmtp_auth.AccessCache.
         """
         pass
 
-    def on_created(self, message):
-        """Event nach der Nachrichtenerstellung, z.B. für Auditlogs"""
-        pass
-
-    def on_deleted(self, message):
-        """Event nach der Nachrichtenlöschung, z.B. für AuditLogs"""
-        pass
+    def _check_not_existing(self, message_queue_name, guid, message):
+        """Wirft HTTP409_Conflict bzw. HTTP410_Gone, wenn message eine existierende Nachricht ist."""
+        if message:
+            if message.deleted_at:
+                raise HTTP410_Gone('Nachricht mit guid %r in der Queue %r wurde bereits am %s geloescht.'
+                                                             % (guid, message_queue_name, message.deleted_at))
+            else:
+                raise HTTP409_Conflict('Es existiert bereits eine Nachricht mit guid %r in der Queue %r.'
+                                                                                % (guid, message_queue_name))
 
     def get(self, message_queue_name, guid):
         """Gibt die Nachricht aus der gegebenen queue mit der gegebeben guid.
@@ -167,9 +1737,13 @@ class MessageHandler(BasicHandler):
         - 200 Ok, wenn die entsprechende Nachricht gefunden wurde,
         - 404 Not Found, wenn die Nachricht nicht gefunden wurde,
         - 410 Gone, wenn eine entsprechende Nachricht existierte, aber gelöscht wurde.
+
+        Der Body wird Stück für Stück gelesen und geschrieben, webapp2 puffert die Antwort aber vollständig.
         """
-        message = self._find_message(message_queue_name, guid)
-        self.on_access('GET', message_queue_name, guid, message)
+        message = self.storage.get_message(message_queue_name, guid)
+        # Das Lesen des Bodys beginnt schon vor der Zugriffsprüfung, siehe iter_body
+        parts = self.storage.iter_body(message) if message and not message.deleted_at else None
+        self._wait_for_events([self.on_access('GET', message_queue_name, guid, message)])
         if not message:
             raise HTTP404_NotFound('Es existiert keine Nachricht mit guid %r in der Queue %r.'
                                                                                 % (guid, message_queue_name))
@@ -180,19 +1754,27 @@ class MessageHandler(BasicHandler):
             self.response.headers["Content-Type"] = message.content_type.encode('utf-8')
         else:
             self.response.headers["Content-Type"] = 'application/octet-stream'
-        self.response.out.write(message.body)
+
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if message.content_encoding == 'gzip':
+            if self._accepts_gzip():
+                self.response.headers['Content-Encoding'] = 'gzip'
+            else:
+                parts = gzip_decompress_iter(parts)
+        for part in parts:
+            self.response.out.write(part)
 
     def post(self, message_queue_name, guid):
         """Erstellt eine Nachricht in der gegebenen queue mit der gegebenen guid.
         Bei der Erstellung wird der header 'Content-Type' beachtet.
 
         Mögliche Antworten sind:
-        - 204 No Content, wenn die Nachricht erstellt wurde, TODO: warum nicht 201?
+        - 201 Created, wenn die Nachricht erstellt wurde,
         - 409 Conflict, wenn eine Nachricht mit der guid schon existiert,
         - 410 Gone, wenn eine Nachricht mit der guid schon existierte, aber gelöscht wurde.
         """
-        message = self._find_message(message_queue_name, guid)
-        self.on_access('POST', message_queue_name, guid, message)
+        # Ob die Nachricht schon existiert, klärt erst die Transaktion in create_messages
+        access = self.on_access('POST', message_queue_name, guid, None)
 
         if not self.check_messagequeue_name(message_queue_name):
             raise HTTP403_Forbidden('Ungueltiger queue-name: %r' % message_queue_name)
@@ -200,20 +1782,14 @@ class MessageHandler(BasicHandler):
         if not re.match(self.guid_pattern, guid):
             raise HTTP403_Forbidden('Ungueltige guid: %r. guids muessen %r matchen.'
                                                                                   % (guid, self.guid_pattern))
-        if message:
-            if message.deleted_at:
-                raise HTTP410_Gone('Nachricht mit guid %r in der Queue %r wurde bereits am %s geloescht.'
-                                                             % (guid, message_queue_name, message.deleted_at))
-            else:
-                raise HTTP409_Conflict('Es existiert bereits eine Nachricht mit guid %r in der Queue %r.'
-                                                                                % (guid, message_queue_name))
-        message = Message.get_or_insert('%s/%s' % (message_queue_name, guid),
-                                        guid=guid,
-                                        body=self.request.body,
-                                        message_queue_name=message_queue_name,
-                                        content_type=self.request.headers.get('Content-Type'),
-                                        deleted_at=None)
-        self.on_created(message)
+        body, content_encoding = self._storable_body(self.request.body, self._get_request_encoding())
+        # Eine Zugriffsprüfung per RPC läuft während der Kompression
+        self._wait_for_events([access])
+        (status, message), = self.storage.create_messages(message_queue_name, [
+            (guid, self.request.headers.get('Content-Type'), body, content_encoding)])
+        if status != 201:
+            self._check_not_existing(message_queue_name, guid, message)
+        self._emit_events('on_created', [message])
         self.response.set_status(201)
 
     def delete(self, message_queue_name, guid):
@@ -223,82 +1799,275 @@ class MessageHandler(BasicHandler):
         - 404 Not Found, wenn keine Nachricht mit der gegebenen guid in der queue gefunden wurde,
         - 410 Gone, wenn eine entsprechende Nachricht existierte, aber bereits gelöscht wurde.
         """
-        message = self._find_message(message_queue_name, guid)
-        self.on_access('DELETE', message_queue_name, guid, message)
-        if not message:
+        message = self.storage.get_message(message_queue_name, guid)
+        self._wait_for_events([self.on_access('DELETE', message_queue_name, guid, message)])
+        if message and not message.deleted_at:
+            # Die Nachricht kann seit dem Lesen von einem anderen Request gelöscht worden sein
+            (status, message), = self.storage.mark_deleted(message_queue_name, [guid], datetime.now())
+        else:
+            status = 410 if message else 404
+        if status == 404:
             raise HTTP404_NotFound('Es existiert keine Nachricht mit guid %r in der Queue %r.'
                                                                                 % (guid, message_queue_name))
-        if message.deleted_at:
+        if status == 410:
             raise HTTP410_Gone('Nachricht mit guid %r in der Queue %r wurde bereits am %s geloescht.'
                                                              % (guid, message_queue_name, message.deleted_at))
-        message.deleted_at = datetime.now()
-        message.put()
-        self.on_deleted(message)
+        self._emit_events('on_deleted', [message])
 
         del self.response.headers['Content-Type']
         self.response.set_status(204)  # no content
 
 
-class AdminHandler(JsonResponseHandler):
+class SubscriptionHandler(MetricsMixin, ListingMixin, BasicHandler):
+    """Liefert die bereitstehenden Nachrichten mehrerer Queues in einer Liste, siehe README/Abonnements.
+
+    Die Queues werden mit dem wiederholbaren Parameter `queue` oder per `prefix` angegeben. Für jede Queue
+    gelten on_access und check_budget einer Instanz von queue_handler, jeder Abruf zählt also gegen das
+    Budget jeder abonnierten Queue.
+
+    Dieser Handler ist als Basisklasse vorgesehen, in dessen Erben zur Anpassung
+
+    * queue_handler (der Erbe von QueueHandler),
+    * queue_path, max_queues, max_messages und max_messages_per_queue,
+    * (min/max)_retry_interval, slow_listing_time (siehe ListingMixin), und
+    * storage
+
+    überschrieben werden können.
+    """
+
+    # Handler, dessen on_access und check_budget gelten
+    queue_handler = QueueHandler
+
+    # Speicher der Nachrichten, siehe fmtp_storage.Storage
+    storage = NdbStorage()
+
+    # Pfad, unter dem queue_handler die Queues bereitstellt. Daraus werden die URLs der Nachrichten gebildet.
+    queue_path = '/'
+
+    # Maximale Anzahl von Queues in einem Abonnement
+    max_queues = 100
+
+    # Maximale Anzahl von Nachrichten in der Liste, und je Queue
+    max_messages = 100
+    max_messages_per_queue = 10
+
+    def _get_queue_names(self):
+        """Gibt die sortierten Namen der abonnierten Queues zurück."""
+        names = set(name for name in self.request.get_all('queue') if name)
+        prefix = self.request.get('prefix')
+        if prefix:
+            # queue_names braucht auf App Engine eine Query über alle Nachrichten, daher wird gecached
+            all_names = self.storage.cache_get('fmtp_queue_names')
+            if all_names is None:
+                all_names = self.storage.queue_names()
+                self.storage.cache_set('fmtp_queue_names', all_names, QUEUE_NAMES_CACHE_TIME)
+            names.update(name for name in all_names if name.startswith(prefix))
+        elif not names:
+            raise HTTP400_BadRequest('Es muss queue oder prefix angegeben werden.')
+        if len(names) > self.max_queues:
+            raise HTTP400_BadRequest('Es koennen hoechstens %d Queues abonniert werden.' % self.max_queues)
+        return sorted(names)
+
+    def _message_as_dict(self, message_queue_name, message):
+        """Erstellt ein dict, das eine Nachricht in der Liste repräsentiert."""
+        return {
+            'url': '%s%s%s/%s/' % (self.request.host_url, self.queue_path, quote(message_queue_name),
+                                   quote(message.guid)),
+            'queue': message_queue_name,
+            'guid': message.guid,
+            'created_at': str(message.created_at),
+        }
+
+    def _render_listing(self, names):
+        """Erstellt die Liste als dict mit document, link, count und render_time, wie
+        QueueHandler._render_listing.
+
+        Je Queue werden höchstens max_messages_per_queue Nachrichten aufgenommen, damit eine volle Queue die
+        übrigen nicht verdrängt. Fehlen Nachrichten, ist `more` gesetzt und der Client soll sofort erneut
+        abrufen, nachdem er die gelieferten Nachrichten gelöscht hat.
+        """
+        start = time.time()
+        messages, more = [], False
+        for message_queue_name in names:
+            limit = min(self.max_messages_per_queue, self.max_messages - len(messages))
+            if limit <= 0:
+                more = True
+                break
+            page, _next_cursor, queue_more = self.storage.list_messages(message_queue_name, None, limit)
+            messages.extend(self._message_as_dict(message_queue_name, message) for message in page)
+            more = more or queue_more
+        document = {'messages': messages, 'queues': names, 'more': more}
+        return {'document': document, 'link': None, 'count': len(messages),
+                'render_time': time.time() - start}
+
+    def get(self):
+        """Liefert die bereitstehenden Nachrichten der abonnierten Queues, als JSON, XML oder plaintext.
+
+        Die Antwort trägt ein ETag aus den Versionen aller Queues. Meldet der Client per If-None-Match, dass
+        er die aktuelle Liste hat, wird mit 304 Not Modified geantwortet, ohne eine Queue abzufragen.
+
+        Der Abruf zählt für jede Queue wie ein Abruf ihrer Liste. Überschreitet eine der Queues ihr Budget
+        (siehe QueueHandler.check_budget), wird mit 429 Too Many Requests und Retry-After geantwortet.
+        """
+        handler = self.queue_handler(self.request, self.response)
+        names = self._get_queue_names()
+        for message_queue_name in names:
+            handler.on_access(message_queue_name)
+        polls = self.count_polls(names)
+        retry_after = [handler.check_budget(message_queue_name, count)
+                       for message_queue_name, count in zip(names, polls)]
+        retry_after = [seconds for seconds in retry_after if seconds is not None]
+        if retry_after:
+            self.response.headers['Retry-After'] = str(max(retry_after))
+            self.response.set_status(429, 'Too Many Requests')
+            return
+
+        listing_format = self.get_listing_format()
+        if listing_format == 'ndjson':
+            listing_format = 'json'
+        versions = [self.storage.queue_version(message_queue_name) for message_queue_name in names]
+        etag = hashlib.md5(repr((versions, listing_format, names, self.max_messages,
+                                 self.max_messages_per_queue))).hexdigest()
+        listing = None
+        if not self.client_has_listing(etag):
+            listing = self.storage.cache_get('fmtp_subscription:%s' % etag)
+            if listing is None:
+                listing = self._render_listing(names)
+                if all(stable for _version, stable in versions):
+                    self.storage.cache_set('fmtp_subscription:%s' % etag, listing, LISTING_CACHE_TIME)
+
+        # Wie bei QueueHandler, mit der am häufigsten abgerufenen Queue
+        retry_interval = self.get_retry_interval(listing, max([count for count in polls if count] or [None]))
+        self.response.headers['X-FMTP-Retry-Interval'] = str(retry_interval)
+        self.response.headers['ETag'] = '"%s"' % etag
+        if listing is None:
+            del self.response.headers['Content-Type']
+            self.response.set_status(304)  # not modified
+            return
+
+        metrics.observe('fmtp_listing_messages', listing['count'], buckets=COUNT_BUCKETS, format='subscription')
+        document = dict(listing['document'], min_retry_interval=retry_interval,
+                        max_retry_interval=self.max_retry_interval)
+        if listing_format == 'json':
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.out.write(json.dumps(document))
+        elif listing_format == 'xml':
+            self.response.headers['Content-Type'] = 'application/xml'
+            self.response.out.write(dict2xml(document, listnames={'messages': 'message', 'queues': 'queue'}))
+        else:
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('\n'.join(x['url'] for x in document['messages']))
+
+
+class AdminHandler(MetricsMixin, JsonResponseHandler):
     """Handler für die Administrative sicht auf eine MessageQueue.
 
     Dieser Handler ist als Basisklasse vorgesehen, in dessen Erben zur Anpassung
 
     * on_access,
     * max_messages
-    * retention_period_days
+    * retention_period_days bzw. get_retention_period_days (gilt auch für GarbageCollectionHandler)
+    * storage
+    * profile_sample_rate (siehe MetricsMixin)
 
     überschreiben werden können (siehe dort zur wozu).
     """
 
-    # Maximale Anzahl von Nachrichten, die angezeigt werden
+    # Maximale Anzahl von Nachrichten, die pro Seite angezeigt werden
     max_messages = 1000
 
     # Minimale Zeit in Tagen, die die gelöschten Nachrichten aufbewahrt werden sollen (also nicht garbage
     # collected werden dürfen)
-    retention_period_days = 7
+    retention_period_days = RETENTION_PERIOD_DAYS
+
+    # Speicher der Nachrichten, siehe fmtp_storage.Storage
+    storage = NdbStorage()
+
+    def _get_date(self, name):
+        """Gibt den Zeitpunkt aus dem Parameter `name` zurück (YYYY-MM-DD oder YYYY-MM-DD HH:MM:SS)."""
+        value = self.request.get(name)
+        if not value:
+            return None
+        for date_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise HTTP400_BadRequest('Ungueltiger Zeitpunkt fuer %s: %r' % (name, value))
+
+    def _get_filters(self):
+        """Gibt die Filter der Liste aus den Parametern als (status, created_after, created_before) zurück.
+
+        `status` ist 'all' (Vorgabe), 'live' oder 'deleted'. Gelöschte Nachrichten werden nach dem
+        Zeitpunkt der Löschung sortiert und lassen sich nicht zusätzlich nach created_at filtern, da der
+        Datastore Ungleichungen nur auf einem Property erlaubt.
+        """
+        status = self.request.get('status', 'all')
+        created_after = self._get_date('created_after')
+        created_before = self._get_date('created_before')
+        if status not in ('all', 'live', 'deleted'):
+            raise HTTP400_BadRequest('Ungueltiger status: %r' % status)
+        if status == 'deleted' and (created_after or created_before):
+            raise HTTP400_BadRequest('status=deleted kann nicht mit created_after/created_before '
+                                     'kombiniert werden.')
+        return status, created_after, created_before
 
     def get(self, message_queue_name):
         """Gibt eine Liste von [max_messages] zusammenfassungen von Nachrichten wieder.
 
-        Dabei werden auch gelöschte Nachrichten angezeigt.
+        Dabei werden auch gelöschte Nachrichten angezeigt, siehe _get_filters zu den Filtern. Geladen
+        werden nur die Metadaten der Nachrichten. Gibt es weitere Nachrichten, enthält die Antwort `cursor`
+        und `next_url` für die nächste Seite.
         """
         self.on_access(message_queue_name)
-        messages = Message.query().filter('message_queue_name =', message_queue_name)
-        return self.paginate(messages, self.max_messages, datanodename='messages',
-                                                          formatter=self._message_as_dict)
+        status, created_after, created_before = self._get_filters()
+        cursor = self.request.get('cursor') or None
+        try:
+            messages, next_cursor, more = self.storage.list_all_messages(
+                message_queue_name, status, created_after, created_before, cursor, self.max_messages)
+        except InvalidCursor:
+            raise HTTP400_BadRequest('Ungueltiger cursor: %r' % cursor)
+        result = {
+            'success': True,
+            'messages': [self._message_as_dict(message) for message in messages],
+        }
+        if more and next_cursor:
+            result['cursor'] = next_cursor
+            params = dict((name, self.request.get(name)) for name in
+                          ['status', 'created_after', 'created_before'] if self.request.get(name))
+            params['cursor'] = result['cursor']
+            result['next_url'] = '%s?%s' % (self.request.path_url, urllib.urlencode(sorted(params.items())))
+        result['garbage_collection'] = self.storage.garbage_collection_status(message_queue_name)
+        result['stats'] = self.storage.queue_stats(message_queue_name)
+        return result
 
     def delete(self, message_queue_name):
         """ Garbagecollected Nachrichten in der angegebenen Queue.
 
-        Löst das Ereignis on_access aus, und löscht alle Nachrichten, die vor nicht weniger als
-        `retention_period_days` Tagen als gelöscht markiert wurden (siehe `MessageHandler.delete`)
+        Löst das Ereignis on_access aus und startet im Hintergrund die Löschung aller Nachrichten, die vor
+        nicht weniger als `get_retention_period_days` Tagen als gelöscht markiert wurden (siehe
+        `MessageHandler.delete`). Läuft bereits eine GarbageCollection, wird nur deren Fortschritt gemeldet.
         """
         self.on_access(message_queue_name)
 
-        delete_before = datetime.now() - timedelta(days=self.retention_period_days)
-        messages = (Message.query()
-                           .filter('message_queue_name = ', message_queue_name)
-                           .filter('deleted_at !=', None)
-                           .filter('deleted_at <', delete_before))
-
-        collected = messages.count()
-        db.delete(messages)
-
-        return {
-            'success': True,
-            'deleted': collected,
-        }
+        delete_before = datetime.now() - timedelta(days=self.get_retention_period_days(message_queue_name))
+        result = self.storage.start_garbage_collection(message_queue_name, delete_before)
+        result['success'] = True
+        return result
 
     def on_access(self, message_queue_name):
         """Event, das beim Versuch, eine Messagequeue abzufragen ausgelöst wird.
         message_queue_name ist der Parameter aus der URL.
 
         Um den Zugriff zu kontrollieren, kann ggf. HTTP401_Unauthorized
-        geraised werden.
+        geraised werden, siehe auch fmtp_auth.AccessCache.
         """
         pass
 
+    def get_retention_period_days(self, message_queue_name):
+        """Gibt die Aufbewahrungsfrist gelöschter Nachrichten der Queue in Tagen zurück."""
+        return self.retention_period_days
+
     def _message_as_dict(self, message):
         """Formatiert eine message als JSON"""
         return {
@@ -309,3 +2078,148 @@ class AdminHandler(JsonResponseHandler):
             'deleted_at': message.deleted_at,
             'content_type': message.content_type,
         }
+
+
+class GarbageCollectionHandler(MetricsMixin, JsonResponseHandler):
+    """Startet die GarbageCollection für alle Queues, gedacht für den regelmäßigen Aufruf per cron.
+
+    Der Handler sollte in app.yaml mit `login: admin` geschützt werden, cron.yaml ruft ihn täglich auf. In
+    Erben können zur Anpassung
+
+    * admin_handler, max_age_days, oder je Queue
+    * get_retention_period_days und get_max_age_days
+
+    überschrieben werden.
+    """
+
+    # Handler, dessen get_retention_period_days die Aufbewahrungsfrist gelöschter Nachrichten bestimmt. So
+    # gilt für DELETE /admin/<queue>/ und die regelmäßige GarbageCollection dieselbe Frist.
+    admin_handler = AdminHandler
+
+    # Alter in Tagen, nach dem nicht abgerufene Nachrichten als gelöscht markiert werden. None: nie
+    max_age_days = None
+
+    # Speicher der Nachrichten, siehe fmtp_storage.Storage
+    storage = NdbStorage()
+
+    def get_retention_period_days(self, message_queue_name):
+        """Gibt die Aufbewahrungsfrist gelöschter Nachrichten der Queue in Tagen zurück, siehe admin_handler."""
+        return self.admin_handler(self.request, self.response).get_retention_period_days(message_queue_name)
+
+    def get_max_age_days(self, message_queue_name):
+        """Gibt das maximale Alter der Nachrichten der Queue in Tagen zurück, oder None für unbegrenzt.
+
+        Ältere Nachrichten werden ohne Abruf als gelöscht markiert, on_deleted wird dabei nicht ausgelöst.
+        """
+        return self.max_age_days
+
+    def get(self):
+        """Startet für jede Queue, in der Nachrichten existieren, eine GarbageCollection.
+
+        Gibt den Fortschritt je Queue zurück, siehe AdminHandler.delete.
+        """
+        now = datetime.now()
+        queues = {}
+        for message_queue_name in self.storage.queue_names():
+            delete_before = now - timedelta(days=self.get_retention_period_days(message_queue_name))
+            expire_before = None
+            max_age_days = self.get_max_age_days(message_queue_name)
+            if max_age_days is not None:
+                expire_before = now - timedelta(days=max_age_days)
+            queues[message_queue_name] = self.storage.start_garbage_collection(
+                message_queue_name, delete_before, expire_before)
+        return {'success': True, 'queues': queues}
+
+
+class EventHandler(MetricsMixin, JsonResponseHandler):
+    """Verarbeitet die mit defer_events zurückgestellten Events, gedacht für den regelmäßigen Aufruf per cron.
+
+    Die Events werden stapelweise geleast und an on_created_batch bzw. on_deleted_batch einer Instanz von
+    events_handler übergeben. Erst danach werden sie aus der Storage gelöscht; schlägt ein Stapel fehl, wird
+    er nach lease_seconds erneut geliefert. Jedes Event wird also mindestens einmal verarbeitet.
+
+    Der Handler sollte in app.yaml mit `login: admin` geschützt werden. In Erben müssen events_handler (der
+    Erbe von MessageHandler mit den Events) und storage gesetzt werden, anpassen lassen sich
+
+    * batch_size, lease_seconds und time_limit.
+    """
+
+    # Handler, dessen Events verarbeitet werden
+    events_handler = MessageHandler
+
+    # Speicher der Events, siehe fmtp_storage.Storage
+    storage = NdbStorage()
+
+    # Anzahl Events, die auf einmal geleast werden
+    batch_size = 100
+
+    # Zeit in Sekunden, nach der nicht verarbeitete Events erneut geliefert werden
+    lease_seconds = 60
+
+    # Zeit in Sekunden, nach der keine weiteren Stapel mehr geleast werden
+    time_limit = 50
+
+    def _process_events(self, handler, events):
+        """Übergibt die Events an den handler. Gibt die event_ids der verarbeiteten Events zurück."""
+        batches = {}
+        for event_id, payload in events:
+            event, messages = pickle.loads(payload)
+            batches.setdefault(event, []).append((event_id, messages))
+        processed = []
+        for event, entries in sorted(batches.items()):
+            if event not in ('on_created', 'on_deleted'):
+                logging.error('Unbekanntes Event %r', event)
+                continue
+            try:
+                getattr(handler, event + '_batch')([message for _id, messages in entries for message in messages])
+            except Exception:
+                logging.exception('%s fuer %d Events fehlgeschlagen', event, len(entries))
+            else:
+                processed.extend(event_id for event_id, _messages in entries)
+        return processed
+
+    def get(self):
+        """Verarbeitet zurückgestellte Events, bis keine mehr vorliegen oder time_limit erreicht ist.
+
+        Gibt die Zahl der verarbeiteten und der fehlgeschlagenen Events zurück.
+        """
+        handler = self.events_handler(self.request, self.response)
+        deadline = time.time() + self.time_limit
+        processed = failed = 0
+        while time.time() < deadline:
+            events = self.storage.lease_events(self.batch_size, self.lease_seconds)
+            done = self._process_events(handler, events)
+            self.storage.delete_events(done)
+            processed += len(done)
+            failed += len(events) - len(done)
+            if len(events) < self.batch_size or len(done) < len(events):
+                break
+        return {'success': True, 'processed': processed, 'failed': failed}
+
+
+class MetricsHandler(BasicHandler):
+    """Liefert die Messwerte der Instanz aus fmtp_metrics, siehe README/Metriken.
+
+    Per default im Prometheus-Textformat, mit `Accept: application/json` oder `?format=json` als JSON,
+    das zusätzlich die Profile einzelner Requests enthält (siehe MetricsMixin.profile_sample_rate).
+
+    Der Handler sollte in app.yaml mit `login: admin` geschützt werden oder on_access überschreiben.
+    """
+
+    def on_access(self):
+        """Event, das beim Abruf der Messwerte ausgelöst wird.
+
+        Um den Zugriff zu kontrollieren, kann ggf. HTTP401_Unauthorized geraised werden.
+        """
+        pass
+
+    def get(self):
+        """Gibt die Messwerte im Prometheus-Textformat oder als JSON zurück."""
+        self.on_access()
+        if (self.request.get('format') == 'json'
+            or 'application/json' in self.request.headers.get('Accept', '')):
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.out.write(json.dumps(metrics.as_dict()))
+        else:
+            self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            self.response.out.write(metrics.as_prometheus())
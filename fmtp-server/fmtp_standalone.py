@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/fmtp_standalone.py
+
+FMTP-Server ohne App Engine: ein HTTP/1.1-Server mit einer einzigen Event-Loop, der die Handler aus
+fmtp_server als WSGI-Anwendung bedient.
+
+Die Handler laufen unverändert, samt on_access, on_created, on_deleted, check_messagequeue_name und
+guid_pattern ihrer Erben. Verbindungen bleiben per keep-alive offen. Long-Polling-Anfragen (Parameter
+`wait`, siehe README/Long-Polling) belegen keinen Thread: der Server parkt sie, bis sich die Version der
+Queue in der Storage ändert oder die Wartezeit abläuft, und reicht sie erst dann ohne `wait` an die Handler
+weiter.
+
+Anfragen an langlaufende Handler (GarbageCollection und Events, siehe background_pattern) laufen in einem
+eigenen Thread, damit sie die Event-Loop nicht blockieren.
+
+Die Handler importieren weiterhin gaetk und das App Engine SDK, beide müssen also im Pfad liegen. Als
+Storage dient SqliteStorage, Datastore und memcache werden nicht benutzt.
+
+    python fmtp_standalone.py --database /var/lib/fmtp/messages.sqlite --port 8080
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+
+from cStringIO import StringIO
+import Queue
+import asynchat
+import asyncore
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+
+from fmtp_storage import InvalidCursor
+
+
+class ParkedRequest(object):
+    """Eine Long-Polling-Anfrage, die auf eine Änderung ihrer Queue wartet."""
+
+    def __init__(self, channel, environ, message_queue_name, cursor, deadline):
+        self.channel = channel
+        self.environ = environ
+        self.message_queue_name = message_queue_name
+        self.cursor = cursor
+        self.deadline = deadline
+        self.version = None
+
+
+class HttpChannel(asynchat.async_chat):
+    """Eine HTTP/1.1-Verbindung. Anfragen werden nacheinander beantwortet, die Verbindung bleibt offen,
+    solange der Client nicht um das Schließen bittet."""
+
+    # Maximale Größe des Request-Headers in Bytes
+    max_header_size = 64 * 1024
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.address = address
+        self.pending = []  # vollständig gelesene, noch nicht beantwortete Anfragen
+        self.busy = False  # True, solange eine Anfrage bearbeitet wird oder geparkt ist
+        self.broken = False  # True, nachdem mit einem Fehler geantwortet wurde
+        self._reset()
+
+    def _reset(self):
+        """Bereitet das Lesen des nächsten Request-Headers vor."""
+        self.buffer = []
+        self.environ = None
+        self.set_terminator('\r\n\r\n')
+
+    def _read_body(self):
+        """Bereitet das Lesen des Request-Bodys vor, oder antwortet mit einem Fehler, wenn er zu groß ist
+        bzw. Expect nicht erfüllt werden kann. Gibt False zurück, wenn es keinen Body zu lesen gibt."""
+        length = int(self.environ.get('CONTENT_LENGTH') or 0)
+        expect = self.environ.get('HTTP_EXPECT', '').lower()
+        if expect and expect != '100-continue':
+            self._reply_error('417 Expectation Failed')
+            return True
+        if length > self.server.max_body_size:
+            self._reply_error('413 Request Entity Too Large')
+            return True
+        if not length:
+            return False
+        if expect:
+            # Der Client wartet auf die Zusage, bevor er den Body sendet
+            self.push('HTTP/1.1 100 Continue\r\n\r\n')
+        self.set_terminator(length)
+        return True
+
+    def collect_incoming_data(self, data):
+        if self.broken:
+            return
+        self.buffer.append(data)
+        if self.environ is None and sum(len(part) for part in self.buffer) > self.max_header_size:
+            self._reply_error('431 Request Header Fields Too Large')
+
+    def found_terminator(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.broken:
+            return
+        if self.environ is None:
+            if not data.strip():
+                return  # Leerzeilen zwischen Requests ignorieren
+            self.environ = self._parse_header(data)
+            if self.environ is None or self._read_body():
+                return
+            data = ''
+        self.environ['wsgi.input'] = StringIO(data)
+        self.pending.append(self.environ)
+        self._reset()
+        self.process()
+
+    def _parse_header(self, data):
+        """Erstellt aus Request-Zeile und Headern das WSGI-environ, oder antwortet mit einem Fehler."""
+        lines = data.split('\r\n')
+        try:
+            method, uri, protocol = lines[0].split(' ', 2)
+        except ValueError:
+            self._reply_error('400 Bad Request')
+            return None
+        path, _, query = uri.partition('?')
+        environ = self.server.base_environ.copy()
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': self.address[0] if self.address else '',
+        })
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name, value = name.strip().upper().replace('-', '_'), value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            elif name:
+                key = 'HTTP_' + name
+                environ[key] = '%s,%s' % (environ[key], value) if key in environ else value
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            self._reply_error('411 Length Required')
+            return None
+        try:
+            int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._reply_error('400 Bad Request')
+            return None
+        return environ
+
+    def _keep_alive(self, environ):
+        """Gibt True zurück, wenn die Verbindung nach der Antwort offen bleiben soll."""
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ.get('SERVER_PROTOCOL') == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    def _reply_error(self, status):
+        """Antwortet mit einem Fehler und schließt die Verbindung."""
+        self.push('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status)
+        self.close_when_done()
+        self.pending = []
+        self.broken = self.busy = True  # keine weiteren Anfragen auf dieser Verbindung
+
+    def process(self):
+        """Bearbeitet die nächste wartende Anfrage, sofern gerade keine bearbeitet wird."""
+        if self.busy or not self.pending:
+            return
+        self.busy = True
+        self.server.handle_request(self, self.pending.pop(0))
+
+    def respond(self, environ, status, headers, body):
+        """Sendet die Antwort auf environ und macht mit der nächsten Anfrage weiter."""
+        keep_alive = self._keep_alive(environ)
+        names = set(name.lower() for name, _value in headers)
+        headers = [(name, value) for name, value in headers if name.lower() != 'connection']
+        if 'content-length' not in names:
+            headers.append(('Content-Length', str(len(body))))
+        headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        self.push('HTTP/1.1 %s\r\n%s\r\n\r\n' % (status, '\r\n'.join('%s: %s' % header for header in headers)))
+        if environ['REQUEST_METHOD'] != 'HEAD':
+            self.push(body)
+        if not keep_alive:
+            self.close_when_done()
+            return
+        self.busy = False
+        self.process()
+
+    def handle_close(self):
+        self.server.forget(self)
+        self.close()
+
+
+class FmtpServer(asyncore.dispatcher):
+    """Bedient eine WSGI-Anwendung mit FMTP-Handlern aus einer einzigen Event-Loop.
+
+    storage muss dieselbe Storage sein, die die Handler nutzen; über sie erkennt der Server, ob eine
+    Long-Polling-Anfrage geparkt werden muss. queue_pattern erkennt die URLs der Nachrichtenlisten,
+    background_pattern die URLs, deren Anfragen in einem eigenen Thread laufen. Request-Bodies über
+    max_body_size Bytes werden mit 413 abgelehnt.
+    """
+
+    def __init__(self, app, storage, host='', port=8080, queue_pattern=r'^/([^/]+)/$', max_wait=20,
+                 poll_interval=0.25, background_pattern=r'^/_fmtp/(gc|events)$', max_body_size=32 * 1024 * 1024):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.app = app
+        self.storage = storage
+        self.queue_pattern = re.compile(queue_pattern)
+        self.background_pattern = re.compile(background_pattern)
+        self.max_wait = max_wait
+        self.max_body_size = max_body_size
+        self.poll_interval = poll_interval
+        self.parked = {}  # Name der Queue -> geparkte Anfragen
+        self.finished = Queue.Queue()  # (channel, environ, Antwort) der Anfragen aus Hintergrund-Threads
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+        self.base_environ = {
+            'SCRIPT_NAME': '',
+            'SERVER_NAME': host or socket.gethostname(),
+            'SERVER_PORT': str(self.socket.getsockname()[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            HttpChannel(self, *pair)
+
+    def call_app(self, environ):
+        """Ruft die WSGI-Anwendung auf und gibt (status, headers, body) zurück."""
+        response = {}
+        output = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+            return output.append
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                output.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            # Ein Fehler in einem Handler darf die Event-Loop nicht beenden
+            traceback.print_exc(file=sys.stderr)
+            return '500 Internal Server Error', [('Content-Type', 'text/plain')], ''
+        return response['status'], response['headers'], ''.join(output)
+
+    def _get_long_poll(self, channel, environ):
+        """Gibt für Long-Polling-Anfragen auf Nachrichtenlisten ein ParkedRequest zurück, sonst None.
+
+        Der Parameter `wait` wird aus der Anfrage entfernt, damit die Handler nie selbst warten.
+        """
+        match = self.queue_pattern.match(environ['PATH_INFO'])
+        if environ['REQUEST_METHOD'] != 'GET' or not match:
+            return None
+        params = urlparse.parse_qsl(environ['QUERY_STRING'], keep_blank_values=True)
+        try:
+            wait = max(0, min(float(dict(params).get('wait') or 0), self.max_wait))
+        except ValueError:
+            return None  # der Handler antwortet mit 400
+        environ['QUERY_STRING'] = urllib.urlencode([(name, value) for name, value in params if name != 'wait'])
+        if not wait:
+            return None
+        return ParkedRequest(channel, environ, match.group(1), dict(params).get('cursor') or None,
+                             time.time() + wait)
+
+    def _call_in_background(self, channel, environ):
+        """Ruft die Anwendung in einem eigenen Thread auf, die Antwort sendet finish_background."""
+        def run():
+            self.finished.put((channel, environ, self.call_app(environ)))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def finish_background(self):
+        """Sendet die Antworten der im Hintergrund bearbeiteten Anfragen."""
+        while True:
+            try:
+                channel, environ, response = self.finished.get_nowait()
+            except Queue.Empty:
+                return
+            if channel.connected:
+                channel.respond(environ, *response)
+            self.check_parked()
+
+    def handle_request(self, channel, environ):
+        """Beantwortet eine Anfrage sofort, im Hintergrund oder parkt sie als Long-Polling-Anfrage."""
+        if self.background_pattern.match(environ['PATH_INFO']):
+            self._call_in_background(channel, environ)
+            return
+        request = self._get_long_poll(channel, environ)
+        if request is None:
+            channel.respond(environ, *self.call_app(environ))
+            if environ['REQUEST_METHOD'] != 'GET':
+                self.check_parked()
+        else:
+            self.attempt(request)
+
+    def attempt(self, request):
+        """Beantwortet eine Long-Polling-Anfrage, wenn es Nachrichten bzw. eine Änderung gibt oder die
+        Wartezeit abgelaufen ist, und parkt sie sonst (wieder)."""
+        # Die Version vor der Prüfung lesen, damit keine Änderung verloren geht
+        request.version = self.storage.queue_version(request.message_queue_name)
+        if time.time() < request.deadline:
+            try:
+                messages, _cursor, _more = self.storage.list_messages(request.message_queue_name,
+                                                                      request.cursor, 1)
+            except InvalidCursor:
+                messages = True  # der Handler antwortet mit 400
+            if not messages:
+                self.parked.setdefault(request.message_queue_name, []).append(request)
+                return
+        status, headers, body = self.call_app(request.environ)
+        if status.startswith('304') and time.time() < request.deadline:
+            self.parked.setdefault(request.message_queue_name, []).append(request)
+            return
+        request.channel.respond(request.environ, status, headers, body)
+
+    def check_parked(self):
+        """Nimmt geparkte Anfragen wieder auf, deren Queue sich geändert hat oder deren Zeit abgelaufen ist.
+
+        Die Version wird je Queue nur einmal gelesen, egal wie viele Anfragen auf sie warten.
+        """
+        now = time.time()
+        ready = []
+        for name, requests in self.parked.items():
+            version = self.storage.queue_version(name)
+            waiting = []
+            for request in requests:
+                if request.deadline > now and request.version == version:
+                    waiting.append(request)
+                else:
+                    ready.append(request)
+            if waiting:
+                self.parked[name] = waiting
+            else:
+                del self.parked[name]
+        for request in ready:
+            self.attempt(request)
+
+    def forget(self, channel):
+        """Verwirft die geparkten Anfragen einer geschlossenen Verbindung."""
+        for name, requests in self.parked.items():
+            requests = [request for request in requests if request.channel is not channel]
+            if requests:
+                self.parked[name] = requests
+            else:
+                del self.parked[name]
+
+    def serve_forever(self):
+        """Betreibt die Event-Loop, bis stop() aufgerufen wird.
+
+        poll() statt select() erlaubt mehr als 1024 offene Verbindungen.
+        """
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout=self.poll_interval, use_poll=True, map=self.socket_map, count=1)
+            self.finish_background()
+            self.check_parked()
+        asyncore.close_all(self.socket_map)
+
+    def stop(self):
+        """Beendet serve_forever nach dem aktuellen Durchlauf der Event-Loop."""
+        self.running = False
+
+
+def make_app(storage):
+    """Erstellt die WSGI-Anwendung mit den Standard-Handlern aus fmtp_server und der gegebenen Storage.
+
+    Wer die Handler anpasst, baut die Anwendung mit seinen Erben selbst und übergibt sie an FmtpServer.
+    """
+    from gaetk.webapp2 import WSGIApplication
+    import fmtp_server
+
+    class QueueHandler(fmtp_server.QueueHandler):
+        pass
+
+    class MessageHandler(fmtp_server.MessageHandler):
+        pass
+
+    QueueHandler.message_handler = MessageHandler
+
+    class AdminHandler(fmtp_server.AdminHandler):
+        pass
+
+    class GarbageCollectionHandler(fmtp_server.GarbageCollectionHandler):
+        admin_handler = AdminHandler
+
+    class EventHandler(fmtp_server.EventHandler):
+        events_handler = MessageHandler
+
+    class SubscriptionHandler(fmtp_server.SubscriptionHandler):
+        queue_handler = QueueHandler
+
+    for handler in (QueueHandler, MessageHandler, AdminHandler, GarbageCollectionHandler, EventHandler,
+                    SubscriptionHandler):
+        handler.storage = storage
+    return WSGIApplication([
+        ('/_fmtp/gc', GarbageCollectionHandler),
+        ('/_fmtp/events', EventHandler),
+        ('/_fmtp/metrics', fmtp_server.MetricsHandler),
+        ('/_fmtp/subscription', SubscriptionHandler),
+        ('/admin/([^/]+)/', AdminHandler),
+        ('/([^/]+)/', QueueHandler),
+        ('/([^/]+)/(.+)/', MessageHandler),
+    ])
+
+
+def main():
+    """Startet den Server mit SqliteStorage und den Standard-Handlern."""
+    import argparse
+    from fmtp_storage import SqliteStorage
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument('--database', required=True, help='Pfad der SQLite-Datenbank')
+    parser.add_argument('--host', default='', help='Adresse, auf der der Server lauscht')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-wait', type=float, default=20, help='Maximale Wartezeit beim Long-Polling')
+    parser.add_argument('--max-body-size', type=int, default=32 * 1024 * 1024,
+                        help='Maximale Größe eines Request-Bodys in Bytes')
+    args = parser.parse_args()
+
+    storage = SqliteStorage(args.database)
+    server = FmtpServer(make_app(storage), storage, args.host, args.port, max_wait=args.max_wait,
+                        max_body_size=args.max_body_size)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
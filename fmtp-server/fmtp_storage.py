@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/fmtp_storage.py
+
+Schnittstelle zur Speicherung von FMTP-Nachrichten und eine Implementierung auf Basis von SQLite.
+
+Die Handler in fmtp_server.py arbeiten nur gegen `Storage`. Auf App Engine wird `fmtp_server.NdbStorage`
+verwendet, für den Betrieb auf normalen Linux-Rechnern und für Benchmarks ohne GAE-Stubs `SqliteStorage`.
+Dieses Modul darf daher nichts aus google.appengine importieren.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class InvalidCursor(ValueError):
+    """Der übergebene Cursor stammt nicht von dieser Storage oder ist beschädigt."""
+
+
+class Storage(object):
+    """Schnittstelle, gegen die QueueHandler, MessageHandler und AdminHandler programmiert sind.
+
+    Nachrichten werden als Objekte mit den Attributen guid, message_queue_name, content_type,
+    content_encoding, content_hash, created_at, deleted_at und leased_until zurückgegeben. Cursor sind
+    Strings, die nur die Storage selbst interpretiert.
+    """
+
+    def create_messages(self, message_queue_name, items):
+        """Speichert Nachrichten, sofern in der Queue noch keine Nachricht mit ihrer guid existiert.
+
+        items ist eine Liste von (guid, content_type, body, content_encoding), der Body ist bereits so
+        kodiert, wie er gespeichert werden soll. Gibt zu jedem Item den HTTP-Status (201, 409 oder 410,
+        siehe MessageHandler.post) und die neue bzw. die bereits existierende Nachricht zurück.
+        Prüfung und Erstellung geschehen atomar.
+        """
+        raise NotImplementedError
+
+    def get_message(self, message_queue_name, guid):
+        """Gibt die Nachricht mit der guid in der Queue zurück, oder None, wenn keine solche existiert."""
+        raise NotImplementedError
+
+    def get_messages(self, message_queue_name, guids):
+        """Wie get_message für mehrere guids, gibt die Nachrichten (bzw. None) in der Reihenfolge der guids
+        zurück. Storages lesen die Nachrichten gemeinsam, nicht einzeln."""
+        raise NotImplementedError
+
+    def iter_body(self, message):
+        """Liefert den gespeicherten Body der Nachricht Stück für Stück.
+
+        Darf mit dem Lesen schon beim Aufruf beginnen, die Handler rufen iter_body daher so früh wie
+        möglich auf (z.B. vor MessageHandler.on_access).
+        """
+        raise NotImplementedError
+
+    def body_sizes(self, messages):
+        """Gibt die Größen der gespeicherten Bodies der Nachrichten zurück, ohne die Bodies zu lesen.
+        Ist die Größe einer Nachricht unbekannt, steht an ihrer Stelle None.
+        """
+        raise NotImplementedError
+
+    def mark_deleted(self, message_queue_name, guids, deleted_at):
+        """Markiert die Nachrichten mit den gegebenen guids als gelöscht und verwirft ihre Bodies.
+
+        Gibt zu jeder guid den HTTP-Status (204, 404 oder 410, siehe MessageHandler.delete) und die
+        Nachricht bzw. None zurück.
+        """
+        raise NotImplementedError
+
+    def list_messages(self, message_queue_name, cursor, limit):
+        """Gibt eine Seite der nicht gelöschten Nachrichten, nach created_at sortiert, zurück.
+
+        Gibt (messages, next_cursor, more) zurück. Wirft InvalidCursor bei ungültigem cursor.
+        Geleaste Nachrichten fehlen bis zum Ablauf ihrer Lease.
+        """
+        raise NotImplementedError
+
+    def lease_messages(self, message_queue_name, cursor, limit, lease_seconds):
+        """Wie list_messages, least die gelieferten Nachrichten aber für lease_seconds Sekunden.
+
+        Das Attribut leased_until der Nachrichten gibt das Ende der Lease an.
+        """
+        raise NotImplementedError
+
+    def list_all_messages(self, message_queue_name, status, created_after, created_before, cursor, limit):
+        """Gibt eine Seite aller Nachrichten für die Administration zurück, siehe AdminHandler.get.
+
+        status ist 'all', 'live' oder 'deleted'. Gelöschte Nachrichten werden nach deleted_at, alle
+        anderen nach created_at sortiert. Gibt (messages, next_cursor, more) zurück.
+        """
+        raise NotImplementedError
+
+    def queue_version(self, message_queue_name):
+        """Gibt (version, stable) zurück. version ändert sich mit jeder Änderung der Queue und, solange
+        Leases laufen, jede Sekunde.
+
+        stable ist False, solange eine Änderung womöglich noch nicht in list_messages sichtbar ist.
+        """
+        raise NotImplementedError
+
+    def queue_names(self):
+        """Gibt die Namen aller Queues zurück, in denen Nachrichten gespeichert sind."""
+        raise NotImplementedError
+
+    def queue_stats(self, message_queue_name):
+        """Gibt die Statistik der Queue als dict zurück, ohne die Nachrichten zu durchlaufen.
+
+        Das dict enthält live (Anzahl nicht gelöschter Nachrichten), deleted (Anzahl Tombstones), bytes
+        (Größe der gespeicherten Bodies nicht gelöschter Nachrichten) und oldest_created_at (Zeitpunkt der
+        Erstellung der ältesten nicht gelöschten Nachricht oder None).
+        """
+        raise NotImplementedError
+
+    def start_garbage_collection(self, message_queue_name, delete_before, expire_before=None):
+        """Startet das endgültige Entfernen der vor delete_before gelöschten Nachrichten der Queue.
+
+        Ist expire_before angegeben, werden zuvor alle vor expire_before erstellten, nicht gelöschten
+        Nachrichten als gelöscht markiert. Gibt den Fortschritt als dict zurück, siehe
+        garbage_collection_status.
+        """
+        raise NotImplementedError
+
+    def garbage_collection_status(self, message_queue_name):
+        """Gibt den Fortschritt der letzten GarbageCollection der Queue als dict zurück, oder None.
+
+        Das dict enthält status ('running' oder 'done'), deleted, delete_before, expired, expire_before,
+        started_at und updated_at.
+        """
+        raise NotImplementedError
+
+    def add_events(self, payloads):
+        """Stellt Events (Strings, siehe fmtp_server.MessageEventsMixin.defer_events) zur späteren
+        Verarbeitung ein."""
+        raise NotImplementedError
+
+    def lease_events(self, limit, lease_seconds):
+        """Gibt bis zu limit eingestellte Events als Liste von (event_id, payload) zurück.
+
+        Die Events werden für lease_seconds Sekunden verborgen. Werden sie bis dahin nicht mit delete_events
+        entfernt, werden sie erneut geliefert, jedes Event also mindestens einmal.
+        """
+        raise NotImplementedError
+
+    def delete_events(self, event_ids):
+        """Entfernt verarbeitete Events, siehe lease_events."""
+        raise NotImplementedError
+
+    def cache_get(self, key):
+        """Gibt einen zuvor mit cache_set abgelegten Wert zurück, oder None."""
+        return None
+
+    def cache_set(self, key, value, time):
+        """Legt einen Wert für höchstens time Sekunden ab. Storages ohne Cache ignorieren das."""
+        pass
+
+    def cache_incr(self, key, time):
+        """Erhöht den Zähler key um eins und gibt den neuen Wert zurück, oder None, wenn die Storage keinen
+        Cache hat. Ein neuer Zähler gilt für höchstens time Sekunden."""
+        return None
+
+    def cache_incr_multi(self, keys, time):
+        """Wie cache_incr für mehrere Zähler, gibt die neuen Werte in der Reihenfolge von keys zurück."""
+        return [self.cache_incr(key, time) for key in keys]
+
+
+class StoredMessage(object):
+    """Metadaten einer Nachricht aus SqliteStorage."""
+
+    def __init__(self, row):
+        self.id, self.message_queue_name, self.guid, self.content_type, self.content_encoding, \
+            self.content_hash, self.created_at, self.deleted_at, self.leased_until = row
+
+    def __unicode__(self):
+        """Repräsentation als Unicode-Objekt"""
+        return u'%s/%s' % (self.message_queue_name, self.guid)
+
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS messages (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           message_queue_name TEXT NOT NULL,
+           guid TEXT NOT NULL,
+           content_type TEXT NOT NULL,
+           content_encoding TEXT,
+           content_hash TEXT,
+           created_at timestamp NOT NULL,
+           deleted_at timestamp,
+           leased_until timestamp,
+           UNIQUE (message_queue_name, guid))''',
+    # Bodies liegen getrennt, damit Listen und Lookups keine Nutzdaten lesen
+    '''CREATE TABLE IF NOT EXISTS bodies (
+           message_id INTEGER PRIMARY KEY,
+           body BLOB NOT NULL)''',
+    # Version und Zähler je Queue, siehe queue_version und queue_stats
+    '''CREATE TABLE IF NOT EXISTS queues (
+           message_queue_name TEXT PRIMARY KEY,
+           version INTEGER NOT NULL,
+           leased_until timestamp,
+           live INTEGER NOT NULL DEFAULT 0,
+           deleted INTEGER NOT NULL DEFAULT 0,
+           bytes INTEGER NOT NULL DEFAULT 0)''',
+    '''CREATE TABLE IF NOT EXISTS garbage_collections (
+           message_queue_name TEXT PRIMARY KEY,
+           delete_before timestamp NOT NULL,
+           deleted INTEGER NOT NULL,
+           expire_before timestamp,
+           expired INTEGER NOT NULL DEFAULT 0,
+           done INTEGER NOT NULL,
+           started_at timestamp NOT NULL,
+           updated_at timestamp NOT NULL)''',
+    # Zurückgestellte Events, siehe Storage.add_events
+    '''CREATE TABLE IF NOT EXISTS events (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           payload BLOB NOT NULL,
+           leased_until timestamp)''',
+    # Nachrichtenliste: nur nicht gelöschte Nachrichten, in Reihenfolge der Erstellung
+    '''CREATE INDEX IF NOT EXISTS messages_live ON messages (message_queue_name, id)
+           WHERE deleted_at IS NULL''',
+    # Admin-Liste der gelöschten Nachrichten und GarbageCollection
+    '''CREATE INDEX IF NOT EXISTS messages_deleted ON messages (message_queue_name, deleted_at, id)
+           WHERE deleted_at IS NOT NULL''',
+    # Admin-Liste nach created_at
+    '''CREATE INDEX IF NOT EXISTS messages_created ON messages (message_queue_name, created_at, id)''',
+]
+
+# Spalten, die in Datenbanken älterer Versionen noch fehlen
+_ADDED_COLUMNS = [
+    ('messages', 'leased_until', 'timestamp'),
+    ('queues', 'leased_until', 'timestamp'),
+    ('messages', 'content_hash', 'TEXT'),
+    ('garbage_collections', 'expire_before', 'timestamp'),
+    ('garbage_collections', 'expired', 'INTEGER NOT NULL DEFAULT 0'),
+    ('queues', 'live', 'INTEGER NOT NULL DEFAULT 0'),
+    ('queues', 'deleted', 'INTEGER NOT NULL DEFAULT 0'),
+    ('queues', 'bytes', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# Zählt die Zähler der Queues neu, wenn sie einer älteren Datenbank hinzugefügt wurden
+_RECOUNT = [
+    '''INSERT OR IGNORE INTO queues (message_queue_name, version)
+           SELECT DISTINCT message_queue_name, 0 FROM messages''',
+    '''UPDATE queues SET
+           live = (SELECT COUNT(*) FROM messages WHERE messages.message_queue_name = queues.message_queue_name
+                   AND deleted_at IS NULL),
+           deleted = (SELECT COUNT(*) FROM messages WHERE messages.message_queue_name = queues.message_queue_name
+                      AND deleted_at IS NOT NULL),
+           bytes = (SELECT COALESCE(SUM(LENGTH(body)), 0) FROM messages JOIN bodies ON message_id = id
+                    WHERE messages.message_queue_name = queues.message_queue_name AND deleted_at IS NULL)''',
+]
+
+# Höchstzahl der guids in einer IN-Klausel, ältere SQLite-Versionen erlauben nur 999 Parameter
+GUIDS_PER_QUERY = 500
+
+_COLUMNS = ('id, message_queue_name, guid, content_type, content_encoding, content_hash, created_at, deleted_at,'
+            ' leased_until')
+
+
+class SqliteStorage(Storage):
+    """Speichert Nachrichten in einer SQLite-Datenbank im WAL-Modus.
+
+    Jeder Thread bekommt eine eigene Verbindung. Im WAL-Modus blockieren Leser die Schreiber nicht,
+    geschrieben wird in kurzen `BEGIN IMMEDIATE`-Transaktionen. Alle Statements sind parametrisiert, so
+    dass sqlite3 sie vorbereitet im Statement-Cache hält.
+    """
+
+    # Anzahl Nachrichten, die die GarbageCollection in einer Transaktion löscht.
+    gc_batch_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.executescript(';\n'.join(_SCHEMA))
+        added = []
+        for table, column, column_type in _ADDED_COLUMNS:
+            if column not in [row[1] for row in connection.execute('PRAGMA table_info(%s)' % table)]:
+                connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, column_type))
+                added.append((table, column))
+        if ('queues', 'live') in added:
+            self._write(lambda connection: [connection.execute(sql) for sql in _RECOUNT])
+
+    def _connection(self):
+        """Gibt die Verbindung des aktuellen Threads zurück und legt sie bei Bedarf an."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, cached_statements=200,
+                                         detect_types=sqlite3.PARSE_DECLTYPES)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA busy_timeout=5000')
+            self._local.connection = connection
+        return connection
+
+    def _write(self, func, *args):
+        """Führt func(connection, *args) in einer Schreibtransaktion aus und gibt das Ergebnis zurück."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(connection, *args)
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def _touch_queue(connection, message_queue_name):
+        """Erhöht die Version der Queue, siehe queue_version."""
+        connection.execute('INSERT OR IGNORE INTO queues (message_queue_name, version) VALUES (?, 0)',
+                           (message_queue_name,))
+        connection.execute('UPDATE queues SET version = version + 1 WHERE message_queue_name = ?',
+                           (message_queue_name,))
+
+    @staticmethod
+    def _add_to_counters(connection, message_queue_name, live=0, deleted=0, bytes=0):
+        """Ändert die Zähler der Queue, siehe queue_stats."""
+        connection.execute('INSERT OR IGNORE INTO queues (message_queue_name, version) VALUES (?, 0)',
+                           (message_queue_name,))
+        connection.execute('UPDATE queues SET live = live + ?, deleted = deleted + ?, bytes = bytes + ?'
+                           ' WHERE message_queue_name = ?', (live, deleted, bytes, message_queue_name))
+
+    @staticmethod
+    def _body_sizes(connection, message_ids):
+        """Gibt die Summe der Größen der Bodies der Nachrichten zurück."""
+        if not message_ids:
+            return 0
+        return connection.execute('SELECT COALESCE(SUM(LENGTH(body)), 0) FROM bodies WHERE message_id IN (%s)'
+                                  % ', '.join('?' * len(message_ids)), message_ids).fetchone()[0]
+
+    @staticmethod
+    def _select_message(connection, message_queue_name, guid):
+        """Liest die Nachricht mit der guid in der Queue oder gibt None zurück."""
+        row = connection.execute('SELECT %s FROM messages WHERE message_queue_name = ? AND guid = ?'
+                                 % _COLUMNS, (message_queue_name, guid)).fetchone()
+        return StoredMessage(row) if row else None
+
+    def create_messages(self, message_queue_name, items):
+        """Speichert alle Nachrichten in einer Transaktion, siehe Storage.create_messages."""
+        def create(connection):
+            results = []
+            created_at = datetime.now()
+            for guid, content_type, body, content_encoding in items:
+                content_hash = hashlib.sha1(body).hexdigest()
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO messages (message_queue_name, guid, content_type, content_encoding,'
+                    ' content_hash, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (message_queue_name, guid, content_type, content_encoding, content_hash, created_at))
+                if cursor.rowcount:
+                    connection.execute('INSERT INTO bodies (message_id, body) VALUES (?, ?)',
+                                       (cursor.lastrowid, sqlite3.Binary(body)))
+                    self._add_to_counters(connection, message_queue_name, live=1, bytes=len(body))
+                    results.append((201, StoredMessage((cursor.lastrowid, message_queue_name, guid, content_type,
+                                                        content_encoding, content_hash, created_at, None,
+                                                        None))))
+                else:
+                    message = self._select_message(connection, message_queue_name, guid)
+                    results.append((410 if message.deleted_at else 409, message))
+            if [status for status, _message in results if status == 201]:
+                self._touch_queue(connection, message_queue_name)
+            return results
+        return self._write(create)
+
+    def get_message(self, message_queue_name, guid):
+        """Siehe Storage.get_message."""
+        return self._select_message(self._connection(), message_queue_name, guid)
+
+    def get_messages(self, message_queue_name, guids):
+        """Siehe Storage.get_messages, mit einer Query je GUIDS_PER_QUERY guids."""
+        messages = {}
+        for start in range(0, len(guids), GUIDS_PER_QUERY):
+            chunk = list(guids[start:start + GUIDS_PER_QUERY])
+            rows = self._connection().execute(
+                'SELECT %s FROM messages WHERE message_queue_name = ? AND guid IN (%s)'
+                % (_COLUMNS, ', '.join('?' * len(chunk))), [message_queue_name] + chunk)
+            messages.update((message.guid, message) for message in (StoredMessage(row) for row in rows))
+        return [messages.get(guid) for guid in guids]
+
+    def iter_body(self, message):
+        """Siehe Storage.iter_body."""
+        row = self._connection().execute('SELECT body FROM bodies WHERE message_id = ?',
+                                         (message.id,)).fetchone()
+        if row:
+            yield str(row[0])
+
+    def body_sizes(self, messages):
+        """Siehe Storage.body_sizes, mit einer Query für alle Nachrichten."""
+        if not messages:
+            return []
+        sizes = dict(self._connection().execute(
+            'SELECT message_id, LENGTH(body) FROM bodies WHERE message_id IN (%s)'
+            % ', '.join('?' * len(messages)), [message.id for message in messages]))
+        return [sizes.get(message.id, 0) for message in messages]
+
+    def mark_deleted(self, message_queue_name, guids, deleted_at):
+        """Markiert alle Nachrichten in einer Transaktion als gelöscht, siehe Storage.mark_deleted."""
+        def mark(connection):
+            results = []
+            for guid in guids:
+                message = self._select_message(connection, message_queue_name, guid)
+                if message is None:
+                    results.append((404, None))
+                elif message.deleted_at:
+                    results.append((410, message))
+                else:
+                    connection.execute('UPDATE messages SET deleted_at = ? WHERE id = ?',
+                                       (deleted_at, message.id))
+                    self._add_to_counters(connection, message_queue_name, live=-1, deleted=1,
+                                          bytes=-self._body_sizes(connection, [message.id]))
+                    # Der Tombstone braucht keinen Body mehr
+                    connection.execute('DELETE FROM bodies WHERE message_id = ?', (message.id,))
+                    message.deleted_at = deleted_at
+                    results.append((204, message))
+            if [status for status, _message in results if status == 204]:
+                self._touch_queue(connection, message_queue_name)
+            return results
+        return self._write(mark)
+
+    @staticmethod
+    def _parse_cursor(cursor, parts):
+        """Zerlegt einen Cursor aus list_messages bzw. list_all_messages."""
+        if not cursor:
+            return None
+        values = cursor.split('|')
+        if len(values) != parts:
+            raise InvalidCursor(cursor)
+        try:
+            return values[:-1] + [int(values[-1])]
+        except ValueError:
+            raise InvalidCursor(cursor)
+
+    def _fetch_page(self, connection, sql, params, limit, make_cursor):
+        """Führt die Query mit limit + 1 aus und gibt (messages, next_cursor, more) zurück."""
+        rows = connection.execute(sql + ' LIMIT ?', params + [limit + 1]).fetchall()
+        messages = [StoredMessage(row) for row in rows[:limit]]
+        more = len(rows) > limit
+        next_cursor = make_cursor(messages[-1]) if messages else None
+        return messages, next_cursor, more
+
+    def _list_live(self, connection, message_queue_name, cursor, limit):
+        """Gibt eine Seite der nicht gelöschten und nicht geleasten Nachrichten zurück.
+
+        Der Cursor ist die id der letzten gelieferten Nachricht.
+        """
+        position = self._parse_cursor(cursor, 1)
+        return self._fetch_page(
+            connection,
+            'SELECT %s FROM messages WHERE message_queue_name = ? AND deleted_at IS NULL AND id > ?'
+            ' AND (leased_until IS NULL OR leased_until <= ?) ORDER BY id' % _COLUMNS,
+            [message_queue_name, position[0] if position else 0, datetime.now()], limit,
+            lambda message: str(message.id))
+
+    def list_messages(self, message_queue_name, cursor, limit):
+        """Siehe Storage.list_messages."""
+        return self._list_live(self._connection(), message_queue_name, cursor, limit)
+
+    def lease_messages(self, message_queue_name, cursor, limit, lease_seconds):
+        """Siehe Storage.lease_messages. Lesen und Leasen geschehen in einer Transaktion."""
+        def lease(connection):
+            messages, next_cursor, more = self._list_live(connection, message_queue_name, cursor, limit)
+            if messages:
+                leased_until = datetime.now() + timedelta(seconds=lease_seconds)
+                connection.executemany('UPDATE messages SET leased_until = ? WHERE id = ?',
+                                       [(leased_until, message.id) for message in messages])
+                for message in messages:
+                    message.leased_until = leased_until
+                self._touch_queue(connection, message_queue_name)
+                connection.execute(
+                    'UPDATE queues SET leased_until = ? WHERE message_queue_name = ?'
+                    ' AND (leased_until IS NULL OR leased_until < ?)',
+                    (leased_until, message_queue_name, leased_until))
+            return messages, next_cursor, more
+        return self._write(lease)
+
+    def list_all_messages(self, message_queue_name, status, created_after, created_before, cursor, limit):
+        """Siehe Storage.list_all_messages.
+
+        Der Cursor ist Sortierkriterium und id der letzten gelieferten Nachricht.
+        """
+        if status == 'deleted':
+            sort_column, conditions, params = 'deleted_at', ['deleted_at IS NOT NULL'], []
+        else:
+            sort_column, conditions, params = 'created_at', [], []
+            if status == 'live':
+                conditions.append('deleted_at IS NULL')
+        if created_after:
+            conditions.append('created_at >= ?')
+            params.append(created_after)
+        if created_before:
+            conditions.append('created_at < ?')
+            params.append(created_before)
+        position = self._parse_cursor(cursor, 2)
+        if position:
+            # Der Zeitpunkt im Cursor wird als Text mit dem gespeicherten Wert verglichen
+            conditions.append('(%s > ? OR (%s = ? AND id > ?))' % (sort_column, sort_column))
+            params.extend([position[0], position[0], position[1]])
+
+        sql = 'SELECT %s FROM messages WHERE %s ORDER BY %s, id' % (
+            _COLUMNS, ' AND '.join(['message_queue_name = ?'] + conditions), sort_column)
+        return self._fetch_page(self._connection(), sql, [message_queue_name] + params, limit,
+                                lambda message: '%s|%d' % (getattr(message, sort_column), message.id))
+
+    def queue_version(self, message_queue_name):
+        """Siehe Storage.queue_version. SQLite ist konsistent, die Version ist also immer stabil."""
+        row = self._connection().execute('SELECT version, leased_until FROM queues WHERE message_queue_name = ?',
+                                         (message_queue_name,)).fetchone()
+        if row is None:
+            return (0, True)
+        if row[1] and row[1] > datetime.now():
+            # Ablaufende Leases ändern die Liste, ohne dass jemand schreibt
+            return ((row[0], int(time.time())), True)
+        return (row[0], True)
+
+    def queue_stats(self, message_queue_name):
+        """Siehe Storage.queue_stats. Die Zähler werden in den Transaktionen der Änderungen fortgeschrieben."""
+        connection = self._connection()
+        row = connection.execute('SELECT live, deleted, bytes FROM queues WHERE message_queue_name = ?',
+                                 (message_queue_name,)).fetchone() or (0, 0, 0)
+        oldest = connection.execute(
+            'SELECT created_at FROM messages WHERE message_queue_name = ? AND deleted_at IS NULL ORDER BY id LIMIT 1',
+            (message_queue_name,)).fetchone()
+        return {'live': row[0], 'deleted': row[1], 'bytes': row[2], 'oldest_created_at': oldest and oldest[0]}
+
+    def queue_names(self):
+        """Siehe Storage.queue_names."""
+        return [row[0] for row in self._connection().execute(
+            'SELECT DISTINCT message_queue_name FROM messages ORDER BY message_queue_name')]
+
+    def start_garbage_collection(self, message_queue_name, delete_before, expire_before=None):
+        """Markiert abgelaufene und entfernt gelöschte Nachrichten sofort, in Transaktionen von je
+        gc_batch_size Nachrichten.
+
+        Nach jedem Stapel wird der Fortschritt gespeichert, so dass andere Zugriffe nicht lange warten.
+        """
+        now = datetime.now()
+        self._write(lambda connection: connection.execute(
+            'INSERT OR REPLACE INTO garbage_collections (message_queue_name, delete_before, deleted,'
+            ' expire_before, expired, done, started_at, updated_at) VALUES (?, ?, 0, ?, 0, 0, ?, ?)',
+            (message_queue_name, delete_before, expire_before, now, now)))
+
+        def expire(connection):
+            ids = [(row[0],) for row in connection.execute(
+                'SELECT id FROM messages WHERE message_queue_name = ? AND deleted_at IS NULL'
+                ' AND created_at < ? ORDER BY id LIMIT ?',
+                (message_queue_name, expire_before, self.gc_batch_size))]
+            connection.executemany('UPDATE messages SET deleted_at = ? WHERE id = ?',
+                                   [(now, message_id) for message_id, in ids])
+            self._add_to_counters(connection, message_queue_name, live=-len(ids), deleted=len(ids),
+                                  bytes=-self._body_sizes(connection, [message_id for message_id, in ids]))
+            connection.executemany('DELETE FROM bodies WHERE message_id = ?', ids)
+            connection.execute(
+                'UPDATE garbage_collections SET expired = expired + ?, updated_at = ?'
+                ' WHERE message_queue_name = ?',
+                (len(ids), datetime.now(), message_queue_name))
+            if ids:
+                self._touch_queue(connection, message_queue_name)
+            return len(ids)
+
+        if expire_before:
+            while self._write(expire) == self.gc_batch_size:
+                pass
+
+        def collect(connection):
+            ids = [(row[0],) for row in connection.execute(
+                'SELECT id FROM messages WHERE message_queue_name = ? AND deleted_at IS NOT NULL'
+                ' AND deleted_at < ? ORDER BY deleted_at LIMIT ?',
+                (message_queue_name, delete_before, self.gc_batch_size))]
+            connection.executemany('DELETE FROM bodies WHERE message_id = ?', ids)
+            connection.executemany('DELETE FROM messages WHERE id = ?', ids)
+            self._add_to_counters(connection, message_queue_name, deleted=-len(ids))
+            connection.execute(
+                'UPDATE garbage_collections SET deleted = deleted + ?, done = ?, updated_at = ?'
+                ' WHERE message_queue_name = ?',
+                (len(ids), len(ids) < self.gc_batch_size, datetime.now(), message_queue_name))
+            return len(ids)
+
+        while self._write(collect) == self.gc_batch_size:
+            pass
+        return self.garbage_collection_status(message_queue_name)
+
+    def add_events(self, payloads):
+        """Siehe Storage.add_events."""
+        def add(connection):
+            connection.executemany('INSERT INTO events (payload) VALUES (?)',
+                                   [(sqlite3.Binary(payload),) for payload in payloads])
+        self._write(add)
+
+    def lease_events(self, limit, lease_seconds):
+        """Siehe Storage.lease_events. Events werden in der Reihenfolge ihres Einstellens geliefert."""
+        def lease(connection):
+            now = datetime.now()
+            rows = connection.execute('SELECT id, payload FROM events WHERE leased_until IS NULL'
+                                      ' OR leased_until < ? ORDER BY id LIMIT ?', (now, limit)).fetchall()
+            connection.executemany('UPDATE events SET leased_until = ? WHERE id = ?',
+                                   [(now + timedelta(seconds=lease_seconds), row[0]) for row in rows])
+            return [(row[0], str(row[1])) for row in rows]
+        return self._write(lease)
+
+    def delete_events(self, event_ids):
+        """Siehe Storage.delete_events."""
+        def delete(connection):
+            connection.executemany('DELETE FROM events WHERE id = ?', [(event_id,) for event_id in event_ids])
+        self._write(delete)
+
+    def garbage_collection_status(self, message_queue_name):
+        """Siehe Storage.garbage_collection_status."""
+        row = self._connection().execute(
+            'SELECT deleted, done, delete_before, started_at, updated_at, expired, expire_before'
+            ' FROM garbage_collections WHERE message_queue_name = ?', (message_queue_name,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'status': 'done' if row[1] else 'running',
+            'deleted': row[0],
+            'delete_before': row[2],
+            'expired': row[5],
+            'expire_before': row[6],
+            'started_at': row[3],
+            'updated_at': row[4],
+        }
@@ -7,14 +7,24 @@ Created by Philipp Benjamin Köppechen on 2011-03-01.
 Copyright (c) 2010 HUDORA. All rights reserved.
 """
 from datetime import datetime, timedelta
+import base64
+import hashlib
+import os
 import unittest
 
+from gaetk.handler import HTTP401_Unauthorized
 from gaetk.webapp2 import WSGIApplication
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from webtest import TestApp
 from mock import Mock
 from huTools import hujson as json
 
-from fmtp_server import Message, MessageHandler, QueueHandler, AdminHandler, db
+import fmtp_server
+from fmtp_server import gzip_compress, gzip_decompress
+from fmtp_server import Message, MessageChunk, MessageHandler, QueueHandler, AdminHandler, GarbageCollection
+from fmtp_server import QueueCounterShard
+from fmtp_server import EventHandler, GarbageCollectionHandler, MetricsHandler, SubscriptionHandler
 
 
 class DbTestCase(unittest.TestCase):
@@ -29,15 +39,21 @@ class DbTestCase(unittest.TestCase):
         ], debug=True))
 
         # clear all Fixtures
-        for cls in [Message]:
-            db.delete(cls.all())
+        for cls in [Message, QueueCounterShard]:
+            ndb.delete_multi(cls.query().fetch(keys_only=True))
+        memcache.flush_all()
 
-        db.put(self.fixtures())
+        # Nachrichten werden wie von MessageHandler.post unter ihrem Key gespeichert
+        fixtures = list(self.fixtures())
+        for entity in fixtures:
+            if isinstance(entity, Message):
+                entity.key = Message.make_key(entity.message_queue_name, entity.guid)
+        ndb.put_multi(fixtures)
 
     def fixtures(self):
         """Überschreiben, um vor den Tests Datenbankfixtures anzulegen.
 
-        Muss ein Iterable aus db.Model zurückgeben
+        Muss ein Iterable aus ndb.Model zurückgeben
         """
         return []
 
@@ -107,9 +123,23 @@ class TestMessageHandlerDelete(DbTestCase):
         """Nachrichten müssen korrekt gelöscht werden."""
         self.app.delete('/somequeue/killme/', status=204)
 
-        msg, = Message.all()
+        msg, = Message.query()
         self.assertNotEqual(msg.deleted_at, None)
 
+    def test_keeps_tombstone_without_body(self):
+        """Gelöschte Nachrichten behalten nur ihre Metadaten, erneutes Einstellen ergibt weiterhin 410."""
+        self.app.post('/somequeue/tombstone/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.app.delete('/somequeue/tombstone/', status=204)
+        self.app.delete('/somequeue/killme/', status=204)
+
+        for guid in ['tombstone', 'killme']:
+            msg = Message.make_key('somequeue', guid).get()
+            self.assertEqual((msg.body, msg.chunks), (None, []))
+            self.assertEqual(MessageChunk.query(ancestor=msg.key).count(), 0)
+        self.assertEqual(Message.make_key('somequeue', 'tombstone').get().content_hash,
+                         hashlib.sha1('body').hexdigest())
+        self.app.post('/somequeue/tombstone/', 'body', {'Content-Type': 'text/plain'}, status=410)
+
     def test_responds_404_if_no_such_message_exists(self):
         """Antwortet http-conform, wenn Nachrichten nicht gefunden werden."""
         # no such guid
@@ -160,13 +190,13 @@ class TestMessageHandlerPost(DbTestCase):
 
     def test_creates_the_message(self):
         """Die Nachricht wird korrekt gespeichert."""
-        db.delete(Message.all())  # damit man sie später ohne Annahme per Message.all() finden kann
+        ndb.delete_multi(Message.query().fetch(keys_only=True))  # damit man sie später per Message.query() findet
 
         self.app.post('/somequeue/new_message/', 'body', {'Content-Type': 'text/plain'})
 
-        msg, = Message.all()
+        msg, = Message.query()
         self.assertEqual(msg.deleted_at, None)
-        self.assertEqual(msg.body, 'body')
+        self.assertEqual(''.join(fmtp_server.iter_body(msg)), 'body')
         self.assertEqual(msg.content_type, 'text/plain')
         self.assertEqual(msg.message_queue_name, 'somequeue')
 
@@ -199,12 +229,153 @@ class TestMessageHandlerPost(DbTestCase):
         self.app.post('/somequeue/new_message/', 'body', {'Content-Type': 'text/plain'})
         self.assertTrue(MessageHandler.on_created.called)
 
+    def test_waits_for_future_of_on_created(self):
+        """Gibt on_created einen Future zurück, ist er vor der Antwort erledigt."""
+        audited = []
+
+        class AuditingMessageHandler(MessageHandler):
+            @ndb.tasklet
+            def on_created(self, message):
+                yield ndb.sleep(0)
+                audited.append(message.guid)
+        app = TestApp(WSGIApplication([('/([^/]+)/(.+)/', AuditingMessageHandler)], debug=True))
+        app.post('/somequeue/new_message/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.assertEquals(audited, ['new_message'])
+
     def test_on_access_gets_called(self):
         """Löst Event aus beim Zugriff"""
         MessageHandler.on_access = Mock()
         self.app.post('/somequeue/new_message/', 'body', {'Content-Type': 'text/plain'})
 
-        self.assertTrue(MessageHandler.on_access.called)
+        MessageHandler.on_access.assert_called_with('POST', 'somequeue', 'new_message', None)
+
+
+class TestMessageCompression(DbTestCase):
+    """Tests der gzip-Kompression von Nachrichten."""
+
+    def setUp(self):
+        super(TestMessageCompression, self).setUp()
+        self.content = 'Hi Alice, ' * 200
+
+    def test_stores_compressed_body(self):
+        """Komprimiert eingelieferte Nachrichten werden komprimiert gespeichert."""
+        self.app.post('/somequeue/zipped/', gzip_compress(self.content),
+                      {'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'}, status=201)
+        msg = Message.make_key('somequeue', 'zipped').get()
+        self.assertEquals(msg.content_encoding, 'gzip')
+        self.assertEquals(gzip_decompress(''.join(fmtp_server.iter_body(msg))), self.content)
+
+    def test_compresses_large_bodies(self):
+        """Große unkomprimierte Nachrichten werden komprimiert gespeichert."""
+        self.app.post('/somequeue/large/', self.content, {'Content-Type': 'text/plain'}, status=201)
+        msg = Message.make_key('somequeue', 'large').get()
+        self.assertEquals(msg.content_encoding, 'gzip')
+        self.assertTrue(len(''.join(fmtp_server.iter_body(msg))) < len(self.content))
+
+    def test_serves_compressed_body_to_gzip_clients(self):
+        """Clients, die gzip verstehen, erhalten den komprimierten Body."""
+        self.app.post('/somequeue/large/', self.content, {'Content-Type': 'text/plain'}, status=201)
+        response = self.app.get('/somequeue/large/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(gzip_decompress(response.body), self.content)
+
+    def test_decompresses_for_other_clients(self):
+        """Clients, die gzip nicht verstehen, erhalten den entpackten Body."""
+        self.app.post('/somequeue/large/', self.content, {'Content-Type': 'text/plain'}, status=201)
+        for accept_encoding in ['', 'identity', 'gzip;q=0']:
+            response = self.app.get('/somequeue/large/', headers={'Accept-Encoding': accept_encoding})
+            self.assertFalse('Content-Encoding' in response.headers)
+            self.assertEquals(response.body, self.content)
+
+    def test_advertises_gzip_requests(self):
+        """Der Server zeigt per Accept-Encoding an, dass Requests komprimiert sein dürfen."""
+        response = self.app.post('/somequeue/new/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.assertEquals(response.headers['Accept-Encoding'], 'gzip')
+
+    def test_rejects_invalid_gzip(self):
+        """Als gzip deklarierte, aber nicht komprimierte Bodies werden abgelehnt."""
+        self.app.post('/somequeue/broken/', 'body', {'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'},
+                      status=400)
+
+
+class TestLargeMessages(DbTestCase):
+    """Tests der Speicherung großer Nachrichten in Chunks."""
+
+    def setUp(self):
+        super(TestLargeMessages, self).setUp()
+        ndb.delete_multi(MessageChunk.query().fetch(keys_only=True))
+        # Zufallsdaten lassen sich nicht komprimieren
+        self.content = os.urandom(fmtp_server.CHUNK_SIZE * 3 + 17)
+
+    def test_stores_large_body_in_chunks(self):
+        """Große Bodies werden in Chunks gespeichert und vollständig ausgeliefert."""
+        self.app.post('/somequeue/large/', self.content, {'Content-Type': 'application/pdf'}, status=201)
+        msg = Message.make_key('somequeue', 'large').get()
+        self.assertEquals(msg.body, None)
+        self.assertEquals(len(msg.chunks), 4)
+        self.assertEquals(''.join(chunk.data for chunk in ndb.get_multi(msg.chunks)), self.content)
+        self.assertEquals(self.app.get('/somequeue/large/').body, self.content)
+
+    def test_stores_small_body_in_one_chunk(self):
+        """Auch kleine Bodies werden getrennt von den Metadaten gespeichert."""
+        self.app.post('/somequeue/small/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        msg = Message.make_key('somequeue', 'small').get()
+        self.assertEquals(msg.body, None)
+        self.assertEquals([chunk.data for chunk in ndb.get_multi(msg.chunks)], ['body'])
+
+    def test_streams_compressed_chunks(self):
+        """Komprimiert gespeicherte große Bodies werden beim Ausliefern stückweise entpackt."""
+        content = gzip_compress(self.content)
+        self.app.post('/somequeue/large/', content, {'Content-Type': 'application/pdf',
+                                                     'Content-Encoding': 'gzip'}, status=201)
+        self.assertEquals(self.app.get('/somequeue/large/').body, self.content)
+        response = self.app.get('/somequeue/large/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(response.body, content)
+
+    def test_duplicate_leaves_no_chunks(self):
+        """Abgelehnte Dubletten hinterlassen keine Chunks."""
+        self.app.post('/somequeue/large/', self.content, {'Content-Type': 'application/pdf'}, status=201)
+
+        duplicate = Message(key=Message.make_key('somequeue', 'large'), guid='large',
+                            message_queue_name='somequeue', content_type='application/pdf')
+        chunks = fmtp_server.split_body(duplicate.key, os.urandom(len(self.content)))
+        duplicate.chunks = [chunk.key for chunk in chunks]
+        existing, = fmtp_server.insert_messages([(duplicate, chunks)])
+
+        self.assertNotEqual(existing, None)
+        self.assertEquals(MessageChunk.query().count(), 4)
+        self.assertEquals(self.app.get('/somequeue/large/').body, self.content)
+
+
+class TestMessageCache(DbTestCase):
+    """Tests des memcache-Lookups der Nachrichten.
+
+    Testet, ob Erstellung und Löschung den Cache korrekt aktualisieren.
+    """
+
+    def test_get_after_delete_responds_410(self):
+        """Eine gecachte Nachricht ist nach der Löschung nicht mehr abrufbar."""
+        self.app.post('/somequeue/cached/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.assertEquals(self.app.get('/somequeue/cached/').body, 'body')
+        self.app.delete('/somequeue/cached/', status=204)
+        self.app.get('/somequeue/cached/', status=410)
+        self.app.post('/somequeue/cached/', 'body', {'Content-Type': 'text/plain'}, status=410)
+
+    def test_serves_message_without_datastore(self):
+        """Kleine Nachrichten werden samt Body aus dem memcache ausgeliefert."""
+        self.app.post('/somequeue/cached/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        Message.make_key('somequeue', 'cached').delete()
+        self.assertEquals(self.app.get('/somequeue/cached/').body, 'body')
+
+    def test_post_responds_409_from_cache(self):
+        """Ein zweites POST derselben Nachricht wird mit 409 beantwortet."""
+        self.app.post('/somequeue/cached/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.app.post('/somequeue/cached/', 'body', {'Content-Type': 'text/plain'}, status=409)
+
+
+class BatchQueueHandler(QueueHandler):
+    """QueueHandler, der Stapel und Bodies in NDJSON-Listen über on_access von MessageHandler freigibt."""
+    message_handler = MessageHandler
 
 
 class TestQueueHandlerGet(DbTestCase):
@@ -259,6 +430,66 @@ class TestQueueHandlerGet(DbTestCase):
         self.assertTrue('<message>' in result.body)
         self.assertTrue('http://localhost/alpha/alice' in result.body)
 
+    def get_ndjson(self, path, app=None):
+        """Stellt eine GET-Anfrage an path und gibt die Zeilen der NDJSON-Liste zurück.
+
+        Ohne app wird eine Liste von BatchQueueHandler abgerufen, der die Bodies einbettet.
+        """
+        app = app or TestApp(WSGIApplication([('/([^/]+)/', BatchQueueHandler)], debug=True))
+        result = app.get(path, headers={'Accept': 'application/x-ndjson'})
+        self.assertEquals(result.headers['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in result.body.splitlines()]
+
+    def test_delivers_ndjson_with_bodies(self):
+        """Nachrichtenlisten können als NDJSON mit eingebetteten Bodies abgefragt werden."""
+        lines = self.get_ndjson('/alpha/')
+        self.assertEquals([(line['url'], line['guid'], line['content_type'], line['body']) for line in lines],
+                          [('http://localhost/alpha/alice/', 'alice', 'text/plain', 'body')])
+
+    def test_inlines_bodies_within_budget(self):
+        """Bodies werden nur bis max_inline_size eingebettet, komprimierte wie gespeichert."""
+        self.app.post('/alpha/bob/', 'x' * 2000, {'Content-Type': 'text/plain'}, status=201)
+        lines = self.get_ndjson('/alpha/')
+        self.assertEquals(lines[1]['content_encoding'], 'gzip')
+        self.assertEquals(gzip_decompress(base64.b64decode(lines[1]['body_base64'])), 'x' * 2000)
+
+        max_inline_size = QueueHandler.max_inline_size
+        QueueHandler.max_inline_size = 10
+        try:
+            lines = self.get_ndjson('/alpha/')
+        finally:
+            QueueHandler.max_inline_size = max_inline_size
+        self.assertEquals([('body' in line or 'body_base64' in line) for line in lines], [True, False])
+
+    def test_inlines_only_readable_bodies(self):
+        """Bodies werden nur eingebettet, wenn on_access von message_handler den Abruf erlaubt."""
+        class SecretMessageHandler(MessageHandler):
+            """Verweigert den Zugriff auf alice."""
+            def on_access(self, method, message_queue_name, guid, message):
+                if guid == 'alice':
+                    raise HTTP401_Unauthorized()
+
+        class SecretQueueHandler(QueueHandler):
+            """QueueHandler, der Bodies über SecretMessageHandler freigibt."""
+            message_handler = SecretMessageHandler
+
+        self.app.post('/alpha/bob/', 'secret', {'Content-Type': 'text/plain'}, status=201)
+        lines = self.get_ndjson('/alpha/', TestApp(WSGIApplication([('/([^/]+)/', SecretQueueHandler)])))
+        self.assertEquals([(line['guid'], line.get('body')) for line in lines],
+                          [('alice', None), ('bob', 'secret')])
+
+        # Die Liste ist nun gecached, trotzdem bekommt jeder Client nur seine Bodies
+        lines = self.get_ndjson('/alpha/', self.app)
+        self.assertEquals([(line['guid'], line.get('body')) for line in lines], [('alice', None), ('bob', None)])
+        lines = self.get_ndjson('/alpha/')
+        self.assertEquals([(line['guid'], line.get('body')) for line in lines],
+                          [('alice', 'body'), ('bob', 'secret')])
+
+    def test_advertises_listing_formats(self):
+        """Jede Liste zeigt die verfügbaren Formate an."""
+        result = self.app.get('/alpha/')
+        self.assertTrue('application/x-ndjson' in result.headers['X-FMTP-Listing-Formats'])
+
     def test_on_access_gets_called(self):
         """Das Event on_access wird aufgerufen."""
         QueueHandler.on_access = Mock()
@@ -267,12 +498,517 @@ class TestQueueHandlerGet(DbTestCase):
         QueueHandler.on_access.assert_called_with('somequeue')
 
 
+class TestQueueHandlerPost(DbTestCase):
+    """Tests der POST-Methode des QueueHandlers.
+
+    Testet, ob Nachrichtenstapel korrekt angelegt werden und der Status jeder Nachricht gemeldet wird.
+    """
+
+    def setUp(self):
+        super(TestQueueHandlerPost, self).setUp()
+        self.app = TestApp(WSGIApplication([
+            ('/([^/]+)/', BatchQueueHandler),
+            ('/([^/]+)/(.+)/', MessageHandler),
+        ], debug=True))
+
+    def tearDown(self):
+        BatchQueueHandler.max_post_messages = QueueHandler.max_post_messages
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue somequeue:
+            doesexist
+            deleted (gelöscht)
+        """
+        yield Message(guid='deleted', message_queue_name='somequeue', body='xxx',
+                                                         content_type='text/plain', deleted_at=datetime.now())
+        yield Message(guid='doesexist', message_queue_name='somequeue', body='body',
+                                                                                    content_type='text/plain')
+
+    def post_batch(self, path, items, **kwargs):
+        """Postet items als NDJSON an path und gibt die Status der Nachrichten als dict zurück."""
+        result = self.app.post(path, '\n'.join(json.dumps(item) for item in items),
+                               {'Content-Type': 'application/x-ndjson'}, **kwargs)
+        return dict((msg['guid'], msg['status']) for msg in json.loads(result.body)['messages'])
+
+    def test_creates_the_messages(self):
+        """Die Nachrichten werden korrekt gespeichert, auch mit binärem Inhalt."""
+        statuses = self.post_batch('/somequeue/', [
+            {'guid': 'text', 'content_type': 'text/plain', 'body': 'body'},
+            {'guid': 'binary', 'content_type': 'image/png', 'body_base64': 'iVBORw=='},
+        ])
+        self.assertEquals(statuses, {'text': 201, 'binary': 201})
+        self.assertEquals(self.app.get('/somequeue/text/').body, 'body')
+        response = self.app.get('/somequeue/binary/')
+        self.assertEquals(response.content_type, 'image/png')
+        self.assertEquals(response.body, '\x89PNG')
+
+    def test_responds_status_per_message(self):
+        """Dubletten und ungültige guids werden pro Nachricht gemeldet."""
+        statuses = self.post_batch('/somequeue/', [
+            {'guid': 'doesexist', 'body': 'body'},
+            {'guid': 'deleted', 'body': 'body'},
+            {'guid': '***', 'body': 'body'},
+            {'guid': 'new_message', 'body': 'body'},
+        ])
+        self.assertEquals(statuses, {'doesexist': 409, 'deleted': 410, '***': 403, 'new_message': 201})
+
+    def test_responds_409_for_duplicates_within_batch(self):
+        """Kommt eine guid mehrfach im Stapel vor, wird nur die erste Nachricht gespeichert."""
+        result = self.app.post('/somequeue/', '\n'.join([json.dumps({'guid': 'twice', 'body': 'first'}),
+                                                          json.dumps({'guid': 'twice', 'body': 'second'})]),
+                               {'Content-Type': 'application/x-ndjson'})
+        self.assertEquals([msg['status'] for msg in json.loads(result.body)['messages']], [201, 409])
+        self.assertEquals(self.app.get('/somequeue/twice/').body, 'first')
+
+    def test_rejects_malformed_batch(self):
+        """Unlesbare Stapel werden mit 400 abgelehnt."""
+        self.app.post('/somequeue/', 'no json', {'Content-Type': 'application/x-ndjson'}, status=400)
+
+    def test_rejects_corrupt_gzip_per_message(self):
+        """Ein Body, der nicht gzip-komprimiert ist, wird nur für seine Nachricht mit 400 abgelehnt."""
+        statuses = self.post_batch('/somequeue/', [
+            {'guid': 'corrupt', 'content_encoding': 'gzip', 'body': 'not gzip'},
+            {'guid': 'fine', 'body': 'body'},
+        ])
+        self.assertEquals(statuses, {'corrupt': 400, 'fine': 201})
+
+    def test_keeps_order_of_batch(self):
+        """Die Nachrichten werden in der Reihenfolge des Stapels erstellt."""
+        guids = ['m%02d' % index for index in range(20)]
+        self.post_batch('/somequeue/', [{'guid': guid, 'body': 'body'} for guid in reversed(guids)])
+        messages = Message.query(Message.message_queue_name == 'somequeue', Message.guid.IN(guids)).fetch()
+        self.assertEquals([message.guid for message in sorted(messages, key=lambda msg: msg.created_at)],
+                          list(reversed(guids)))
+
+    def test_checks_access_per_message(self):
+        """MessageHandler.on_access wird für jede Nachricht mit POST aufgerufen."""
+        MessageHandler.on_access = Mock()
+        self.post_batch('/somequeue/', [{'guid': 'a', 'body': 'body'}, {'guid': 'b', 'body': 'body'}])
+        self.assertEquals([call[0] for call in MessageHandler.on_access.call_args_list],
+                          [('POST', 'somequeue', 'a', None), ('POST', 'somequeue', 'b', None)])
+
+    def test_limits_messages_per_request(self):
+        """Mehr als max_post_messages Nachrichten werden mit 400 abgelehnt, keine wird erstellt."""
+        BatchQueueHandler.max_post_messages = 1
+        self.app.post('/somequeue/', '\n'.join(json.dumps({'guid': guid, 'body': 'body'}) for guid in 'ab'),
+                      {'Content-Type': 'application/x-ndjson'}, status=400)
+        self.assertEquals(Message.query(Message.guid == 'a').count(), 0)
+        self.assertEquals(self.post_batch('/somequeue/', [{'guid': 'a', 'body': 'body'}]), {'a': 201})
+
+    def test_denies_without_message_handler(self):
+        """Ohne message_handler werden Stapel mit 403 abgelehnt."""
+        self.app = TestApp(WSGIApplication([('/([^/]+)/', QueueHandler)], debug=True))
+        self.app.post('/somequeue/', json.dumps({'guid': 'a', 'body': 'body'}),
+                      {'Content-Type': 'application/x-ndjson'}, status=403)
+        self.assertEquals(Message.query(Message.guid == 'a').count(), 0)
+
+    def test_on_created_gets_called(self):
+        """Löst Event für jede erstellte Nachricht aus."""
+        QueueHandler.on_created = Mock()
+        self.post_batch('/somequeue/', [{'guid': 'a', 'body': 'body'}, {'guid': 'doesexist', 'body': 'body'}])
+        self.assertEquals(QueueHandler.on_created.call_count, 1)
+
+
+class TestQueueHandlerDelete(DbTestCase):
+    """Tests der DELETE-Methode des QueueHandlers.
+
+    Testet, ob mehrere Nachrichten korrekt gelöscht werden und der Status jeder Nachricht gemeldet wird.
+    """
+
+    def setUp(self):
+        super(TestQueueHandlerDelete, self).setUp()
+        self.app = TestApp(WSGIApplication([
+            ('/([^/]+)/', BatchQueueHandler),
+            ('/([^/]+)/(.+)/', MessageHandler),
+        ], debug=True))
+
+    def tearDown(self):
+        BatchQueueHandler.max_delete_guids = QueueHandler.max_delete_guids
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue somequeue:
+            alpha, beta
+            deleted (gelöscht)
+        """
+        yield Message(guid='deleted', message_queue_name='somequeue', body='xxx',
+                                                         content_type='text/plain', deleted_at=datetime.now())
+        yield Message(guid='alpha', message_queue_name='somequeue', body='body', content_type='text/plain')
+        yield Message(guid='beta', message_queue_name='somequeue', body='body', content_type='text/plain')
+
+    def delete_batch(self, path, guids, **kwargs):
+        """Löscht guids per DELETE auf path und gibt die Status der Nachrichten als Liste zurück."""
+        result = self.app.request(path, method='DELETE', body=json.dumps({'guids': guids}), **kwargs)
+        return [(msg['guid'], msg['status']) for msg in json.loads(result.body)['messages']]
+
+    def test_deletes_the_messages(self):
+        """Die Nachrichten werden gelöscht, der Status jeder guid wird gemeldet."""
+        statuses = self.delete_batch('/somequeue/', ['alpha', 'beta', 'deleted', 'unknown', 'alpha'])
+        self.assertEquals(statuses, [('alpha', 204), ('beta', 204), ('deleted', 410), ('unknown', 404),
+                                     ('alpha', 410)])
+        self.assertTrue(all(msg.deleted_at for msg in Message.query()))
+        self.app.get('/somequeue/alpha/', status=410)
+
+    def test_rejects_malformed_request(self):
+        """Unlesbare Requests werden mit 400 abgelehnt."""
+        self.app.request('/somequeue/', method='DELETE', body='alpha', status=400)
+        self.app.request('/somequeue/', method='DELETE', body=json.dumps({'guids': 'abc'}), status=400)
+        self.app.request('/somequeue/', method='DELETE', body=json.dumps({'guids': [1, 2]}), status=400)
+        self.assertFalse([msg for msg in Message.query() if msg.guid != 'deleted' and msg.deleted_at])
+
+    def test_rejects_invalid_guids(self):
+        """Ungültige guids werden mit 403 gemeldet und nicht gelöscht."""
+        statuses = self.delete_batch('/somequeue/', ['alpha', '***'])
+        self.assertEquals(statuses, [('alpha', 204), ('***', 403)])
+
+    def test_limits_guids_per_request(self):
+        """Mehr als max_delete_guids guids werden mit 400 abgelehnt."""
+        BatchQueueHandler.max_delete_guids = 1
+        self.app.request('/somequeue/', method='DELETE', body=json.dumps({'guids': ['alpha', 'beta']}),
+                         status=400)
+
+    def test_checks_access_per_message(self):
+        """MessageHandler.on_access wird für jede guid mit DELETE und der Nachricht aufgerufen."""
+        MessageHandler.on_access = Mock()
+        self.delete_batch('/somequeue/', ['beta', 'alpha', 'unknown'])
+        self.assertEquals([(call[0][:3], call[0][3] and call[0][3].guid)
+                           for call in MessageHandler.on_access.call_args_list],
+                          [(('DELETE', 'somequeue', 'alpha'), 'alpha'), (('DELETE', 'somequeue', 'beta'), 'beta'),
+                           (('DELETE', 'somequeue', 'unknown'), None)])
+
+    def test_denies_without_message_handler(self):
+        """Ohne message_handler werden Stapel mit 403 abgelehnt."""
+        self.app = TestApp(WSGIApplication([('/([^/]+)/', QueueHandler)], debug=True))
+        self.app.request('/somequeue/', method='DELETE', body=json.dumps({'guids': ['alpha']}), status=403)
+        self.assertEquals(Message.make_key('somequeue', 'alpha').get().deleted_at, None)
+
+    def test_on_deleted_gets_called(self):
+        """Löst Event für jede gelöschte Nachricht aus."""
+        QueueHandler.on_deleted = Mock()
+        self.delete_batch('/somequeue/', ['alpha', 'deleted'])
+        self.assertEquals(QueueHandler.on_deleted.call_count, 1)
+
+    def test_runs_futures_of_on_deleted_in_parallel(self):
+        """Die Futures von on_deleted laufen parallel und sind vor der Antwort erledigt."""
+        events = []
+
+        class AuditingQueueHandler(BatchQueueHandler):
+            @ndb.tasklet
+            def on_deleted(self, message):
+                events.append(('start', message.guid))
+                yield ndb.sleep(0)
+                events.append(('done', message.guid))
+        self.app = TestApp(WSGIApplication([('/([^/]+)/', AuditingQueueHandler)], debug=True))
+        self.delete_batch('/somequeue/', ['alpha', 'beta'])
+        self.assertEquals(sorted(events[:2]), [('start', 'alpha'), ('start', 'beta')])
+        self.assertEquals(sorted(events[2:]), [('done', 'alpha'), ('done', 'beta')])
+
+
+class TestQueueHandlerPaging(DbTestCase):
+    """Tests des Blätterns in Nachrichtenlisten."""
+
+    def setUp(self):
+        """Verkleinert die Seitengröße auf 2 Nachrichten."""
+        super(TestQueueHandlerPaging, self).setUp()
+
+        class SmallPageQueueHandler(QueueHandler):
+            max_messages = 2
+        self.app = TestApp(WSGIApplication([('/([^/]+)/', SmallPageQueueHandler)], debug=True))
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            first, second, third
+        """
+        for i, guid in enumerate(['first', 'second', 'third']):
+            yield Message(guid=guid, message_queue_name='alpha', body='body', content_type='text/plain',
+                          created_at=datetime(2011, 3, 23, 0, 0, i))
+
+    def test_pages_through_queue(self):
+        """Über next_url bzw. den Link-Header lassen sich alle Nachrichten abrufen."""
+        result = self.app.get('/alpha/', headers={'Accept': 'application/json'})
+        page = json.loads(result.body)
+        self.assertEquals([msg['url'] for msg in page['messages']],
+                          ['http://localhost/alpha/first/', 'http://localhost/alpha/second/'])
+        self.assertEquals(result.headers['Link'], '<%s>; rel="next"' % page['next_url'])
+
+        result = self.app.get(page['next_url'], headers={'Accept': 'application/json'})
+        page = json.loads(result.body)
+        self.assertEquals([msg['url'] for msg in page['messages']], ['http://localhost/alpha/third/'])
+        self.assertFalse('next_url' in page)
+        self.assertFalse('Link' in result.headers)
+
+    def test_rejects_invalid_cursor(self):
+        """Ungültige Cursor werden mit 400 beantwortet."""
+        self.app.get('/alpha/?cursor=***', status=400)
+
+
+class TestQueueHandlerLongPolling(DbTestCase):
+    """Tests des Long-Pollings (Parameter wait) in Nachrichtenlisten."""
+
+    def setUp(self):
+        """Ersetzt time.sleep, damit die Tests nicht wirklich warten."""
+        super(TestQueueHandlerLongPolling, self).setUp()
+        self.sleep = fmtp_server.time.sleep
+        fmtp_server.time.sleep = Mock()
+
+    def tearDown(self):
+        fmtp_server.time.sleep = self.sleep
+
+    def get_message_urls(self, path):
+        """Extrahiert die URLS der Nachrichten aus einer JSON-anfrage an path"""
+        result = self.app.get(path, headers={'Accept': 'application/json'})
+        return [msg['url'] for msg in json.loads(result.body)['messages']]
+
+    def test_returns_new_message(self):
+        """Eine wartende Anfrage liefert Nachrichten, die während des Wartens eingestellt werden."""
+        def post_message(seconds):
+            self.app.post('/alpha/late/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        fmtp_server.time.sleep.side_effect = post_message
+
+        self.assertEquals(self.get_message_urls('/alpha/?wait=10'), ['http://localhost/alpha/late/'])
+        self.assertEquals(fmtp_server.time.sleep.call_count, 1)
+
+    def test_returns_empty_list_after_timeout(self):
+        """Ohne neue Nachrichten liefert die Anfrage nach Ablauf der Wartezeit eine leere Liste."""
+        self.assertEquals(self.get_message_urls('/alpha/?wait=0.1'), [])
+
+    def test_does_not_wait_without_parameter(self):
+        """Ohne den Parameter wait wird nicht gewartet."""
+        self.assertEquals(self.get_message_urls('/alpha/'), [])
+        self.assertFalse(fmtp_server.time.sleep.called)
+
+    def test_rejects_invalid_wait(self):
+        """Ungültige Wartezeiten werden mit 400 beantwortet."""
+        self.app.get('/alpha/?wait=forever', status=400)
+
+    def test_queue_version_changes_on_create_and_delete(self):
+        """Erstellung und Löschung von Nachrichten ändern die Version der Queue."""
+        version = fmtp_server.get_queue_version('alpha')
+        self.app.post('/alpha/new/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.assertNotEqual(fmtp_server.get_queue_version('alpha'), version)
+        version = fmtp_server.get_queue_version('alpha')
+        self.app.delete('/alpha/new/', status=204)
+        self.assertNotEqual(fmtp_server.get_queue_version('alpha'), version)
+
+
+class TestQueueHandlerConditionalGet(DbTestCase):
+    """Tests von ETag und If-None-Match bei Nachrichtenlisten."""
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            alice
+        """
+        yield Message(guid='alice', message_queue_name='alpha', body='body', content_type='text/plain')
+
+    def test_responds_304_if_unchanged(self):
+        """Hat der Client die aktuelle Liste, wird mit 304 geantwortet."""
+        result = self.app.get('/alpha/', headers={'Accept': 'application/json'})
+        etag = result.headers['ETag']
+        result = self.app.get('/alpha/', headers={'Accept': 'application/json', 'If-None-Match': etag},
+                              status=304)
+        self.assertEquals(result.headers['ETag'], etag)
+        self.assertEquals(result.body, '')
+
+    def test_etag_changes_with_queue(self):
+        """Neue Nachrichten ändern das ETag."""
+        etag = self.app.get('/alpha/').headers['ETag']
+        self.app.post('/alpha/bob/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        result = self.app.get('/alpha/', headers={'If-None-Match': etag}, status=200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+        self.assertEquals(result.body.splitlines(), ['http://localhost/alpha/alice/', 'http://localhost/alpha/bob/'])
+
+    def test_etag_depends_on_format(self):
+        """Jedes Listenformat hat ein eigenes ETag."""
+        etag = self.app.get('/alpha/', headers={'Accept': 'application/json'}).headers['ETag']
+        self.app.get('/alpha/', headers={'Accept': 'application/xml', 'If-None-Match': etag}, status=200)
+
+    def test_serves_cached_listing(self):
+        """Solange sich die Queue nicht ändert, wird die gerenderte Liste aus dem memcache geliefert."""
+        self.app.get('/alpha/')
+        Message.make_key('alpha', 'alice').delete()
+        self.assertEquals(self.app.get('/alpha/').body.splitlines(), ['http://localhost/alpha/alice/'])
+
+
+class TestQueueHandlerRetryInterval(DbTestCase):
+    """Tests der adaptiven Retry-Intervalle und des Abruf-Budgets."""
+
+    def setUp(self):
+        """Hält die Uhr an, damit alle Abrufe in dieselbe Minute fallen."""
+        super(TestQueueHandlerRetryInterval, self).setUp()
+        self.time = fmtp_server.time.time
+        fmtp_server.time.time = Mock(return_value=self.time())
+
+    def tearDown(self):
+        fmtp_server.time.time = self.time
+        QueueHandler.max_polls_per_minute = None
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            alice
+        """
+        yield Message(guid='alice', message_queue_name='alpha', body='body', content_type='text/plain')
+
+    def get_retry_interval(self, path):
+        """Gibt das Retry-Interval aus der JSON-Liste unter path zurück."""
+        result = self.app.get(path, headers={'Accept': 'application/json'})
+        interval = json.loads(result.body)['min_retry_interval']
+        self.assertEquals(result.headers['X-FMTP-Retry-Interval'], str(interval))
+        return interval
+
+    def test_keeps_consumers_of_busy_queues_close(self):
+        """Liegen Nachrichten bereit, bleibt es beim min_retry_interval."""
+        self.assertEquals([self.get_retry_interval('/alpha/') for _ in range(3)], [500, 500, 500])
+
+    def test_pushes_pollers_of_idle_queues_out(self):
+        """Je öfter eine leere Queue abgefragt wird, desto länger sollen die Clients warten."""
+        self.assertEquals([self.get_retry_interval('/empty/') for _ in range(3)], [500, 1000, 1500])
+        for _ in range(200):
+            self.app.get('/empty/')
+        self.assertEquals(self.get_retry_interval('/empty/'), 60000)
+
+    def test_counts_polls_per_client(self):
+        """Ein Client, der oft fragt, drängt andere Clients derselben Queue nicht zurück."""
+        for _ in range(5):
+            self.app.get('/empty/', extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        result = self.app.get('/empty/', extra_environ={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEquals(result.headers['X-FMTP-Retry-Interval'], '500')
+        result = self.app.get('/empty/', extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEquals(result.headers['X-FMTP-Retry-Interval'], '3000')
+
+    def test_answers_429_over_budget(self):
+        """Überschreitet eine Queue max_polls_per_minute, wird mit 429 und Retry-After geantwortet."""
+        QueueHandler.max_polls_per_minute = 2
+        self.app.get('/alpha/', status=200)
+        self.app.get('/alpha/', status=200)
+        result = self.app.get('/alpha/', status=429)
+        self.assertTrue(0 < int(result.headers['Retry-After']) <= 60)
+        self.app.get('/beta/', status=200)
+
+
+class TestCounterShards(DbTestCase):
+    """Tests der Verteilung großer Stapel auf die Shards der Zähler."""
+
+    def test_spreads_batches_over_shards(self):
+        """Mehr Stapel als Shards werden vollständig gezählt, gleichzeitige Stapel nutzen eigene Shards."""
+        storage = fmtp_server.NdbStorage()
+        count = (fmtp_server.COUNTER_SHARDS + 1) * fmtp_server.BATCH_SIZE
+        items = [(u'guid%d' % index, 'text/plain', 'x', None) for index in range(count)]
+        self.assertEquals([status for status, _message in storage.create_messages(u'alpha', items)],
+                          [201] * count)
+        shards = QueueCounterShard.query().fetch()
+        self.assertTrue(len(shards) <= fmtp_server.PARALLEL_BATCHES)
+        self.assertEquals(sum(shard.live for shard in shards), count)
+
+        results = storage.mark_deleted(u'alpha', [guid for guid, _type, _body, _encoding in items], datetime.now())
+        self.assertEquals([status for status, _message in results], [204] * count)
+        stats = storage.queue_stats(u'alpha')
+        self.assertEquals((stats['live'], stats['deleted'], stats['bytes']), (0, count, 0))
+
+    def test_uses_distinct_shards(self):
+        """batch_keys liefert verschiedene Shards, reihum über alle Shards."""
+        keys = QueueCounterShard.batch_keys(u'alpha', fmtp_server.COUNTER_SHARDS)
+        self.assertEquals(sorted(keys), sorted(QueueCounterShard.make_keys(u'alpha')))
+
+
+class TestQueueHandlerHead(DbTestCase):
+    """Tests der Statistik einer Queue per HEAD."""
+
+    def test_reports_queue_stats(self):
+        """HEAD liefert die Zähler der Queue, die POST und DELETE fortschreiben."""
+        for guid, body in [('alice', 'body'), ('bob', 'longer body'), ('carol', 'x')]:
+            self.app.post('/alpha/%s/' % guid, body, {'Content-Type': 'text/plain'}, status=201)
+        self.app.post('/alpha/alice/', 'body', {'Content-Type': 'text/plain'}, status=409)
+        self.app.delete('/alpha/alice/', status=204)
+
+        result = self.app.head('/alpha/')
+        self.assertEquals((result.headers['X-FMTP-Depth'], result.headers['X-FMTP-Tombstones'],
+                           result.headers['X-FMTP-Bytes']), ('2', '1', '12'))
+        self.assertTrue(0 <= int(result.headers['X-FMTP-Oldest-Age']) < 60)
+        self.assertEquals(result.body, '')
+
+    def test_reports_empty_queue(self):
+        """Eine unbekannte Queue ist leer und hat kein Alter."""
+        result = self.app.head('/empty/')
+        self.assertEquals(result.headers['X-FMTP-Depth'], '0')
+        self.assertFalse('X-FMTP-Oldest-Age' in result.headers)
+
+
+class TestQueueHandlerLeases(DbTestCase):
+    """Tests des Leasens (Parameter lease) von Nachrichten."""
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            alice
+            bob, Lease abgelaufen
+        """
+        yield Message(guid='alice', message_queue_name='alpha', body='body', content_type='text/plain',
+                      created_at=datetime.now() - timedelta(minutes=2))
+        yield Message(guid='bob', message_queue_name='alpha', body='body', content_type='text/plain',
+                      created_at=datetime.now() - timedelta(minutes=1),
+                      leased_until=datetime.now() - timedelta(seconds=1))
+
+    def get_messages(self, path):
+        """Gibt die Nachrichten aus einer JSON-Anfrage an path zurück."""
+        result = self.app.get(path, headers={'Accept': 'application/json'})
+        return json.loads(result.body)['messages']
+
+    def test_hides_leased_messages(self):
+        """Geleaste Nachrichten fehlen in anderen Listen, solange die Lease läuft."""
+        messages = self.get_messages('/alpha/?lease=60')
+        self.assertEquals([msg['url'] for msg in messages],
+                          ['http://localhost/alpha/alice/', 'http://localhost/alpha/bob/'])
+        self.assertTrue(all(msg['leased_until'] for msg in messages))
+        self.assertEquals(self.get_messages('/alpha/?lease=60'), [])
+        self.assertEquals(self.get_messages('/alpha/'), [])
+
+    def test_expired_lease_is_visible(self):
+        """Nach Ablauf der Lease erscheint die Nachricht wieder."""
+        self.assertEquals([msg['url'] for msg in self.get_messages('/alpha/')],
+                          ['http://localhost/alpha/alice/', 'http://localhost/alpha/bob/'])
+
+    def test_leased_message_can_be_deleted(self):
+        """Wer die Nachricht geleast hat, holt und löscht sie wie gewohnt."""
+        url = self.get_messages('/alpha/?lease=60')[0]['url']
+        self.app.get(url, status=200)
+        self.app.delete(url, status=204)
+
+    def test_has_no_etag(self):
+        """Listen mit lease werden weder gecached noch per ETag bestätigt."""
+        self.assertFalse('ETag' in self.app.get('/alpha/?lease=60').headers)
+
+    def test_rejects_invalid_lease(self):
+        """Ungültige Lease-Dauern werden mit 400 beantwortet."""
+        self.app.get('/alpha/?lease=long', status=400)
+
+
 class TestAdminHandlerDelete(DbTestCase):
     """ Tests der DELETE-Methode des AdminHandlers.
 
     Die methode löst die GarbageCollection der Queue aus.
     Testet, ob es die richtigen Nachrichen löscht.
     """
+    def setUp(self):
+        """Führt deferred Tasks sofort aus."""
+        super(TestAdminHandlerDelete, self).setUp()
+        ndb.delete_multi(GarbageCollection.query().fetch(keys_only=True))
+        self.defer = fmtp_server.deferred.defer
+        fmtp_server.deferred.defer = Mock(side_effect=lambda func, *args, **kwargs: func(*args))
+
+    def tearDown(self):
+        fmtp_server.deferred.defer = self.defer
+        fmtp_server.GC_BATCH_SIZE = 100
+
     def fixtures(self):
         young = datetime.now() - timedelta(days=2)
         old = datetime.now() - timedelta(days=7, hours=2)
@@ -315,14 +1051,292 @@ class TestAdminHandlerDelete(DbTestCase):
     def test_answers_report(self):
         """Bei Erfolg wird eine json-zusammenfassung geliefert."""
         result = self.app.delete('/admin/alpha/')
-        self.assertEquals(json.loads(result.body), {
-            'success': True,
-            'deleted': 1,
-        })
+        report = json.loads(result.body)
+        self.assertEquals(report['success'], True)
+        self.assertEquals(report['status'], 'done')
+        self.assertEquals(report['deleted'], 1)
+
+    def test_collects_in_batches(self):
+        """Die GarbageCollection arbeitet stapelweise und entfernt auch die Chunks der Nachrichten."""
+        fmtp_server.GC_BATCH_SIZE = 1
+        old = datetime.now() - timedelta(days=8)
+        for guid in ['first', 'second']:
+            message = Message(key=Message.make_key('gamma', guid), guid=guid, message_queue_name='gamma',
+                              content_type='text/plain', deleted_at=old)
+            chunks = fmtp_server.split_body(message.key, 'body')
+            message.chunks = [chunk.key for chunk in chunks]
+            fmtp_server.insert_messages([(message, chunks)])
+        self.assertEquals(json.loads(self.app.delete('/admin/gamma/').body)['deleted'], 2)
+        self.assertFalse(MessageChunk.query(ancestor=Message.make_key('gamma', 'first')).fetch(1))
+
+    def test_reports_running_collection(self):
+        """Läuft bereits eine GarbageCollection, wird keine weitere gestartet."""
+        fmtp_server.deferred.defer = Mock()
+        self.assertEquals(json.loads(self.app.delete('/admin/alpha/').body)['status'], 'running')
+        self.assertEquals(json.loads(self.app.delete('/admin/alpha/').body)['status'], 'running')
+        self.assertEquals(fmtp_server.deferred.defer.call_count, 1)
+        self.assertTrue(self._message_exists('oldenough'))
 
     def _message_exists(self, guid):
         """Helper, um festzustellen, ob eine Nachricht existiert."""
-        return bool(Message.all().filter('guid =', guid).fetch(1))
+        return bool(Message.query(Message.guid == guid).fetch(1))
+
+
+class TestGarbageCollectionHandler(DbTestCase):
+    """Tests der regelmäßigen GarbageCollection aller Queues mit Aufbewahrungsfrist und Höchstalter."""
+
+    def setUp(self):
+        """Führt deferred Tasks sofort aus."""
+        super(TestGarbageCollectionHandler, self).setUp()
+        ndb.delete_multi(GarbageCollection.query().fetch(keys_only=True))
+        self.defer = fmtp_server.deferred.defer
+        fmtp_server.deferred.defer = Mock(side_effect=lambda func, *args, **kwargs: func(*args))
+
+        class Handler(GarbageCollectionHandler):
+            """Verwirft Nachrichten in alpha nach 3 Tagen, gelöschte in beta nach einem Tag."""
+            def get_max_age_days(self, message_queue_name):
+                return 3 if message_queue_name == 'alpha' else None
+
+            def get_retention_period_days(self, message_queue_name):
+                return 1 if message_queue_name == 'beta' else 7
+        self.gc_app = TestApp(WSGIApplication([('/_fmtp/gc', Handler)], debug=True))
+
+    def tearDown(self):
+        fmtp_server.deferred.defer = self.defer
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            stale (vor 5 Tagen erstellt)
+            fresh
+        queue beta:
+            stale (vor 5 Tagen erstellt)
+            deleted (vor 2 Tagen gelöscht)
+        """
+        old = datetime.now() - timedelta(days=5)
+        yield Message(guid='stale', message_queue_name='alpha', created_at=old, content_type='text/plain')
+        yield Message(guid='fresh', message_queue_name='alpha', content_type='text/plain')
+        yield Message(guid='stale', message_queue_name='beta', created_at=old, content_type='text/plain')
+        yield Message(guid='deleted', message_queue_name='beta', content_type='text/plain',
+                      deleted_at=datetime.now() - timedelta(days=2))
+
+    def test_applies_policies_per_queue(self):
+        """Höchstalter und Aufbewahrungsfrist gelten je Queue, der Fortschritt wird gemeldet."""
+        report = json.loads(self.gc_app.get('/_fmtp/gc').body)
+        self.assertEquals([(queue, report['queues'][queue]['expired'], report['queues'][queue]['deleted'])
+                           for queue in sorted(report['queues'])], [('alpha', 1, 0), ('beta', 0, 1)])
+
+        self.assertTrue(Message.make_key('alpha', 'stale').get().deleted_at)
+        self.assertEquals(Message.make_key('alpha', 'fresh').get().deleted_at, None)
+        self.assertEquals(Message.make_key('beta', 'stale').get().deleted_at, None)
+        self.assertEquals(Message.make_key('beta', 'deleted').get(), None)
+
+    def test_takes_retention_period_from_admin_handler(self):
+        """Die Aufbewahrungsfrist ist dieselbe wie bei DELETE /admin/<queue>/."""
+        class ShortAdminHandler(AdminHandler):
+            retention_period_days = 1
+
+        class Handler(GarbageCollectionHandler):
+            admin_handler = ShortAdminHandler
+        app = TestApp(WSGIApplication([('/_fmtp/gc', GarbageCollectionHandler), ('/_fmtp/short-gc', Handler)]))
+        app.get('/_fmtp/gc')
+        self.assertTrue(Message.make_key('beta', 'deleted').get())
+        app.get('/_fmtp/short-gc')
+        self.assertEquals(Message.make_key('beta', 'deleted').get(), None)
+
+
+class TestDeferredEvents(DbTestCase):
+    """Tests der zurückgestellten, stapelweise verarbeiteten Events."""
+
+    def setUp(self):
+        super(TestDeferredEvents, self).setUp()
+        batches = self.batches = []
+
+        class DeferringMessageHandler(MessageHandler):
+            defer_events = True
+
+            def on_created_batch(self, messages):
+                batches.append(('created', sorted(message.guid for message in messages)))
+
+            def on_deleted_batch(self, messages):
+                batches.append(('deleted', sorted(message.guid for message in messages)))
+
+        class DeferringEventHandler(EventHandler):
+            events_handler = DeferringMessageHandler
+        self.app = TestApp(WSGIApplication([
+            ('/_fmtp/events', DeferringEventHandler),
+            ('/([^/]+)/(.+)/', DeferringMessageHandler),
+        ], debug=True))
+
+    def test_processes_events_in_batches(self):
+        """Die Events mehrerer Requests werden erst vom EventHandler und gemeinsam verarbeitet."""
+        self.app.post('/somequeue/alpha/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.app.post('/somequeue/beta/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        self.app.delete('/somequeue/alpha/', status=204)
+        self.assertEquals(self.batches, [])
+
+        result = json.loads(self.app.get('/_fmtp/events').body)
+        self.assertEquals((result['processed'], result['failed']), (3, 0))
+        self.assertEquals(self.batches, [('created', ['alpha', 'beta']), ('deleted', ['alpha'])])
+        self.assertEquals(json.loads(self.app.get('/_fmtp/events').body)['processed'], 0)
+
+
+class TestMetricsHandler(DbTestCase):
+    """Tests der Messwerte der Handler und ihrer Ausgabe."""
+
+    def setUp(self):
+        """Beginnt mit leeren Messwerten."""
+        super(TestMetricsHandler, self).setUp()
+        fmtp_server.metrics.reset()
+
+        class ProfiledMessageHandler(MessageHandler):
+            profile_sample_rate = 1
+        self.app = TestApp(WSGIApplication([
+            ('/_fmtp/metrics', MetricsHandler),
+            ('/([^/]+)/', QueueHandler),
+            ('/([^/]+)/(.+)/', ProfiledMessageHandler),
+        ], debug=True))
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue alpha:
+            alice
+        """
+        yield Message(guid='alice', message_queue_name='alpha', body='body', content_type='text/plain')
+
+    def get_metrics(self):
+        """Gibt die Messwerte als JSON zurück."""
+        return json.loads(self.app.get('/_fmtp/metrics', headers={'Accept': 'application/json'}).body)
+
+    def test_counts_responses_per_status(self):
+        """Antworten werden je Handler, Methode und Statusklasse gezählt, erfolgreiche Anfragen je Queue."""
+        self.app.get('/alpha/alice/')
+        self.app.get('/alpha/nobody/', status=404)
+        self.app.get('/alpha/')
+        counters = self.get_metrics()['counters']
+        self.assertEquals(sorted((counter['labels']['handler'], counter['labels']['status'], counter['value'])
+                                 for counter in counters['fmtp_responses_total']),
+                          [('ProfiledMessageHandler', '2xx', 1), ('ProfiledMessageHandler', '4xx', 1),
+                           ('QueueHandler', '2xx', 1)])
+        self.assertEquals(counters['fmtp_queue_requests_total'], [{'labels': {'queue': 'alpha'}, 'value': 2}])
+        self.assertTrue(counters['fmtp_datastore_rpcs_total'])
+
+    def test_counts_response_bytes(self):
+        """Die Bytes stückweise geschriebener Antworten werden gezählt."""
+        content = os.urandom(fmtp_server.CHUNK_SIZE * 2 + 17)
+        self.app.post('/alpha/large/', content, {'Content-Type': 'application/pdf'}, status=201)
+        fmtp_server.metrics.reset()
+        self.app.get('/alpha/large/')
+        counters = self.get_metrics()['counters']
+        self.assertEquals(counters['fmtp_response_bytes_total'],
+                          [{'labels': {'handler': 'ProfiledMessageHandler'}, 'value': len(content)}])
+
+    def test_profiles_sampled_requests(self):
+        """Profilierte Requests erscheinen samt Datastore-Aufrufen in den Profilen."""
+        self.app.get('/alpha/alice/')
+        profile, = self.get_metrics()['profiles']
+        self.assertEquals((profile['method'], profile['path'], profile['status']), ('GET', '/alpha/alice/', 200))
+        self.assertTrue(profile['stats'])
+
+    def test_serves_prometheus_text(self):
+        """Ohne Accept: application/json wird das Prometheus-Textformat geliefert."""
+        self.app.get('/alpha/')
+        result = self.app.get('/_fmtp/metrics')
+        self.assertTrue(result.headers['Content-Type'].startswith('text/plain'))
+        self.assertTrue('fmtp_request_seconds_bucket{handler="QueueHandler",le="0.005",method="GET"}'
+                        in result.body)
+        self.assertTrue('fmtp_listing_messages_count{format="text"} 1' in result.body)
+
+
+class TestSubscriptionHandler(DbTestCase):
+    """Tests der Liste über mehrere Queues."""
+
+    def setUp(self):
+        super(TestSubscriptionHandler, self).setUp()
+        self.app = TestApp(WSGIApplication([
+            ('/_fmtp/subscription', SubscriptionHandler),
+            ('/([^/]+)/', QueueHandler),
+            ('/([^/]+)/(.+)/', MessageHandler),
+        ], debug=True))
+
+    def tearDown(self):
+        SubscriptionHandler.max_messages = 100
+        QueueHandler.max_polls_per_minute = None
+
+    def fixtures(self):
+        """Erstellt Fixture-Messages
+
+        queue printer-1:
+            alice
+            bob (gelöscht)
+        queue printer-2:
+            carol
+        queue partner:
+            dave
+        """
+        yield Message(guid='alice', message_queue_name='printer-1', body='body', content_type='text/plain')
+        yield Message(guid='bob', message_queue_name='printer-1', body='body', content_type='text/plain',
+                      deleted_at=datetime.now())
+        yield Message(guid='carol', message_queue_name='printer-2', body='body', content_type='text/plain')
+        yield Message(guid='dave', message_queue_name='partner', body='body', content_type='text/plain')
+
+    def test_lists_given_queues(self):
+        """Die Liste enthält die bereitstehenden Nachrichten aller angegebenen Queues."""
+        result = self.app.get('/_fmtp/subscription?queue=printer-1&queue=partner',
+                              headers={'Accept': 'application/json'})
+        data = json.loads(result.body)
+        self.assertEquals(data['queues'], ['partner', 'printer-1'])
+        self.assertEquals([(msg['queue'], msg['guid'], msg['url']) for msg in data['messages']], [
+            ('partner', 'dave', 'http://localhost/partner/dave/'),
+            ('printer-1', 'alice', 'http://localhost/printer-1/alice/')])
+        self.assertFalse(data['more'])
+
+    def test_lists_queues_by_prefix(self):
+        """Mit prefix werden alle Queues abonniert, deren Name damit beginnt."""
+        result = self.app.get('/_fmtp/subscription?prefix=printer-')
+        self.assertEquals(result.body.splitlines(), ['http://localhost/printer-1/alice/',
+                                                     'http://localhost/printer-2/carol/'])
+
+    def test_responds_304_if_unchanged(self):
+        """Hat der Client die aktuelle Liste, wird mit 304 geantwortet, bis sich eine der Queues ändert."""
+        etag = self.app.get('/_fmtp/subscription?prefix=printer-').headers['ETag']
+        self.app.get('/_fmtp/subscription?prefix=printer-', headers={'If-None-Match': etag}, status=304)
+        self.app.post('/printer-2/eve/', 'body', {'Content-Type': 'text/plain'}, status=201)
+        result = self.app.get('/_fmtp/subscription?prefix=printer-', headers={'If-None-Match': etag},
+                              status=200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+    def test_reports_more_messages(self):
+        """Passen nicht alle Nachrichten in die Liste, ist more gesetzt."""
+        SubscriptionHandler.max_messages = 1
+        result = self.app.get('/_fmtp/subscription?prefix=printer-', headers={'Accept': 'application/json'})
+        data = json.loads(result.body)
+        self.assertEquals([msg['guid'] for msg in data['messages']], ['alice'])
+        self.assertTrue(data['more'])
+
+    def test_applies_budget_of_each_queue(self):
+        """Abrufe eines Abonnements zählen gegen das Budget jeder Queue."""
+        QueueHandler.max_polls_per_minute = 2
+        self.app.get('/printer-1/', status=200)
+        self.app.get('/_fmtp/subscription?queue=partner&queue=printer-1', status=200)
+        result = self.app.get('/_fmtp/subscription?queue=printer-1', status=429)
+        self.assertTrue(0 < int(result.headers['Retry-After']) <= 60)
+        self.app.get('/printer-1/', status=429)
+        self.app.get('/_fmtp/subscription?queue=partner', status=200)
+
+    def test_rejects_missing_queues(self):
+        """Ohne queue oder prefix wird mit 400 geantwortet."""
+        self.app.get('/_fmtp/subscription', status=400)
+
+    def test_on_access_gets_called(self):
+        """on_access des queue_handler wird für jede Queue aufgerufen."""
+        QueueHandler.on_access = Mock()
+        self.app.get('/_fmtp/subscription?queue=printer-1&queue=partner')
+
+        self.assertEquals([call[0] for call in QueueHandler.on_access.call_args_list],
+                          [('partner',), ('printer-1',)])
 
 
 class TestAdminHandlerGet(DbTestCase):
@@ -355,22 +1369,52 @@ class TestAdminHandlerGet(DbTestCase):
         self.assertEqual(body['messages'], [
                 {
                     u'queue': u'alpha',
-                    u'guid': u'deleted',
-                    u'is_deleted': True,
+                    u'guid': u'alice',
+                    u'is_deleted': False,
                     u'created_at': u'2011-03-23 00:00:00',
-                    u'deleted_at': u'2011-03-23 00:00:00',
+                    u'deleted_at': None,
                     u'content_type': u'text/plain',
                 }, {
                     u'queue': u'alpha',
-                    u'guid': u'alice',
-                    u'is_deleted': False,
+                    u'guid': u'deleted',
+                    u'is_deleted': True,
                     u'created_at': u'2011-03-23 00:00:00',
-                    u'deleted_at': None,
+                    u'deleted_at': u'2011-03-23 00:00:00',
                     u'content_type': u'text/plain',
                 }
             ]
         )
 
+    def test_filters_by_status(self):
+        """Mit dem Parameter status werden nur lebende bzw. gelöschte Nachrichten angezeigt."""
+        self.assertEqual(self._guids('/admin/alpha/?status=live'), ['alice'])
+        self.assertEqual(self._guids('/admin/alpha/?status=deleted'), ['deleted'])
+        self.app.get('/admin/alpha/?status=unknown', status=400)
+
+    def test_filters_by_created_at(self):
+        """Mit created_after und created_before wird nach dem Erstellungszeitpunkt gefiltert."""
+        self.assertEqual(self._guids('/admin/alpha/?created_after=2011-03-23'), ['alice', 'deleted'])
+        self.assertEqual(self._guids('/admin/alpha/?created_before=2011-03-23'), [])
+        self.assertEqual(self._guids('/admin/alpha/?status=live&created_before=2011-03-24'), ['alice'])
+        self.app.get('/admin/alpha/?created_after=yesterday', status=400)
+        self.app.get('/admin/alpha/?status=deleted&created_after=2011-03-23', status=400)
+
+    def test_pages_with_cursor(self):
+        """Über next_url lassen sich alle Nachrichten abrufen."""
+        class SmallPageAdminHandler(AdminHandler):
+            max_messages = 1
+        self.app = TestApp(WSGIApplication([('/admin/([^/]+)/', SmallPageAdminHandler)], debug=True))
+
+        page = json.loads(self.app.get('/admin/alpha/').body)
+        self.assertEqual([msg['guid'] for msg in page['messages']], ['alice'])
+        page = json.loads(self.app.get(page['next_url']).body)
+        self.assertEqual([msg['guid'] for msg in page['messages']], ['deleted'])
+        self.assertFalse('next_url' in page)
+
+    def _guids(self, url):
+        """Helper, der die guids der Nachrichten in der Admin-Liste zurückgibt."""
+        return [msg['guid'] for msg in json.loads(self.app.get(url).body)['messages']]
+
     def test_on_access_gets_called(self):
         """Das Event on_access wird aufgerufen."""
         AdminHandler.on_access = Mock()
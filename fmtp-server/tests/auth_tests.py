@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/tests/auth_tests.py
+
+Tests der Hilfen für Zugriffsprüfungen aus fmtp_auth. Laufen ohne App Engine SDK.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+import base64
+import unittest
+
+from fmtp_auth import AccessCache, basic_credentials
+
+
+class FakeRequest(object):
+    """Request mit den gegebenen Headern."""
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+
+class TestBasicCredentials(unittest.TestCase):
+    """Tests des Auslesens von HTTP-Basic-Credentials."""
+
+    def test_decodes_credentials(self):
+        """user und password werden aus dem Authorization-Header gelesen."""
+        request = FakeRequest(Authorization='Basic %s' % base64.b64encode('alice:se:cret'))
+        self.assertEquals(basic_credentials(request), ('alice', 'se:cret'))
+
+    def test_ignores_other_schemes(self):
+        """Ohne gültige Basic-Credentials wird None zurückgegeben."""
+        self.assertEquals(basic_credentials(FakeRequest()), None)
+        self.assertEquals(basic_credentials(FakeRequest(Authorization='Bearer token')), None)
+        self.assertEquals(basic_credentials(FakeRequest(Authorization='Basic !!!')), None)
+
+
+class TestAccessCache(unittest.TestCase):
+    """Tests von Ablaufzeit, Negativ-Caching, Verdrängung und Widerruf."""
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = AccessCache(max_size=2, ttl=300, negative_ttl=30, clock=lambda: self.now)
+        self.checks = []
+
+    def check(self, credentials, message_queue_name, method):
+        """Erlaubt alice alles, allen anderen nichts, und merkt sich die Aufrufe."""
+        self.checks.append((credentials, message_queue_name, method))
+        return credentials == ('alice', 'secret')
+
+    def test_caches_results_until_ttl(self):
+        """Erlaubte Zugriffe werden ttl Sekunden lang nicht erneut geprüft."""
+        for _ in range(3):
+            self.assertTrue(self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check))
+        self.assertEquals(len(self.checks), 1)
+        self.now += 301
+        self.assertTrue(self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check))
+        self.assertEquals(len(self.checks), 2)
+
+    def test_caches_denials_shorter(self):
+        """Verweigerte Zugriffe werden nur negative_ttl Sekunden gecached."""
+        self.assertFalse(self.cache.allowed(('bob', 'guess'), 'alpha', 'GET', self.check))
+        self.assertFalse(self.cache.allowed(('bob', 'guess'), 'alpha', 'GET', self.check))
+        self.now += 31
+        self.assertFalse(self.cache.allowed(('bob', 'guess'), 'alpha', 'GET', self.check))
+        self.assertEquals(len(self.checks), 2)
+
+    def test_keys_on_password_queue_and_method(self):
+        """Ein anderes Passwort, eine andere Queue oder Methode wird neu geprüft."""
+        self.cache.max_size = 10
+        self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check)
+        self.assertFalse(self.cache.allowed(('alice', 'wrong'), 'alpha', 'GET', self.check))
+        self.cache.allowed(('alice', 'secret'), 'beta', 'GET', self.check)
+        self.cache.allowed(('alice', 'secret'), 'alpha', 'DELETE', self.check)
+        self.assertEquals(len(self.checks), 4)
+        self.assertFalse([key for key in self.cache.entries if 'secret' in key])
+
+    def test_evicts_least_recently_used(self):
+        """Ist der Cache voll, wird der am längsten nicht benutzte Eintrag verdrängt."""
+        self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check)
+        self.cache.allowed(('alice', 'secret'), 'beta', 'GET', self.check)
+        self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check)
+        self.cache.allowed(('alice', 'secret'), 'gamma', 'GET', self.check)
+        self.assertEquals(self.cache.get(('alice', 'secret'), 'beta', 'GET'), None)
+        self.assertTrue(self.cache.get(('alice', 'secret'), 'alpha', 'GET'))
+
+    def test_revokes_entries(self):
+        """revoke verwirft die Einträge eines Benutzers bzw. einer Queue."""
+        self.cache.max_size = 10
+        self.cache.allowed(('alice', 'secret'), 'alpha', 'GET', self.check)
+        self.cache.allowed(('alice', 'secret'), 'beta', 'GET', self.check)
+        self.cache.allowed(('bob', 'guess'), 'alpha', 'GET', self.check)
+        self.assertEquals(self.cache.revoke(message_queue_name='beta'), 1)
+        self.assertEquals(self.cache.revoke(user='alice'), 1)
+        self.assertEquals(self.cache.get(('alice', 'secret'), 'alpha', 'GET'), None)
+        self.assertEquals(self.cache.get(('bob', 'guess'), 'alpha', 'GET'), False)
+        self.assertEquals(self.cache.revoke(), 1)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/tests/metrics_tests.py
+
+Tests der Messwerte aus fmtp_metrics. Laufen ohne App Engine SDK.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+import unittest
+
+from fmtp_metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests von Zählern, Histogrammen und den Ausgabeformaten."""
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counts_per_labels(self):
+        """Zähler werden je Kombination von Labels geführt."""
+        self.metrics.incr('fmtp_responses_total', handler='QueueHandler', status='2xx')
+        self.metrics.incr('fmtp_responses_total', 2, status='2xx', handler='QueueHandler')
+        self.metrics.incr('fmtp_responses_total', handler='QueueHandler', status='4xx')
+        self.assertEquals(self.metrics.as_dict()['counters']['fmtp_responses_total'], [
+            {'labels': {'handler': 'QueueHandler', 'status': '2xx'}, 'value': 3},
+            {'labels': {'handler': 'QueueHandler', 'status': '4xx'}, 'value': 1}])
+
+    def test_observes_cumulative_buckets(self):
+        """Histogramme zählen kumulativ je Klasse, Werte über der letzten Grenze nur in count."""
+        for value in [0.5, 1, 3, 100]:
+            self.metrics.observe('fmtp_request_seconds', value, buckets=(1, 5), method='GET')
+        histogram, = self.metrics.as_dict()['histograms']['fmtp_request_seconds']
+        self.assertEquals(histogram['buckets'], [[1, 2], [5, 3]])
+        self.assertEquals((histogram['sum'], histogram['count']), (104.5, 4))
+
+    def test_counts_datastore_rpcs_per_request(self):
+        """Datastore-Aufrufe werden insgesamt und für den laufenden Request gezählt."""
+        self.metrics.count_rpc('Put')
+        self.metrics.start_request()
+        self.metrics.count_rpc('Get')
+        self.metrics.count_rpc('Get')
+        self.assertEquals(self.metrics.finish_request(), {'Get': 2})
+        self.assertEquals(self.metrics.finish_request(), {})
+        counters = self.metrics.as_dict()['counters']['fmtp_datastore_rpcs_total']
+        self.assertEquals([(counter['labels']['kind'], counter['value']) for counter in counters],
+                          [('read', 2), ('write', 1)])
+
+    def test_formats_prometheus_text(self):
+        """Die Ausgabe entspricht dem Prometheus-Textformat."""
+        self.metrics.incr('fmtp_queue_requests_total', queue=u'a"b')
+        self.metrics.observe('fmtp_listing_messages', 3, buckets=(1, 5))
+        self.assertEquals(self.metrics.as_prometheus().splitlines(), [
+            '# TYPE fmtp_queue_requests_total counter',
+            'fmtp_queue_requests_total{queue="a\\"b"} 1',
+            '# TYPE fmtp_listing_messages histogram',
+            'fmtp_listing_messages_bucket{le="1"} 0',
+            'fmtp_listing_messages_bucket{le="5"} 1',
+            'fmtp_listing_messages_bucket{le="+Inf"} 1',
+            'fmtp_listing_messages_sum 3',
+            'fmtp_listing_messages_count 1'])
+
+    def test_keeps_latest_profiles(self):
+        """Es werden nur die letzten max_profiles Profile aufbewahrt."""
+        self.metrics.max_profiles = 2
+        self.metrics.reset()
+        for index in range(3):
+            self.metrics.add_profile({'index': index})
+        self.assertEquals(self.metrics.as_dict()['profiles'], [{'index': 1}, {'index': 2}])
+
+    def test_limits_label_combinations(self):
+        """Über max_series hinaus werden Labels unter OTHER zusammengefasst."""
+        self.metrics.max_series = 2
+        for queue in ['alpha', 'beta', 'gamma', 'delta', 'alpha']:
+            self.metrics.incr('fmtp_queue_requests_total', queue=queue)
+        self.assertEquals([(counter['labels']['queue'], counter['value'])
+                           for counter in self.metrics.as_dict()['counters']['fmtp_queue_requests_total']],
+                          [('_other', 2), ('alpha', 2), ('beta', 1)])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/tests/standalone_tests.py
+
+Tests des Servers aus fmtp_standalone. Statt der FMTP-Handler bedient der Server meist eine minimale
+WSGI-Anwendung, diese Tests laufen daher ohne App Engine SDK. Die Tests mit den echten Handlern aus
+make_app werden ohne SDK übersprungen.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+import httplib
+import json
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import fmtp_standalone
+from fmtp_standalone import FmtpServer
+from fmtp_storage import SqliteStorage
+
+try:
+    import gaetk
+    import google.appengine
+    HAVE_SDK = True
+except ImportError:
+    HAVE_SDK = False
+
+
+def make_app(storage, gc_done=None):
+    """Minimale Anwendung: GET /<queue>/ listet guids, POST /<queue>/<guid>/ legt eine Nachricht an.
+
+    /_fmtp/gc antwortet erst, wenn gc_done gesetzt ist.
+    """
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/_fmtp/gc':
+            gc_done.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['done']
+        parts = environ['PATH_INFO'].strip('/').split('/')
+        if environ['REQUEST_METHOD'] == 'POST':
+            storage.create_messages(parts[0], [(parts[1], 'text/plain', environ['wsgi.input'].read(), None)])
+            start_response('201 Created', [])
+            return []
+        assert 'wait' not in environ['QUERY_STRING']
+        messages, _cursor, _more = storage.list_messages(parts[0], None, 10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['\n'.join(message.guid for message in messages).encode('utf-8')]
+    return app
+
+
+class TestFmtpServer(unittest.TestCase):
+    """Tests von keep-alive und Long-Polling."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SqliteStorage(os.path.join(self.directory, 'fmtp.sqlite'))
+        self.gc_done = threading.Event()
+        self.server = FmtpServer(make_app(self.storage, self.gc_done), self.storage, 'localhost', 0,
+                                 poll_interval=0.05, max_body_size=1024)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.gc_done.set()
+        self.server.stop()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def _connection(self):
+        return httplib.HTTPConnection('localhost', self.port, timeout=10)
+
+    def test_keeps_connection_alive(self):
+        """Mehrere Anfragen laufen über dieselbe Verbindung."""
+        connection = self._connection()
+        for guid in ['alice', 'bob']:
+            connection.request('POST', '/alpha/%s/' % guid, 'body')
+            response = connection.getresponse()
+            response.read()
+            self.assertEquals(response.status, 201)
+            self.assertEquals(response.getheader('Connection'), 'keep-alive')
+        connection.request('GET', '/alpha/')
+        self.assertEquals(connection.getresponse().read().splitlines(), ['alice', 'bob'])
+
+    def test_parks_long_poll_until_message_arrives(self):
+        """Eine wartende Anfrage wird beantwortet, sobald eine Nachricht eintrifft."""
+        poller = self._connection()
+        poller.request('GET', '/alpha/?wait=5')
+        time.sleep(0.2)
+
+        start = time.time()
+        sender = self._connection()
+        sender.request('POST', '/alpha/alice/', 'body')
+        sender.getresponse().read()
+
+        self.assertEquals(poller.getresponse().read(), 'alice')
+        self.assertTrue(time.time() - start < 2)
+
+    def test_long_poll_times_out(self):
+        """Ohne neue Nachrichten antwortet eine wartende Anfrage nach Ablauf der Wartezeit."""
+        start = time.time()
+        connection = self._connection()
+        connection.request('GET', '/alpha/?wait=0.3')
+        response = connection.getresponse()
+        self.assertEquals((response.status, response.read()), (200, ''))
+        self.assertTrue(time.time() - start >= 0.3)
+
+    def test_rejects_large_bodies(self):
+        """Bodies über max_body_size werden mit 413 abgelehnt, ohne sie zu lesen."""
+        connection = self._connection()
+        connection.request('POST', '/alpha/big/', 'x' * 2048)
+        self.assertEquals(connection.getresponse().status, 413)
+
+    def test_answers_expect_continue(self):
+        """Auf Expect: 100-continue antwortet der Server mit 100 Continue, bevor er den Body liest."""
+        sock = socket.create_connection(('localhost', self.port), timeout=10)
+        sock.sendall('POST /alpha/alice/ HTTP/1.1\r\nHost: localhost\r\nContent-Length: 4\r\n'
+                     'Expect: 100-continue\r\n\r\n')
+        self.assertTrue(sock.recv(1024).startswith('HTTP/1.1 100 Continue\r\n\r\n'))
+        sock.sendall('body')
+        response = ''
+        while '\r\n\r\n' not in response:
+            response += sock.recv(1024)
+        self.assertTrue(response.startswith('HTTP/1.1 201'))
+        sock.close()
+
+    def test_runs_garbage_collection_in_background(self):
+        """Eine laufende GarbageCollection blockiert andere Anfragen nicht."""
+        collector = self._connection()
+        collector.request('GET', '/_fmtp/gc')
+        time.sleep(0.1)
+
+        connection = self._connection()
+        connection.request('POST', '/alpha/alice/', 'body')
+        self.assertEquals(connection.getresponse().status, 201)
+
+        self.gc_done.set()
+        self.assertEquals(collector.getresponse().read(), 'done')
+
+
+@unittest.skipUnless(HAVE_SDK, 'gaetk und das App Engine SDK fehlen')
+class TestMakeApp(unittest.TestCase):
+    """Tests der echten Handler aus make_app mit SqliteStorage."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SqliteStorage(os.path.join(self.directory, 'fmtp.sqlite'))
+        self.server = FmtpServer(fmtp_standalone.make_app(self.storage), self.storage, 'localhost', 0,
+                                 poll_interval=0.05)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def request(self, method, path, body=None, headers=None):
+        """Stellt eine Anfrage und gibt (status, headers, body) zurück."""
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=10)
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+
+    def test_serves_messages(self):
+        """Nachrichten lassen sich einstellen, auflisten, abrufen und löschen."""
+        self.assertEquals(self.request('POST', '/alpha/alice/', 'Hallo', {'Content-Type': 'text/plain'})[0], 201)
+        status, _headers, body = self.request('GET', '/alpha/', headers={'Accept': 'application/json'})
+        self.assertEquals([msg['url'] for msg in json.loads(body)['messages']],
+                          ['http://localhost:%d/alpha/alice/' % self.port])
+        self.assertEquals(self.request('GET', '/alpha/alice/')[2], 'Hallo')
+        self.assertEquals(self.request('DELETE', '/alpha/alice/')[0], 204)
+        self.assertEquals(self.request('GET', '/alpha/alice/')[0], 410)
+
+    def test_serves_batches_and_subscriptions(self):
+        """Stapel und Abonnements sind verdrahtet."""
+        status, _headers, body = self.request('POST', '/alpha/', json.dumps({'guid': 'bob', 'body': 'Hallo'}),
+                                              {'Content-Type': 'application/x-ndjson'})
+        self.assertEquals((status, json.loads(body)['messages'][0]['status']), (200, 201))
+        body = self.request('GET', '/_fmtp/subscription?prefix=al', headers={'Accept': 'application/json'})[2]
+        self.assertEquals([msg['guid'] for msg in json.loads(body)['messages']], ['bob'])
+
+    def test_runs_garbage_collection(self):
+        """Die GarbageCollection läuft über die echten Handler."""
+        self.assertEquals(self.request('GET', '/_fmtp/gc')[0], 200)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fmtp-server/tests/storage_tests.py
+
+Tests der SQLite-Storage. Laufen ohne App Engine SDK.
+
+Copyright (c) 2011 HUDORA. All rights reserved.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from fmtp_storage import InvalidCursor, SqliteStorage
+
+
+class TestSqliteStorage(unittest.TestCase):
+    """Tests der Operationen, die die Handler von einer Storage erwarten."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SqliteStorage(os.path.join(self.directory, 'fmtp.sqlite'))
+        self.storage.create_messages(u'alpha', [(u'alice', 'text/plain', 'body', None),
+                                                (u'bob', 'application/pdf', '\x1f\x8b\x00', 'gzip')])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_uses_wal_mode(self):
+        """Die Datenbank läuft im WAL-Modus."""
+        self.assertEquals(self.storage._connection().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_creates_if_absent(self):
+        """Existierende Nachrichten werden nicht überschrieben."""
+        self.storage.mark_deleted(u'alpha', [u'bob'], datetime.now())
+        results = self.storage.create_messages(u'alpha', [(u'alice', 'text/plain', 'other', None),
+                                                          (u'bob', 'text/plain', 'other', None),
+                                                          (u'carol', 'text/plain', 'body', None)])
+        self.assertEquals([(message.guid, status) for status, message in results],
+                          [(u'alice', 409), (u'bob', 410), (u'carol', 201)])
+        message = self.storage.get_message(u'alpha', u'alice')
+        self.assertEquals(''.join(self.storage.iter_body(message)), 'body')
+
+    def test_gets_message(self):
+        """Nachrichten werden samt Metadaten gefunden, andere Queues sind getrennt."""
+        message = self.storage.get_message(u'alpha', u'bob')
+        self.assertEquals(message.content_type, 'application/pdf')
+        self.assertEquals(message.content_encoding, 'gzip')
+        self.assertEquals(message.deleted_at, None)
+        self.assertEquals(''.join(self.storage.iter_body(message)), '\x1f\x8b\x00')
+        self.assertEquals(self.storage.get_message(u'beta', u'bob'), None)
+
+    def test_gets_messages(self):
+        """Mehrere Nachrichten werden in der Reihenfolge der guids gelesen, fehlende sind None."""
+        messages = self.storage.get_messages(u'alpha', [u'bob', u'nobody', u'alice'])
+        self.assertEquals([message and message.guid for message in messages], [u'bob', None, u'alice'])
+        self.assertEquals(self.storage.get_messages(u'alpha', [u'guid%d' % index for index in range(1200)]),
+                          [None] * 1200)
+
+    def test_gets_body_sizes(self):
+        """Die Größen der Bodies werden ohne die Bodies gelesen."""
+        messages = [self.storage.get_message(u'alpha', guid) for guid in (u'bob', u'alice')]
+        self.assertEquals(self.storage.body_sizes(messages), [3, 4])
+        self.assertEquals(self.storage.body_sizes([]), [])
+
+    def test_marks_deleted(self):
+        """Löschen liefert die Status von MessageHandler.delete."""
+        results = self.storage.mark_deleted(u'alpha', [u'alice', u'alice', u'nobody'], datetime.now())
+        self.assertEquals([status for status, _message in results], [204, 410, 404])
+        message = self.storage.get_message(u'alpha', u'alice')
+        self.assertTrue(message.deleted_at)
+        self.assertEquals(message.content_hash, hashlib.sha1('body').hexdigest())
+        self.assertEquals(list(self.storage.iter_body(message)), [])
+
+    def test_lists_live_messages_in_pages(self):
+        """Die Liste enthält nur nicht gelöschte Nachrichten und lässt sich per Cursor blättern."""
+        self.storage.create_messages(u'alpha', [(u'carol', 'text/plain', 'body', None)])
+        self.storage.mark_deleted(u'alpha', [u'bob'], datetime.now())
+
+        messages, cursor, more = self.storage.list_messages(u'alpha', None, 1)
+        self.assertEquals(([message.guid for message in messages], more), ([u'alice'], True))
+        messages, cursor, more = self.storage.list_messages(u'alpha', cursor, 1)
+        self.assertEquals(([message.guid for message in messages], more), ([u'carol'], False))
+        self.assertRaises(InvalidCursor, self.storage.list_messages, u'alpha', 'garbage', 1)
+
+    def test_lists_all_messages(self):
+        """Die Admin-Liste filtert nach Status und created_at."""
+        self.storage.mark_deleted(u'alpha', [u'bob'], datetime.now())
+
+        def guids(status, created_after=None, created_before=None):
+            messages, _cursor, _more = self.storage.list_all_messages(u'alpha', status, created_after,
+                                                                      created_before, None, 10)
+            return [message.guid for message in messages]
+        self.assertEquals(guids('all'), [u'alice', u'bob'])
+        self.assertEquals(guids('live'), [u'alice'])
+        self.assertEquals(guids('deleted'), [u'bob'])
+        self.assertEquals(guids('all', created_before=datetime.now() - timedelta(days=1)), [])
+
+        messages, cursor, more = self.storage.list_all_messages(u'alpha', 'all', None, None, None, 1)
+        self.assertTrue(more)
+        messages, cursor, more = self.storage.list_all_messages(u'alpha', 'all', None, None, cursor, 1)
+        self.assertEquals(([message.guid for message in messages], more), ([u'bob'], False))
+
+    def test_changes_queue_version(self):
+        """Erstellen und Löschen ändern die Version der Queue, Dubletten nicht."""
+        version = self.storage.queue_version(u'alpha')
+        self.storage.create_messages(u'alpha', [(u'alice', 'text/plain', 'body', None)])
+        self.assertEquals(self.storage.queue_version(u'alpha'), version)
+        self.storage.mark_deleted(u'alpha', [u'alice'], datetime.now())
+        self.assertNotEqual(self.storage.queue_version(u'alpha'), version)
+
+    def test_leases_messages(self):
+        """Geleaste Nachrichten fehlen bis zum Ablauf der Lease in allen Listen."""
+        messages, _cursor, _more = self.storage.lease_messages(u'alpha', None, 1, 60)
+        self.assertEquals([message.guid for message in messages], [u'alice'])
+        self.assertTrue(messages[0].leased_until > datetime.now())
+        messages, _cursor, _more = self.storage.list_messages(u'alpha', None, 10)
+        self.assertEquals([message.guid for message in messages], [u'bob'])
+
+        self.storage._connection().execute('UPDATE messages SET leased_until = ?',
+                                           (datetime.now() - timedelta(seconds=1),))
+        messages, _cursor, _more = self.storage.list_messages(u'alpha', None, 10)
+        self.assertEquals([message.guid for message in messages], [u'alice', u'bob'])
+
+    def test_counts_queue_stats(self):
+        """Die Zähler folgen Erstellen, Löschen und GarbageCollection."""
+        stats = self.storage.queue_stats(u'alpha')
+        self.assertEquals((stats['live'], stats['deleted'], stats['bytes']), (2, 0, 7))
+        self.assertEquals(stats['oldest_created_at'], self.storage.get_message(u'alpha', u'alice').created_at)
+
+        self.storage.create_messages(u'alpha', [(u'alice', 'text/plain', 'other', None)])
+        self.storage.mark_deleted(u'alpha', [u'alice', u'alice'], datetime.now() - timedelta(days=8))
+        stats = self.storage.queue_stats(u'alpha')
+        self.assertEquals((stats['live'], stats['deleted'], stats['bytes']), (1, 1, 3))
+        self.assertEquals(stats['oldest_created_at'], self.storage.get_message(u'alpha', u'bob').created_at)
+
+        self.storage.start_garbage_collection(u'alpha', datetime.now() - timedelta(days=7), datetime.now())
+        self.assertEquals(self.storage.queue_stats(u'alpha'),
+                          {'live': 0, 'deleted': 1, 'bytes': 0, 'oldest_created_at': None})
+        self.assertEquals(self.storage.queue_stats(u'beta')['live'], 0)
+
+    def test_leases_events(self):
+        """Geleaste Events werden erst nach Ablauf der Lease erneut geliefert, gelöschte nie mehr."""
+        self.storage.add_events(['first', '\x80second'])
+        self.assertEquals([payload for _id, payload in self.storage.lease_events(1, 60)], ['first'])
+        events = self.storage.lease_events(10, 60)
+        self.assertEquals([payload for _id, payload in events], ['\x80second'])
+        self.assertEquals(self.storage.lease_events(10, 60), [])
+
+        self.storage.delete_events([event_id for event_id, _payload in events])
+        self.storage._connection().execute('UPDATE events SET leased_until = ?',
+                                           (datetime.now() - timedelta(seconds=1),))
+        self.assertEquals([payload for _id, payload in self.storage.lease_events(10, 60)], ['first'])
+
+    def test_collects_garbage(self):
+        """Die GarbageCollection entfernt nur früh genug gelöschte Nachrichten."""
+        self.storage.gc_batch_size = 1
+        self.storage.create_messages(u'alpha', [(u'carol', 'text/plain', 'body', None)])
+        self.storage.mark_deleted(u'alpha', [u'alice', u'bob'], datetime.now() - timedelta(days=8))
+        self.storage.mark_deleted(u'alpha', [u'carol'], datetime.now())
+
+        status = self.storage.start_garbage_collection(u'alpha', datetime.now() - timedelta(days=7))
+        self.assertEquals((status['status'], status['deleted']), ('done', 2))
+        self.assertEquals(self.storage.get_message(u'alpha', u'alice'), None)
+        self.assertTrue(self.storage.get_message(u'alpha', u'carol'))
+        self.assertEquals(self.storage.garbage_collection_status(u'alpha')['deleted'], 2)
+        self.assertEquals(self.storage.queue_names(), [u'alpha'])
+
+    def test_expires_old_messages(self):
+        """Mit expire_before markiert die GarbageCollection zu alte Nachrichten als gelöscht."""
+        self.storage.gc_batch_size = 1
+        self.storage.create_messages(u'alpha', [(u'carol', 'text/plain', 'body', None)])
+        self.storage._connection().execute('UPDATE messages SET created_at = ? WHERE guid != ?',
+                                           (datetime.now() - timedelta(days=3), u'carol'))
+        version = self.storage.queue_version(u'alpha')
+
+        status = self.storage.start_garbage_collection(u'alpha', datetime.now() - timedelta(days=7),
+                                                       datetime.now() - timedelta(days=2))
+        self.assertEquals((status['expired'], status['deleted']), (2, 0))
+        self.assertTrue(self.storage.get_message(u'alpha', u'alice').deleted_at)
+        self.assertEquals(self.storage.get_message(u'alpha', u'carol').deleted_at, None)
+        self.assertNotEqual(self.storage.queue_version(u'alpha'), version)